@@ -47,7 +47,7 @@ result = "(%s) arg0: [%s], arg1: [%s] arg2: [%s] [%s]\n %s \n\n" % (System.Net.D
 
 def message(msg):
   print msg
-  ts.WriteLogMessage(msg, "", None)
+  logsink.WriteLogMessage(msg, "", None)
   return msg
 
 def get_task(task,calinfo):
@@ -145,7 +145,7 @@ if ( arg0 == 'dashboard' ):
   except:
     tb = format_trace_back()
     result += tb
-    GenUtils.PriorityLogMsg('info', '_run.py', tb)
+    logsink.PriorityLogMsg('info', '_run.py', tb)
 
 if ( arg0 == 'pylib' ):
   result = os.path.realpath('.')
@@ -165,10 +165,6 @@ if ( arg0 == 'get_fb_ical_url' ):
   except:
     tb = format_trace_back()
     result = tb
-    GenUtils.PriorityLogMsg('info', 'get_fb_ical_url', tb)
-  
- 
-
-
-
+    logsink.PriorityLogMsg('info', 'get_fb_ical_url', tb)
 
+logsink.Close()   # write out what is queued before the engine shuts down
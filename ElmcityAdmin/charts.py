@@ -16,7 +16,8 @@ import CalendarAggregator
 local_storage = get_local_storage()
 python_lib = local_storage + '/Lib'
 sys.path.append(python_lib)
-import traceback, os   
+import traceback, os, glob
+import w3clog, failedreq, logpool   # from ElmcityLib
 
 hostname = System.Net.Dns.GetHostName()
 
@@ -36,13 +37,13 @@ def make_html(local_storage, bin, type, in_spec, title, query):
       cmd = cmd.replace('__XML_FNAMES__', '-fnames:xpath')
     else:
       cmd = cmd.replace('__XML_FNAMES__', '')
-    GenUtils.LogMsg("info", "make_html", cmd)
+    logsink.LogMsg("info", "make_html", cmd)
     os.system(cmd)
     d = System.Xml.XmlDocument()
     d.Load(out_spec)
     make_html_table(d, expanded_title, out_spec, html_fname )
   except:
-    GenUtils.LogMsg("exception", "make_html", format_traceback() )
+    logsink.LogMsg("exception", "make_html", format_traceback() )
 
 def get_xml_header_row(row):
   headers = ''
@@ -63,6 +64,12 @@ def make_url(fname):
   return 'http://elmcity.blob.core.windows.net/charts/%s' % fname
 
 def make_html_table(d, title, out_spec, fname):
+  rows = '<tr>%s</tr>\n' % get_xml_header_row(d.DocumentElement.ChildNodes[0])
+  for row in d.DocumentElement.ChildNodes:
+    rows += '<tr>%s</tr>\n' % get_xml_value_row(row)
+  put_html_table(title, fname, rows)
+
+def put_html_table(title, fname, rows):
   try:
     html = """<html>
 <head><title>%s</title></head>
@@ -73,19 +80,33 @@ h1 { font-size:smaller }
 <h1><a href="%s">%s</a></h1>\n<table>
 """ % (title, make_url(fname), title )
 
-    html += '<tr>%s</tr>\n' % get_xml_header_row(d.DocumentElement.ChildNodes[0])
-    for row in d.DocumentElement.ChildNodes:
-      html += '<tr>%s</tr>\n' % get_xml_value_row(row)
+    html += rows
     html += '</table>\n</body>\n</html>'
     data = System.Text.Encoding.UTF8.GetBytes(html)
     r = bs.PutBlob('charts', fname, System.Collections.Hashtable(), data, 'text/html' )
     print r.HttpResponse.status.ToString()
   except:
-    GenUtils.PriorityLogMsg('exception', 'charts.py: make_html_table', format_traceback() )
+    logsink.PriorityLogMsg('exception', 'charts.py: make_html_table', format_traceback() )
+
+def make_rows_html(title, headers, rows):
+  try:
+    put_html_table(expand_title(title), make_fname(title, 'html'), w3clog.HtmlRows(headers, rows))
+  except:
+    logsink.LogMsg("exception", "make_rows_html", format_traceback() )
+
+def make_w3c_chart(title, headers, rows):
+  try:
+    fname = make_fname(title, 'gif')
+    out_spec = make_out_spec(local_storage, fname)
+    w3clog.WriteChart(out_spec, expand_title(title), headers, rows)
+    data = System.IO.File.ReadAllBytes(out_spec)
+    bs.PutBlob('charts', fname, System.Collections.Hashtable(), data, "image/gif" )
+  except:
+    logsink.PriorityLogMsg('exception', 'MakeChart: ' + title, format_traceback() )
   
 bin = 'e:\\approot\\bin'
 
-GenUtils.LogMsg('info', 'charts.py', repr(get_process_owner()) )
+logsink.LogMsg('info', 'charts.py', repr(get_process_owner()) )
 
 # event queries
 
@@ -111,82 +132,39 @@ title = 'SystemLogErrors'
 query = template.replace('__EVENTTYPE__', 'Error')
 make_html(local_storage, bin, 'evt', 'System', title, query)
 
-# web queries: tables
+# web queries: tables and charts, from one pass over what the logs have added since the last run (see w3clog.py)
+
+def get_optional_setting(name):
+  settings = GenUtils.GetSettingsFromAzureTable()
+  if settings.ContainsKey(name):
+    return float(settings[name])
+  return None
 
 try:
-  in_spec = '%s/*.log' % get_log_storage()
+  window_days = get_optional_setting('web_log_window_days')   # None: every log in the store, as LogParser read them
+  count_error = get_optional_setting('web_log_count_error')   # None: exact counts
+  tail = w3clog.TailState(w3clog.StatePath(), window_days, error=count_error)
+  aggregates = tail.Update(glob.glob('%s/*.log' % get_log_storage()), workers=logpool.CpuCount())
+  tail.Save()
+  logsink.LogMsg('info', 'charts.py: w3clog', '%s lines' % aggregates.lines)
+  for title, headers, rows in aggregates.Tables():
+    make_rows_html(title, headers, rows)
+  for title, headers, rows in aggregates.Charts():
+    make_w3c_chart(title, headers, rows)
 except:
-  GenUtils.PriorityLogMsg('exception', 'charts.py: get_log_storage', format_traceback() )
-
-title = 'Top400Urls'
-query = 'select top 50 count(*) as c, cs-uri-stem into __OUT__ from __IN__ where sc-status = 400 group by cs-uri-stem order by c desc'
-make_html(local_storage, bin, 'iisw3c', in_spec, title, query)
-
-title = 'TopSlowUrlsStatusEq200'
-query = 'select top 50 time-taken as millis, sc-bytes, cs-uri-stem into __OUT__ from __IN__ where sc-status = 200 order by millis desc'
-make_html(local_storage, bin, 'iisw3c', in_spec, title, query)
-
-title = 'TopSlowUrlsStatusGt200'
-query = 'select top 50 time-taken as millis, sc-status, sc-bytes, cs-uri-stem into __OUT__ from __IN__ where sc-status > 200 order by millis desc'
-make_html(local_storage, bin, 'iisw3c', in_spec, title, query)
-
-title = 'TopUrls'
-query = 'select top 50 count(*) as c, cs-uri-stem into __OUT__ from __IN__ where sc-status = 200 group by cs-uri-stem order by c desc'
-make_html(local_storage, bin, 'iisw3c', in_spec, title, query)
-
-# web queries: charts
+  logsink.PriorityLogMsg('exception', 'charts.py: w3clog', format_traceback() )
 
-title = 'LoadTimesHtmlOnly'
-query = "select qntround_to_digit(time-taken, 2) as millis, count(*) as pageloads into __OUT__ from __IN__ where cs-uri-stem like '%html%' group by millis having count(*) > 0 order by millis"
-make_chart(local_storage, bin, 'iisw3c', 'ColumnClustered', in_spec, title, query)
-
-title = 'LoadTimes'
-query = 'select qntround_to_digit(time-taken, 2) as millis, count(*) as pageloads into __OUT__ from __IN__ group by millis having count(*) > 0 order by millis'
-make_chart(local_storage, bin, 'iisw3c', 'ColumnClustered', in_spec, title, query)
-
-title = 'RequestsByStatus'
-query = 'select sc-status, count(*) as requests into __OUT__ from __IN__ group by sc-status order by requests desc'
-make_chart(local_storage, bin, 'iisw3c', 'ColumnClustered', in_spec, title, query)
-
-title = 'RequestsByHour'
-query = 'select quantize(to_timestamp(date,time),3600) as hourly, count(*) as requests into __OUT__ from __IN__ group by hourly order by hourly'
-make_chart(local_storage, bin, 'iisw3c', 'ColumnClustered', in_spec, title, query)
-
-title = 'RequestsByIp'
-query = 'select top 50 c-ip as dnsname, count(*) as requests into __OUT__ from __IN__ group by dnsname having requests > 0 order by requests desc'
-make_chart(local_storage, bin, 'iisw3c', 'ColumnClustered', in_spec, title, query)
-
-# failed requests: tables
+# failed requests: tables, reading only traces not seen before (see failedreq.py)
 
 try:
-  in_spec = '%s/*.xml' % get_failed_request_log_storage()
+  traces = failedreq.TraceCache(failedreq.CachePath())
+  summary = traces.Update(glob.glob('%s/*.xml' % get_failed_request_log_storage()), workers=logpool.CpuCount())
+  traces.Save()
+  logsink.LogMsg('info', 'charts.py: failedreq', '%s traces, %s read' % ( len(traces.files), traces.read ))
+  for title, headers, rows in summary.Tables():
+    make_rows_html(title, headers, rows)
 except:
-  GenUtils.PriorityLogMsg('exception', 'charts.py: get_log_storage', format_traceback() )
-  
-# logparser -q -i:XML -fNames:XPath "select count(/failedRequest/@url), /failedRequest/@url from *.xml where /failedRequest/Event/EventData/Data/@Name = 'RequestURL' group by /failedRequest/@url order by count(/failedRequest/@url) desc" 
-title = 'FailedRequestsByCount'
-query = "select count(/failedRequest/@url), /failedRequest/@url into __OUT__ from __IN__ where /failedRequest/Event/EventData/Data/@Name = 'RequestURL' group by /failedRequest/@url order by count(/failedRequest/@url) desc"
-make_html(local_storage, bin, 'xml', in_spec, title, query)  
-
-title = 'FailedRequestsByStatus'
-query = "select /failedRequest/@statusCode, count(/failedRequest/@statusCode) into __OUT__ from __IN__ where /failedRequest/Event/EventData/Data/@Name = 'RequestURL' group by /failedRequest/@statusCode order by count(/failedRequest/@statusCode) desc"
-make_html(local_storage, bin, 'xml', in_spec, title, query)  
-
-title = 'FailedRequestTop400s'
-query = "select top 10 count(/failedRequest/@url), /failedRequest/@url  into __OUT__ from __IN__ where /failedRequest/Event/EventData/Data/@Name = 'RequestURL' and /failedRequest/@statusCode = '400' group by /failedRequest/@url order by count(/failedRequest/@url) desc"
-make_html(local_storage, bin, 'xml', in_spec, title, query) 
-
-title = 'FailedRequestTop404s'
-query = "select top 10 count(/failedRequest/@url), /failedRequest/@url into __OUT__ from __IN__ where /failedRequest/Event/EventData/Data/@Name = 'RequestURL' and /failedRequest/@statusCode = '404' group by /failedRequest/@url order by count(/failedRequest/@url) desc"
-make_html(local_storage, bin, 'xml', in_spec, title, query) 
-
-title = 'FailedRequestTop200s'
-query = "select top 10 count(/failedRequest/@url), /failedRequest/@url into __OUT__ from __IN__ where /failedRequest/Event/EventData/Data/@Name = 'RequestURL' and /failedRequest/@statusCode = '200' group by /failedRequest/@url order by count(/failedRequest/@url) desc"
-make_html(local_storage, bin, 'xml', in_spec, title, query) 
-
-title = 'FailedRequestTopOthers'
-query = "select top 10 count(/failedRequest/@url), /failedRequest/@statusCode, /failedRequest/@url into __OUT__ from __IN__ where /failedRequest/Event/EventData/Data/@Name = 'RequestURL' and not /failedRequest/@statusCode = '200' and not /failedRequest/@statusCode = '400' and not /failedRequest/@statusCode = '404'group by /failedRequest/@statusCode order by count(/failedRequest/@statusCode) desc"
-make_html(local_storage, bin, 'xml', in_spec, title, query) 
+  logsink.PriorityLogMsg('exception', 'charts.py: failedreq', format_traceback() )
 
 try:
   args = System.Collections.Generic.List[str]()
@@ -196,7 +174,9 @@ try:
   script_url = CalendarAggregator.Configurator.dashboard_script_url
   PythonUtils.RunIronPython(local_storage, script_url, args)    
 except:
-  GenUtils.PriorityLogMsg('exception', format_traceback(), None )
+  logsink.PriorityLogMsg('exception', format_traceback(), None )
+
+logsink.Close()   # write out what is queued before the engine shuts down
 
 # run logparser queries against iis logs and failed request logs
 # output charts (gifs) and/or tables (htmls) to charts container in azure storage
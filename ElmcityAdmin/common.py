@@ -1,6 +1,8 @@
 clr.AddReference('System.Management')
 import System.Management 
 
+import logsink   # from ElmcityLib, buffered in place of GenUtils.LogMsg, see logsink.py
+
 def get_resource_dirs():
   return System.IO.Directory.GetDirectories('c:\Resources\Directory')
 
@@ -50,20 +52,20 @@ def format_traceback():
 
 def make_chart(local_storage, bin, source_type, chart_type, in_spec, title, query):
   try:
-    GenUtils.LogMsg("info", "query: " + query, None)    
+    logsink.LogMsg("info", "query: " + query, None)    
     fname = make_fname ( title, 'gif' )
     out_spec = make_out_spec( local_storage, fname )
     expanded_title = expand_title ( title )
     query = query.replace('__IN__', in_spec)
     query = query.replace('__OUT__', out_spec)
     cmd = '%s\\LogParser -q -e:1 -i:%s -o:CHART -categories:ON -groupSize:1500x800 -legend:ON -ChartTitle:"%s" -chartType:"%s" "%s"' % ( bin, source_type, expanded_title, chart_type, query )
-    GenUtils.LogMsg("info", "make_chart: " + cmd, None)
+    logsink.LogMsg("info", "make_chart: " + cmd, None)
     os.system(cmd)
     bs = BlobStorage.MakeDefaultBlobStorage()
     data = System.IO.File.ReadAllBytes(out_spec)
     bs.PutBlob('charts', fname, System.Collections.Hashtable(), data, "image/gif" )
   except:
-    GenUtils.PriorityLogMsg('exception', 'MakeChart: ' + title, format_traceback() )
+    logsink.PriorityLogMsg('exception', 'MakeChart: ' + title, format_traceback() )
 
 def make_out_spec(local_storage, fname):
   return '%s/%s' % ( local_storage, fname )
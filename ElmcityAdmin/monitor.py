@@ -31,7 +31,7 @@ def make_xml_blobname():
 monitor = '%s/%s' % ( local_storage, 'monitor.xml')
 
 try:
-  GenUtils.LogMsg('info', 'worker querying into %s' % monitor, None)
+  logsink.LogMsg('info', 'worker querying into %s' % monitor, None)
   ts = TableStorage.MakeDefaultTableStorage()
   dt = System.DateTime.UtcNow - System.TimeSpan.FromHours(48)
   filter = "$filter=PartitionKey+eq+'monitor'+and+RowKey+gt+'%s'" % dt.Ticks
@@ -39,12 +39,12 @@ try:
   f = open(monitor, 'w')
   f.write(s)
   f.close()
-  GenUtils.LogMsg('info', 'worker saving %s' % monitor, None)
-  GenUtils.LogMsg('info', 'worker saving %s' % monitor, None)
+  logsink.LogMsg('info', 'worker saving %s' % monitor, None)
+  logsink.LogMsg('info', 'worker saving %s' % monitor, None)
   bs.PutBlob('charts', 'monitor.xml', s)
 except:
   print format_traceback()
-  GenUtils.PriorityLogMsg('exception', 'MakeChart', format_traceback() )
+  logsink.PriorityLogMsg('exception', 'MakeChart', format_traceback() )
 
 # charts
 
@@ -127,6 +127,54 @@ title = 'AspNetReqsSucceededAndFailed'
 query = template % ( fields, 'w3wp', 1000)
 make_chart(local_storage, bin, 'xml', 'Line', in_spec, title, query)
 
+# fusecal queries (one row per parse, from ElmcityLib/metrics.py, all hosts)
+
+make_fname = make_web_fname
+
+template = "select d:parser, %s into __OUT__ from __IN__ where d:ProcName = 'fusecal' group by d:parser order by d:parser"
+
+fields = 'sum(d:fetch_ms) as fetch, sum(d:parse_ms) as parse, sum(d:filter_ms) as filter, sum(d:build_ms) as build, sum(d:serialize_ms) as serialize'
+
+title = 'FusecalPhaseMsByParser'
+query = template % fields
+make_chart(local_storage, bin, 'xml', 'BarStacked', in_spec, title, query)
+
+fields = 'sum(d:events_in) as events_in, sum(d:events_out) as events_out'
+
+title = 'FusecalEventsByParser'
+query = template % fields
+make_chart(local_storage, bin, 'xml', 'BarClustered', in_spec, title, query)
+
+template = "select to_timestamp(d:TimeStamp, 'yyyy-MM-ddThh:mm:ss.???????Z') as when, %s into __OUT__ from __IN__ where d:ProcName = 'fusecal' order by when"
+
+fields = 'd:fetch_ms, d:parse_ms, d:filter_ms, d:build_ms, d:serialize_ms'
+
+title = 'FusecalPhaseMs'
+query = template % fields
+make_chart(local_storage, bin, 'xml', 'Line', in_spec, title, query)
+
+fields = 'd:bytes_fetched'
+
+title = 'FusecalBytesFetched'
+query = template % fields
+make_chart(local_storage, bin, 'xml', 'Line', in_spec, title, query)
+
+# fusecal cache queries (counts since the last row, from ElmcityLib/cache.py)
+
+template = "select d:cache, %s into __OUT__ from __IN__ where d:ProcName = 'fusecal_cache' group by d:cache order by d:cache"
+
+fields = 'sum(d:memory_hits) as memory_hits, sum(d:disk_hits) as disk_hits, sum(d:stale_hits) as stale_hits, sum(d:misses) as misses'
+
+title = 'FusecalCacheHitsByCache'
+query = template % fields
+make_chart(local_storage, bin, 'xml', 'BarStacked', in_spec, title, query)
+
+fields = 'sum(d:memory_evictions) as memory_evictions, sum(d:disk_evictions) as disk_evictions, sum(d:refresh_errors) as refresh_errors'
+
+title = 'FusecalCacheEvictionsByCache'
+query = template % fields
+make_chart(local_storage, bin, 'xml', 'BarClustered', in_spec, title, query)
+
 # worker queries
 
 make_fname = make_worker_fname
@@ -154,9 +202,11 @@ try:
   script_url = CalendarAggregator.Configurator.dashboard_script_url
   PythonUtils.RunIronPython(local_storage, script_url, args)    
 except:
-  GenUtils.PriorityLogMsg('exception', format_traceback(), None )
+  logsink.PriorityLogMsg('exception', format_traceback(), None )
   
-GenUtils.LogMsg("info", "monitor.py stopping", None)
+logsink.LogMsg("info", "monitor.py stopping", None)
+
+logsink.Close()   # write out what is queued before the engine shuts down
 
 # pull 24 hours of diagnostics from odata feed into a file
 # run logparser queries against the file
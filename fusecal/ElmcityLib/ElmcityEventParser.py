@@ -1,23 +1,42 @@
-import sys, datetime, time, traceback
+import sys, datetime, time, traceback, threading, itertools, hashlib
 
-IPY = True
+from array import array
+
+import fetch, icswriter, filters, dateparse, cache, metrics, logsink, timezones, registry
+
+try:
+  import clr
+  IPY = True
+except ImportError:
+  IPY = False   # plain python, for local testing against the stand-in server
 
 sys.path.append("c:\\users\\jon\\aptc") # for local testing
-import clr
 
-clr.AddReference("System")
-clr.AddReference("mscorlib")
-import System
+if IPY:
+  clr.AddReference("System")
+  clr.AddReference("mscorlib")
+  import System
+
+  clr.AddReference("CalendarAggregator")
+  import CalendarAggregator
+
+  clr.AddReference("ElmcityUtils")
+  import ElmcityUtils
 
-clr.AddReference("CalendarAggregator")
-import CalendarAggregator
+  clr.AddReference("DDay.iCal")
+  import DDay.iCal
+  import DDay.iCal.Serialization 
 
-clr.AddReference("ElmcityUtils")
-import ElmcityUtils
+FETCH_BUDGET_SECONDS = 90   # for all the fetches one parse makes, inside the webrole script timeout
 
-clr.AddReference("DDay.iCal")
-import DDay.iCal
-import DDay.iCal.Serialization 
+SNAPSHOT_TTL_SECONDS = 7 * 86400   # past this a snapshot is rebuilt even if its sources haven't changed
+
+snapshots = cache.ResultCache('snapshots', capacity=64, max_age=SNAPSHOT_TTL_SECONDS)   # request -> fingerprint of its sources, and the ICS built from them
+
+def Digest(body):
+  if isinstance(body, unicode):
+    body = body.encode('utf-8')
+  return hashlib.sha1(body).hexdigest()
 
 class Event:
 
@@ -32,41 +51,253 @@ class Event:
     title = self.title.encode('utf-8')
     return "<Event: %s, %s, UTC: %s>" % (title, self.start, self.start_is_utc)
 
+# events held as parallel columns rather than one object apiece. parsers append
+# Events as before; filter, sort and dedup work on the columns and return new
+# batches, and Rows hands columns to the ICS writer without building objects.
+
+class EventBatch:
+
+  COLUMNS = ( 'title', 'start', 'start_is_utc', 'location', 'url' )
+
+  def __init__(self, events=None):
+    self.title = []
+    self.start = []
+    self.start_is_utc = array('b')
+    self.location = []
+    self.url = []
+    if events is not None:
+      self.Extend(events)
+
+  def __len__(self):
+    return len(self.title)
+
+  def __iter__(self):
+    for i in xrange(len(self.title)):
+      yield self[i]
+
+  def __getitem__(self, i):
+    evt = Event()
+    evt.title = self.title[i]
+    evt.start = self.start[i]
+    evt.start_is_utc = bool(self.start_is_utc[i])
+    evt.location = self.location[i]
+    evt.url = self.url[i]
+    return evt
+
+  def __repr__(self):
+    return "<EventBatch: %s events>" % len(self)
+
+  def append(self, evt):   # lowercase, so code written for a list of Events still works
+    self.AppendRow(evt.title, evt.start, evt.start_is_utc, evt.location, evt.url)
+
+  def AppendRow(self, title, start, start_is_utc=False, location=None, url=None):
+    self.title.append(title)
+    self.start.append(start)
+    self.start_is_utc.append(start_is_utc and 1 or 0)
+    self.location.append(location)
+    self.url.append(url)
+
+  def Extend(self, events):
+    if isinstance(events, EventBatch):
+      self.title.extend(events.title)
+      self.start.extend(events.start)
+      self.start_is_utc.extend(events.start_is_utc)
+      self.location.extend(events.location)
+      self.url.extend(events.url)
+    else:
+      for evt in events:
+        self.append(evt)
+
+  def Column(self, name):
+    if name not in self.COLUMNS:
+      raise KeyError(name)
+    return getattr(self, name)
+
+  def Rows(self, *names):
+    return itertools.izip(*[self.Column(name) for name in names])
+
+  def Take(self, indices):
+    batch = EventBatch()
+    title, start, start_is_utc, location, url = self.title, self.start, self.start_is_utc, self.location, self.url
+    batch.title = [title[i] for i in indices]
+    batch.start = [start[i] for i in indices]
+    batch.start_is_utc = array('b', [start_is_utc[i] for i in indices])
+    batch.location = [location[i] for i in indices]
+    batch.url = [url[i] for i in indices]
+    return batch
+
+  def Filter(self, predicate, *columns):
+    # predicate gets one value per column, title alone by default
+    if len(columns) <= 1:
+      values = self.Column(columns and columns[0] or 'title')
+      return self.Take([i for i, value in enumerate(values) if predicate(value)])
+    return self.Take([i for i, row in enumerate(self.Rows(*columns)) if predicate(*row)])
+
+  def Sort(self, *columns):
+    columns = columns or ( 'start', )
+    if len(columns) == 1:
+      keys = self.Column(columns[0])
+    else:
+      keys = zip(*[self.Column(name) for name in columns])
+    return self.Take(sorted(xrange(len(keys)), key=keys.__getitem__))
+
+  def Dedup(self, *columns):
+    # keeps the first row for each distinct combination, in order
+    columns = columns or ( 'title', 'start' )
+    seen = {}
+    keep = []
+    for i, key in enumerate(self.Rows(*columns)):
+      if key not in seen:
+        seen[key] = True
+        keep.append(i)
+    if len(keep) == len(self):
+      return self
+    return self.Take(keep)
+
 class EventParser:
 
+  ics_backend = 'dday'   # or 'stream', see icswriter.py
+
   def __init__(self, url=None, filter=None, tz_source=None, tz_dest=None):
         
     self.url = url
-    if ( filter is not None ):
-      self.filter = filter.lower()
-    else:
-      self.filter = filter
+    self.filter = filter   # see filters.py, matching ignores case
     self.tz_source = tz_source
     self.tz_dest = tz_dest
-    self.events = []
+    self.events = EventBatch()
     self.ics = ''
     self.dtformat = '%Y-%m-%d %H:%M'
+    self.fetcher = fetch.SharedFetcher()
+    self.budget = fetch.Budget(FETCH_BUDGET_SECONDS)
+    info = registry.Lookup(url)
+    self.conditional_get = info is None or info.conditional_get   # as registered, see registry.py
+    self.fetches = 0
+    self.sources = []
+    self.reused = False
+    self.failed = False    # part of the parse went wrong, so what it built isn't snapshotted
+    self.streams = []
+    self.sample = metrics.Sample(self.__class__.__name__)   # see metrics.py, emitted by BuildICS
+    self.started = time.time()
+    self.lock = threading.Lock()
     self.month_dict = {'January':1,'February':2,'March':3,'April':4,'May':5,'June':6, 'July':7,'August':8,'September':9,'October':10,'November':11,'December':12}
 
-  if IPY:
-    def LogMsg(self,category=None, message=None, details=None):
-      logger = ElmcityUtils.Logger()
-      logger.LogMsg(category, message, details)
-  else:
-    def LogMsg(self,category=None, message=None, details=None):
-      print '%s, %s, %s' % ( category, message, details )
+  def LogMsg(self,category=None, message=None, details=None):
+    logsink.LogMsg(category, message, details)   # queued, see logsink.py
+
+  def LogFailure(self, message, details=None):
+    # an exception the parse carries on past. the ICS still gets built from what
+    # was found, but a snapshot of it would be served as if nothing had gone wrong
+    self.failed = True
+    self.LogMsg('exception', message, details)
+
+  def Fetch(self, url):
+    return self.FetchPage(url).body
+
+  def FetchPage(self, url):
+    # the fetch.FetchResult, for parsers that want its headers too
+    result = self.sample.Timed('fetch', self.fetcher.Fetch, url, self.budget, self.conditional_get)
+    self.CountFetch()
+    if not result.from_cache:
+      self.sample.Count('bytes_fetched', len(result.body))
+    return result
+
+  def Open(self, url):
+    # only the wait for headers counts as fetch time, the body is read as it is parsed
+    stream = self.sample.Timed('fetch', self.fetcher.Open, url, self.budget, self.conditional_get)
+    self.CountFetch()
+    self.lock.acquire()
+    try:
+      self.streams.append(stream)
+    finally:
+      self.lock.release()
+    return stream
+
+  def CountFetch(self):
+    self.lock.acquire()   # parsers that fan out fetch from several threads
+    try:
+      self.fetches += 1
+    finally:
+      self.lock.release()
+    self.sample.Count('fetches')
+
+  # most sources change far less often than they are polled. a parser names the
+  # pages its events come from with Source, then asks Unchanged: if they hash
+  # the same as when the stored ICS was built, that ICS is the answer and the
+  # parse and BuildICS are skipped
+
+  def Source(self, url, body=None, digest=None):
+    if digest is None:
+      digest = Digest(body)
+    self.lock.acquire()
+    try:
+      self.sources.append(( url, digest ))
+    finally:
+      self.lock.release()
+
+  def Salt(self):
+    return ''   # parsers whose output also depends on today's date override this
+
+  def SnapshotKey(self):
+    return snapshots.Key(self.__class__.__name__, self.url, self.filter, self.tz_source, self.tz_dest, self.Salt())
+
+  def Fingerprint(self):
+    if not self.sources:
+      return None
+    sha1 = hashlib.sha1()
+    for url, digest in self.sources:
+      sha1.update(( u'%s\t%s\n' % ( url, digest ) ).encode('utf-8'))
+    return sha1.hexdigest()
+
+  def Unchanged(self):
+    fingerprint = self.Fingerprint()
+    if fingerprint is None:
+      return False
+    snapshot = snapshots.Peek(self.SnapshotKey(), SNAPSHOT_TTL_SECONDS)
+    if snapshot is None:
+      return False
+    stored, ics = snapshot.split(u'\n', 1)
+    if stored != fingerprint:
+      return False
+    self.ics = ics
+    self.reused = True
+    self.LogMsg("info", "Unchanged: reusing ICS built from the same %s sources, url: %s" % ( len(self.sources), self.url ), None)
+    return True
+
+  def Snapshot(self):
+    fingerprint = self.Fingerprint()
+    if fingerprint is not None and self.ics and not self.failed:
+      snapshots.Store(self.SnapshotKey(), fingerprint + u'\n' + self.ics)
+
+  def BuildICS(self):
+    # everything since the parser was made that wasn't fetching was parsing. a
+    # parser that fetches from several threads can spend more fetch time than
+    # that, and then its parse time is just not known
+    self.sample.Time('parse', max(time.time() - self.started - self.sample.seconds.get('fetch', 0.0), 0.0))
+    if not self.reused:
+      if IPY and self.ics_backend == 'dday':
+        self.BuildDDayICS()
+      else:
+        self.BuildStreamICS()
+      self.Snapshot()
+    self.Report()
+
+  def Report(self):
+    for stream in self.streams:
+      self.sample.Count('bytes_fetched', getattr(stream, 'bytes_fetched', 0))
+    self.sample.Count('reused', self.reused and 1 or 0)
+    metrics.Emit(self.sample)
 
   if IPY:
-    def BuildICS(self):
-      self.LogMsg("info", "ElmcityEventParser", ','.join(sys.path))
-      msg = "BuildICS: called with %s unfiltered events, url: %s, filter: |%s|, tz_source: |%s|" % ( len(self.events), self.url, self.filter, self.tz_source )
+    def BuildDDayICS(self):
+      msg = "BuildICS: called with %s unfiltered events, url: %s, filter: |%s|, tz_source: |%s|, tz_dest: |%s|" % ( len(self.events), self.url, self.filter, self.tz_source, self.tz_dest )
       self.LogMsg("info", msg, None)
       try:
         self.ApplyFilter()
+        start = time.time()
+        zone = self.ConvertEvents()
         cal = DDay.iCal.iCalendar()
-        if ( self.tz_source is not None ):
-          tzinfo = CalendarAggregator.Utils.TzinfoFromName(self.tz_source)
-          CalendarAggregator.Collector.AddTimezoneToDDayICal(cal,tzinfo)
+        if ( zone is not None ):
+          CalendarAggregator.Collector.AddTimezoneToDDayICal(cal,zone.tzinfo)
         for event in self.events:
           ical_evt = DDay.iCal.Event()
           ical_evt.Summary = event.title
@@ -76,47 +307,101 @@ class EventParser:
             ical_evt.Start = DDay.iCal.iCalDateTime(utc_dtstart);
           else:        
             ical_evt.Start = DDay.iCal.iCalDateTime(dt.year,dt.month,dt.day,dt.hour,dt.minute,dt.second)
-          ical_evt.Start.TZID = tzinfo.Id 
+          if ( zone is not None ):
+            ical_evt.Start.TZID = zone.tzid
           ical_evt.UID = CalendarAggregator.Event.MakeEventUid(ical_evt)
           cal.Events.Add(ical_evt)
+        self.sample.Time('build', time.time() - start)
         serializer = DDay.iCal.Serialization.iCalendar.iCalendarSerializer()
         self.LogMsg("info", "BuildICS: serializing %s filtered events" % len(self.events), None )
-        self.ics = serializer.SerializeToString(cal)
+        self.ics = self.sample.Timed('serialize', serializer.SerializeToString, cal)
       except:
         self.LogMsg('exception', 'BuildICS', traceback.format_exc())
 
-  else:
-    def BuildICS(self):
+  def BuildStreamICS(self):
+    msg = "BuildStreamICS: called with %s unfiltered events, url: %s, filter: |%s|, tz_source: |%s|, tz_dest: |%s|" % ( len(self.events), self.url, self.filter, self.tz_source, self.tz_dest )
+    self.LogMsg("info", msg, None)
+    try:
       self.ApplyFilter()
-      for evt in self.events:
-        print evt
-
-  def ParseDateTime(self, date_string, format):
-    if IPY:
-      import System.DateTime, System.Globalization
-      culture = System.Globalization.CultureInfo("en-US")
-      fstr = self.StrptimeFormatToDotNetFormat(format)
-      dt = System.DateTime.ParseExact(date_string,fstr,culture)
-      return datetime.datetime(dt.Year, dt.Month, dt.Day, dt.Hour, dt.Minute, dt.Second)
-    else: 
-      return datetime.datetime.strptime(date_string, format)
-
-  def StrptimeFormatToDotNetFormat(self, format):
-    format = format.replace('%a', 'ddd')
-    format = format.replace('%B', 'MMMM')
-    format = format.replace('%d', 'd')
-    format = format.replace('%I', 'h')
-    format = format.replace('%M', 'm')
-    format = format.replace('%p', 'tt')
-    return format
-    
-	  
+      self.sample.Timed('build', self.ConvertEvents)
+      self.ics = self.sample.Timed('serialize', u''.join, self.IterICS())   # the writer builds as it goes
+    except:
+      self.LogMsg('exception', 'BuildStreamICS', traceback.format_exc())
+
+  def IterICS(self):
+    tzid = None
+    vtimezone = None
+    zone = timezones.Get(self.tz_dest or self.tz_source)
+    if ( zone is not None ):
+      tzid, vtimezone = zone.tzid, zone.VTimezone()
+    return icswriter.IterICS(self.events, tzid=tzid, vtimezone=vtimezone)
+
+  # with a tz_dest that differs from tz_source, every start (utc, or wall-clock
+  # time in tz_source) becomes wall-clock time in tz_dest, in one pass over the
+  # column, and the calendar is written in tz_dest. returns the zone to write in
+
+  def ConvertEvents(self):
+    source = timezones.Get(self.tz_source)
+    dest = timezones.Get(self.tz_dest)
+    if dest is None:
+      return source
+    if source is not None and source.tzid == dest.tzid:
+      return dest
+    events = self.events
+    events.start = timezones.Convert(events.start, events.start_is_utc, source, dest)
+    events.start_is_utc = array('b', [0]) * len(events)
+    return dest
+
+  def ParseDateTime(self, date_string, format, infer_year=False):
+    return dateparse.Parse(date_string, format, infer_year)
+
   def ApplyFilter(self):
+
+    self.sample.Count('events_in', len(self.events))
+    self.sample.Timed('filter', self.FilterEvents)
+    self.sample.Count('events_out', len(self.events))
+
+  def FilterEvents(self):
     
     if self.filter is None:
-      return self.events
+      return
     
-    self.events = [x for x in self.events if x.title and x.title.lower().find(self.filter.lower()) > -1]
-
+    try:
+      matcher = filters.Compile(self.filter)
+    except filters.FilterError:
+      self.LogMsg('warning', 'ApplyFilter: treating as a plain substring', traceback.format_exc())
+      matcher = filters.Substring(self.filter)
 
+    if matcher is not None:
+      self.events = self.events.Filter(matcher, *matcher.fields)
 
+def benchmark(n=100000):
+  import metrics
+  start = datetime.datetime(2010, 1, 1, 19, 0)
+  def Make(i):
+    evt = Event()
+    evt.title = 'Story time %s, Keene Public Library' % ( i % 500 )
+    evt.start = start + datetime.timedelta(days=i % 365)
+    evt.url = 'http://www.example.com/event/%s' % ( i % 500 )
+    return evt
+  for label, events in [ ( 'batch', EventBatch() ), ( 'list', [] ) ]:   # batch first, peak memory only goes up
+    baseline = metrics.PeakMemoryBytes()
+    t = time.time()
+    for i in xrange(n):
+      events.append(Make(i))
+    built = time.time() - t
+    t = time.time()
+    if label == 'list':
+      kept = [x for x in events if x.title.lower().find('keene') > -1]
+      seen = {}
+      uniques = []
+      for x in kept:
+        if ( x.title, x.start ) not in seen:
+          seen[( x.title, x.start )] = True
+          uniques.append(x)
+      uniques.sort(key=lambda x: x.start)
+    else:
+      uniques = events.Filter(lambda title: title.lower().find('keene') > -1).Dedup('title', 'start').Sort('start')
+    print '%s: %s events, build %.2f s, filter+dedup+sort %.2f s to %s events, peak memory +%.1f MB' % ( label, n, built,
+      time.time() - t, len(uniques), ( metrics.PeakMemoryBytes() - baseline ) / 1048576.0 )
+    del events, uniques
@@ -0,0 +1,214 @@
+import sys, os, time, json, tempfile, datetime
+
+# offline benchmarks for the ElmcityLib parsers. the sites they were written
+# against are gone, so each case serves recorded pages from fixtures/ (or a
+# synthetic scale-up of them) through a stand-in server, and runs the parser
+# in a child interpreter of its own so peak memory means something. a run is
+# checked against fixtures/thresholds.json.
+#
+#   benchmarks.py            run every case, exit 1 if any breaks its thresholds
+#   benchmarks.py run NAME   run some cases
+#   benchmarks.py update     run every case and record new thresholds
+
+lib_dir = os.path.dirname(os.path.abspath(__file__))
+fixtures_dir = os.path.join(lib_dir, 'fixtures')
+thresholds_path = os.path.join(fixtures_dir, 'thresholds.json')
+
+HOSTS = [ 'www.myspace.com', 'www.librarything.com', 'www.libraryinsight.com' ]
+
+# headroom given to a fresh measurement when it becomes a threshold
+TIME_HEADROOM = 3.0
+TIME_FLOOR_SECONDS = 0.25
+MEMORY_HEADROOM = 2.0
+MEMORY_FLOOR_MB = 8.0
+
+def Fixture(name):
+  f = open(os.path.join(fixtures_dir, name), 'rb')
+  try:
+    return f.read()
+  finally:
+    f.close()
+
+# each setup adds its pages to the stand-in and returns ( parser class, url, filter, tz_source )
+
+def HelloWorld(server, scale):
+  import helloworld
+  return helloworld.HelloWorldParser, None, None, None
+
+def MySpace(server, scale):
+  import myspace
+  server.Add('/jatobamusic', Fixture('myspace_profile.html'))
+  shows = Fixture('myspace_shows.html')
+  if scale > 1:
+    start = shows.index('<div class="eventitem">')
+    end = shows.rindex('</div>\n</div>')
+    item = '<div class="eventitem">\n  <div class="event-cal">%s</div>\n  <div class="event-titleinfo"><a href="http://events.myspace.com/Event/%s">Jatoba show %s&nbsp;Venue %s, Keene, NH</a></div>\n</div>\n'
+    day = datetime.datetime(2010, 10, 1, 21, 0)
+    items = [item % ( ( day + datetime.timedelta(days=i % 300) ).strftime('%a, %B %d @ %I:%M %p'), i, i, i % 40 ) for i in range(scale)]
+    shows = shows[:start] + ''.join(items) + shows[end:]
+  server.Add('/jatobamusic/shows', shows)
+  return myspace.MySpaceParser, 'http://www.myspace.com/jatobamusic', None, 'eastern'
+
+def LibraryThing(server, scale):
+  import librarything
+  venue = Fixture('librarything_venue.html')
+  if scale > 1:
+    import cStringIO
+    f = cStringIO.StringIO()
+    librarything.WriteSyntheticFeed(f, scale, venues=25)
+    feed = f.getvalue()
+    for v in range(25):
+      server.Add('/venue/%s' % v, venue.replace('5757 S. University', '%s S. University' % v))
+  else:
+    feed = Fixture('librarything_chicago.rss')
+    for path in [ '/venue/1204/Seminary-Co-op-Bookstore', '/venue/1205/57th-Street-Books', '/venue/1311/Women-and-Children-First' ]:
+      server.Add(path, venue)
+  server.Add('/rss/events/location/chicago', feed, 'application/rss+xml')
+  return librarything.LibraryThingParser, 'http://www.librarything.com/rss/events/location/chicago', None, 'central'
+
+def LibraryInsight(server, scale):
+  import libraryinsight
+  calendar = Fixture('libraryinsight_calendar.html')
+  ids = [ '287809', '287810', '287811', '287812' ]
+  events = [Fixture('libraryinsight_%s.ics' % id) for id in ids]
+  if scale > 1:
+    links = ''.join(['<tr><td><a href="calendar.asp?jx=ea&amp;lmx=%s">Event %s</a></td></tr>\n' % ( 300000 + i, i ) for i in range(scale)])
+    calendar = calendar.replace('</table>', links + '</table>')
+    for i in range(scale):
+      id = str(300000 + i)
+      ids.append(id)
+      events.append(events[i % 4].replace('SUMMARY:', 'SUMMARY:%s ' % i).replace('UID:2878', 'UID:%s' % id))
+  server.Add('/calendar.asp?jx=ea', calendar)
+  for id, text in zip(ids, events):
+    server.Add('/tvCalSendHome.asp?po=1&jx=eap&ijSchedule=%s' % id, text, 'text/calendar')
+  return libraryinsight.LibraryInsightParser, 'http://www.libraryinsight.com/calendar.asp?jx=ea', None, 'eastern'
+
+CASES = [ ( 'helloworld', HelloWorld, 1 ),
+          ( 'myspace', MySpace, 1 ),
+          ( 'myspace_x500', MySpace, 500 ),
+          ( 'librarything', LibraryThing, 1 ),
+          ( 'librarything_x20000', LibraryThing, 20000 ),
+          ( 'libraryinsight', LibraryInsight, 1 ),
+          ( 'libraryinsight_x500', LibraryInsight, 500 ) ]
+
+# in the child: cold caches in a scratch local storage, then one warm pass
+
+def RunCase(name):
+  import standin, fetch, metrics
+  setup, scale = [ ( setup, scale ) for case, setup, scale in CASES if case == name ][0]
+  server = standin.StandIn()
+  cls, url, filter, tz_source = setup(server, scale)
+  server.Start()
+  fetch.shared = fetch.Fetcher(host_map=dict([ ( host, server.address ) for host in HOSTS ]))
+  try:
+    baseline = metrics.PeakMemoryBytes()
+    result = { 'case' : name }
+    for label in [ 'cold', 'warm' ]:
+      parser = cls(url=url, filter=filter, tz_source=tz_source)
+      start = time.time()
+      parser.Parse()
+      elapsed = time.time() - start
+      if label == 'cold':
+        result['seconds'] = elapsed
+        result['fetches'] = parser.fetches
+        result['events'] = len(parser.events)
+        result['events_per_sec'] = len(parser.events) / max(elapsed, 1e-6)
+        result['ics_bytes'] = len(parser.ics)
+      else:
+        result['warm_seconds'] = elapsed
+        result['warm_fetches'] = parser.fetches
+    result['peak_mb'] = ( metrics.PeakMemoryBytes() - baseline ) / 1048576.0
+    result['not_modified'] = server.counters['not_modified']
+    return result
+  finally:
+    fetch.shared.pool.Close()
+    server.Stop()
+
+def Child(name):
+  out = sys.stdout
+  sys.stdout = open(os.devnull, 'w')   # parsers print their events
+  import pool
+  sys.path[0:0] = pool.SearchPaths()
+  os.environ['ELMCITY_LOCAL_STORAGE'] = tempfile.mkdtemp(prefix='elmcity-bench-')
+  try:
+    result = RunCase(name)
+  except:
+    import traceback
+    result = { 'case' : name, 'error' : traceback.format_exc() }
+  out.write(json.dumps(result) + '\n')
+  out.flush()
+
+def Run(names=None):
+  import pool
+  results = []
+  for name, setup, scale in CASES:
+    if names and name not in names:
+      continue
+    worker = pool.WorkerProcess('child', script='benchmarks.py', args=[ name ])
+    try:
+      results.append(worker.Receive())
+    finally:
+      worker.Kill()
+  return results
+
+def LoadThresholds():
+  try:
+    f = open(thresholds_path, 'rb')
+    try:
+      return json.loads(f.read())
+    finally:
+      f.close()
+  except (IOError, ValueError):
+    return {}
+
+def Check(result, threshold):
+  failures = []
+  if 'error' in result:
+    return [ result['error'].strip().split('\n')[-1] ]
+  if threshold is None:
+    return failures
+  for key, limit in [ ( 'seconds', 'max_seconds' ), ( 'warm_seconds', 'max_warm_seconds' ), ( 'fetches', 'max_fetches' ), ( 'peak_mb', 'max_peak_mb' ) ]:
+    if limit in threshold and result[key] > threshold[limit]:
+      failures.append('%s %.2f > %.2f' % ( key, result[key], threshold[limit] ))
+  if 'min_events' in threshold and result['events'] < threshold['min_events']:
+    failures.append('events %s < %s' % ( result['events'], threshold['min_events'] ))
+  return failures
+
+def Threshold(result):
+  return { 'max_seconds' : round(max(result['seconds'] * TIME_HEADROOM, TIME_FLOOR_SECONDS), 2),
+           'max_warm_seconds' : round(max(result['warm_seconds'] * TIME_HEADROOM, TIME_FLOOR_SECONDS), 2),
+           'max_fetches' : result['fetches'],
+           'max_peak_mb' : round(max(result['peak_mb'] * MEMORY_HEADROOM, MEMORY_FLOOR_MB), 1),
+           'min_events' : result['events'] }
+
+def Report(results, thresholds):
+  print '%-22s %8s %8s %8s %8s %10s %8s  %s' % ( 'case', 'seconds', 'warm', 'fetches', 'events', 'events/s', 'peak MB', 'status' )
+  failed = 0
+  for result in results:
+    failures = Check(result, thresholds.get(result['case']))
+    failed += len(failures) > 0
+    status = failures and 'FAIL: ' + '; '.join(failures) or ( result['case'] in thresholds and 'ok' or 'no threshold' )
+    if 'error' in result:
+      print '%-22s %s' % ( result['case'], status )
+      continue
+    print '%-22s %8.2f %8.2f %8d %8d %10.0f %8.1f  %s' % ( result['case'], result['seconds'], result['warm_seconds'], result['fetches'],
+      result['events'], result['events_per_sec'], result['peak_mb'], status )
+  return failed
+
+if __name__ == '__main__':
+  mode = sys.argv[1:] and sys.argv[1] or 'run'
+  if mode == 'child':
+    Child(sys.argv[2])
+  elif mode == 'update':
+    results = Run(sys.argv[2:])
+    thresholds = LoadThresholds()
+    for result in results:
+      if 'error' not in result:
+        thresholds[result['case']] = Threshold(result)
+    Report(results, thresholds)
+    f = open(thresholds_path, 'wb')
+    f.write(json.dumps(thresholds, indent=2, sort_keys=True, separators=(',', ': ')) + '\n')
+    f.close()
+  else:
+    results = Run(sys.argv[2:])
+    sys.exit(Report(results, LoadThresholds()) and 1 or 0)
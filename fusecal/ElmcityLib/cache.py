@@ -0,0 +1,336 @@
+import os, time, threading, hashlib, traceback, sys
+
+import storage, metrics
+
+# two-tier cache for fusecal results: an in-memory LRU in front of files under
+# local storage. an entry younger than its ttl is served as is; one that is past
+# its ttl but still inside the stale window is served while a background thread
+# recomputes it; anything older is recomputed in the foreground. caches read with
+# Peek rather than Get keep the ttl and leave recomputing to the caller. with a
+# max_age, files that old are pruned from local storage every so often, so keys
+# that are never asked for again don't pile up there.
+
+PRUNE_INTERVAL_SECONDS = 3600
+REPORT_INTERVAL_SECONDS = 300
+
+caches = []    # every ResultCache in the process, for Report
+caches_lock = threading.Lock()
+last_reported = time.time()
+
+class LruTier:
+
+  def __init__(self, capacity):
+    self.capacity = capacity
+    self.entries = {}                    # key -> [prev, next, key, value]
+    self.head = [None, None, None, None] # sentinel, head[1] is most recently used
+    self.head[0] = self.head[1] = self.head
+    self.evictions = 0
+
+  def __len__(self):
+    return len(self.entries)
+
+  def Unlink(self, link):
+    link[0][1] = link[1]
+    link[1][0] = link[0]
+
+  def PushFront(self, link):
+    link[0] = self.head
+    link[1] = self.head[1]
+    self.head[1][0] = link
+    self.head[1] = link
+
+  def Get(self, key):
+    link = self.entries.get(key)
+    if link is None:
+      return None
+    self.Unlink(link)
+    self.PushFront(link)
+    return link[3]
+
+  def Put(self, key, value):
+    link = self.entries.get(key)
+    if link is not None:
+      link[3] = value
+      self.Unlink(link)
+      self.PushFront(link)
+      return
+    link = [None, None, key, value]
+    self.entries[key] = link
+    self.PushFront(link)
+    while len(self.entries) > self.capacity:
+      oldest = self.head[0]
+      self.Unlink(oldest)
+      del self.entries[oldest[2]]
+      self.evictions += 1
+
+  def Remove(self, key):
+    link = self.entries.pop(key, None)
+    if link is not None:
+      self.Unlink(link)
+
+class DiskTier:
+
+  def __init__(self, directory):
+    self.directory = directory
+    self.evictions = 0
+
+  def Path(self, key):
+    return os.path.join(self.directory, key)
+
+  def Get(self, key):
+    path = self.Path(key)
+    try:
+      stored = os.path.getmtime(path)
+      f = open(path, 'rb')
+      try:
+        data = f.read()
+      finally:
+        f.close()
+    except (IOError, OSError):
+      return None
+    return ( stored, data.decode('utf-8') )
+
+  def Put(self, key, stored, value):
+    path = self.Path(key)
+    storage.write_file_atomic(path, value.encode('utf-8'))
+    os.utime(path, (stored, stored))
+
+  def Remove(self, key):
+    try:
+      os.remove(self.Path(key))
+      self.evictions += 1
+    except OSError:
+      pass
+
+  def Prune(self, max_age):
+    now = time.time()
+    for name in os.listdir(self.directory):
+      path = os.path.join(self.directory, name)
+      try:
+        if now - os.path.getmtime(path) > max_age:
+          os.remove(path)
+          self.evictions += 1
+      except OSError:
+        pass
+
+class ResultCache:
+
+  def __init__(self, name, capacity=256, directory=None, max_age=None):
+    self.name = name
+    self.memory = LruTier(capacity)
+    self.disk = DiskTier(directory or storage.get_storage_dir('cache', name))
+    self.max_age = max_age
+    self.last_pruned = time.time()   # the first prune waits an interval, so starting up stays cheap
+    self.lock = threading.Lock()
+    self.refreshing = {}
+    self.counters = { 'memory_hits' : 0, 'disk_hits' : 0, 'stale_hits' : 0, 'misses' : 0, 'refreshes' : 0, 'refresh_errors' : 0 }
+    self.reported = {}
+    caches_lock.acquire()
+    try:
+      caches.append(self)
+    finally:
+      caches_lock.release()
+
+  def Key(self, *parts):
+    s = u'\t'.join([ part is not None and unicode(part) or u'' for part in parts ])
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+  def Count(self, name):
+    self.lock.acquire()
+    try:
+      self.counters[name] += 1
+    finally:
+      self.lock.release()
+
+  def Lookup(self, key):
+    self.lock.acquire()
+    try:
+      entry = self.memory.Get(key)
+    finally:
+      self.lock.release()
+    if entry is not None:
+      return entry, 'memory_hits'
+    entry = self.disk.Get(key)
+    if entry is not None:
+      self.lock.acquire()
+      try:
+        self.memory.Put(key, entry)
+      finally:
+        self.lock.release()
+      return entry, 'disk_hits'
+    return None, 'misses'
+
+  def Store(self, key, value):
+    if not value:     # an empty result means the parse failed, don't pin that
+      return
+    entry = ( time.time(), value )
+    self.lock.acquire()
+    try:
+      self.memory.Put(key, entry)
+    finally:
+      self.lock.release()
+    try:
+      self.disk.Put(key, entry[0], value)
+    except:
+      sys.stderr.write('ResultCache.Store: %s\n%s' % ( self.name, traceback.format_exc() ) )
+    self.Prune()
+
+  def Prune(self, force=False):
+    if self.max_age is None:
+      return
+    self.lock.acquire()
+    try:
+      if not force and time.time() - self.last_pruned < PRUNE_INTERVAL_SECONDS:
+        return
+      self.last_pruned = time.time()
+    finally:
+      self.lock.release()
+    try:
+      self.disk.Prune(self.max_age)
+    except:
+      sys.stderr.write('ResultCache.Prune: %s\n%s' % ( self.name, traceback.format_exc() ) )
+
+  def Forget(self, key):
+    self.lock.acquire()
+    try:
+      self.memory.Remove(key)
+    finally:
+      self.lock.release()
+    self.disk.Remove(key)
+
+  def Peek(self, key, ttl):
+    # the value if it is younger than ttl, otherwise None
+    entry, tier = self.Lookup(key)
+    if entry is not None:
+      if time.time() - entry[0] < ttl:
+        self.Count(tier)
+        return entry[1]
+      self.Forget(key)
+    self.Count('misses')
+    return None
+
+  def Get(self, key, compute, ttl, stale=0):
+    entry, tier = self.Lookup(key)
+    if entry is not None:
+      age = time.time() - entry[0]
+      if age < ttl:
+        self.Count(tier)
+        return entry[1]
+      if age < ttl + stale:
+        self.Count('stale_hits')
+        self.Revalidate(key, compute)
+        return entry[1]
+      self.Forget(key)
+    self.Count('misses')
+    value = compute()
+    self.Store(key, value)
+    return value
+
+  def Revalidate(self, key, compute):
+    self.lock.acquire()
+    try:
+      if key in self.refreshing:   # one refresh per key at a time
+        return
+      self.refreshing[key] = True
+    finally:
+      self.lock.release()
+    t = threading.Thread(target=self.Refresh, args=(key, compute))
+    t.setDaemon(True)
+    t.start()
+
+  def Refresh(self, key, compute):
+    try:
+      try:
+        self.Store(key, compute())
+        self.Count('refreshes')
+      except:
+        self.Count('refresh_errors')
+        sys.stderr.write('ResultCache.Refresh: %s\n%s' % ( self.name, traceback.format_exc() ) )
+    finally:
+      self.lock.acquire()
+      try:
+        del self.refreshing[key]
+      finally:
+        self.lock.release()
+
+  def Stats(self):
+    self.lock.acquire()
+    try:
+      stats = dict(self.counters)
+      stats['memory_entries'] = len(self.memory)
+      stats['memory_evictions'] = self.memory.evictions
+      stats['disk_evictions'] = self.disk.evictions
+    finally:
+      self.lock.release()
+    return stats
+
+  def Report(self):
+    # counts since the last report, and how full the memory tier is now
+    stats = self.Stats()
+    row = {}
+    for name, value in stats.items():
+      if name == 'memory_entries':
+        row[name] = value
+      else:
+        row[name] = value - self.reported.get(name, 0)
+    self.reported = stats
+    metrics.EmitCache(self.name, row)
+
+# each cache's counters go to the monitor table every REPORT_INTERVAL_SECONDS, from
+# whichever dispatch notices it is time, and once more when a worker or engine is done
+
+def Report(force=False):
+  global last_reported
+  caches_lock.acquire()
+  try:
+    if not force and time.time() - last_reported < REPORT_INTERVAL_SECONDS:
+      return
+    last_reported = time.time()
+    reporting = list(caches)
+  finally:
+    caches_lock.release()
+  for cache in reporting:
+    cache.Report()
+
+def test():
+  import tempfile
+  cache = ResultCache('test', capacity=2, directory=tempfile.mkdtemp())
+  calls = []
+  def compute():
+    calls.append(1)
+    return u'BEGIN:VCALENDAR\r\nEND:VCALENDAR\r\n'
+  for i in range(3):
+    cache.Get(cache.Key('http://example.com/%s' % i), compute, ttl=60)
+  cache.Get(cache.Key('http://example.com/0'), compute, ttl=60)   # evicted from memory, found on disk
+  print 'computed %s times' % len(calls), cache.Stats()
+  pruned = ResultCache('test_pruned', directory=tempfile.mkdtemp(), max_age=60)
+  old, new = pruned.Key('old'), pruned.Key('new')
+  pruned.Store(old, u'old')
+  pruned.Store(new, u'new')
+  os.utime(pruned.disk.Path(old), ( time.time() - 120, ) * 2)
+  pruned.memory.Remove(old)
+  assert pruned.Peek(old, ttl=60) is None and pruned.Peek(new, ttl=60) == u'new'
+  pruned.Store(old, u'old')
+  os.utime(pruned.disk.Path(old), ( time.time() - 120, ) * 2)
+  pruned.Prune()   # not due yet
+  assert os.path.exists(pruned.disk.Path(old))
+  pruned.last_pruned -= PRUNE_INTERVAL_SECONDS
+  pruned.Store(new, u'newer')
+  assert not os.path.exists(pruned.disk.Path(old)) and os.path.exists(pruned.disk.Path(new))
+  assert pruned.Stats()['disk_evictions'] == 2, pruned.Stats()
+  writer = metrics.MemoryWriter()
+  old_sink = metrics.SetSink(metrics.BatchingSink(writer))
+  try:
+    Report()   # not due yet
+    pruned.Get(new, compute, ttl=60)
+    Report(force=True)
+    pruned.Get(new, compute, ttl=60)
+    Report(force=True)
+    metrics.sink.Close()
+  finally:
+    metrics.SetSink(old_sink)
+  rows = [ row for row in writer.rows if row['cache'] == 'test_pruned' ]
+  assert len(rows) == 2 and rows[0]['ProcName'] == metrics.CACHE_PROC_NAME, rows
+  assert ( rows[1]['memory_hits'], rows[1]['misses'], rows[1]['disk_evictions'] ) == ( 1, 0, 0 ), rows
+  for name in ( 'memory_hits', 'misses', 'disk_evictions' ):
+    assert rows[0][name] + rows[1][name] == pruned.Stats()[name], ( name, rows )
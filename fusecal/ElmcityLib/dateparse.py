@@ -0,0 +1,240 @@
+import re, datetime, time
+
+# strptime-style parsing with each format compiled once into a regex and a list
+# of field setters. names are english, as with the en-US culture the .NET side
+# used, and matching ignores case. also the two things parsers kept redoing by
+# hand: expanding a leading Today/Tomorrow, and picking the year for a date that
+# doesn't say, which is this year unless the month has already gone by.
+
+DAYS = [ 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday' ]
+MONTHS = [ 'january', 'february', 'march', 'april', 'may', 'june', 'july', 'august', 'september', 'october', 'november', 'december' ]
+
+RELATIVE = [ ( 'today', 0 ), ( 'tomorrow', 1 ) ]
+
+EXPANSIONS = { 'c' : '%a %b %d %H:%M:%S %Y', 'x' : '%m/%d/%y', 'X' : '%H:%M:%S', 'D' : '%m/%d/%y', 'T' : '%H:%M:%S', 'R' : '%H:%M', 'h' : '%b' }
+
+def Names(names):
+  return '(' + '|'.join(sorted(names, key=len, reverse=True)) + ')'
+
+def Index(names):
+  index = {}
+  for i in range(len(names)):
+    index[names[i]] = i
+  return index
+
+full_days = Index(DAYS)
+abbr_days = Index([day[:3] for day in DAYS])
+full_months = Index(MONTHS)
+abbr_months = Index([month[:3] for month in MONTHS])
+
+# directive -> ( pattern, field, converter )
+
+DIRECTIVES = {
+  'a' : ( Names(abbr_days.keys()), 'weekday', lambda s: abbr_days[s.lower()] ),
+  'A' : ( Names(full_days.keys()), 'weekday', lambda s: full_days[s.lower()] ),
+  'b' : ( Names(abbr_months.keys()), 'month', lambda s: abbr_months[s.lower()] + 1 ),
+  'B' : ( Names(full_months.keys()), 'month', lambda s: full_months[s.lower()] + 1 ),
+  'd' : ( r'(3[01]|[12]\d|0[1-9]|[1-9]| [1-9])', 'day', int ),
+  'f' : ( r'(\d{1,6})', 'microsecond', lambda s: int(s.ljust(6, '0')) ),
+  'H' : ( r'(2[0-3]|[0-1]\d|\d)', 'hour', int ),
+  'I' : ( r'(1[0-2]|0[1-9]|[1-9])', 'hour12', int ),
+  'j' : ( r'(36[0-6]|3[0-5]\d|[12]\d\d|0[1-9]\d|00[1-9]|[1-9]\d|0[1-9]|[1-9])', 'julian', int ),
+  'm' : ( r'(1[0-2]|0[1-9]|[1-9])', 'month', int ),
+  'M' : ( r'([0-5]\d|\d)', 'minute', int ),
+  'p' : ( r'(am|pm)', 'pm', lambda s: s.lower() == 'pm' ),
+  'S' : ( r'(6[0-1]|[0-5]\d|\d)', 'second', int ),
+  'U' : ( r'(5[0-3]|[0-4]\d|\d)', 'week_sunday', int ),
+  'w' : ( r'([0-6])', 'weekday', lambda s: ( int(s) - 1 ) % 7 ),
+  'W' : ( r'(5[0-3]|[0-4]\d|\d)', 'week_monday', int ),
+  'y' : ( r'(\d\d)', 'year', lambda s: int(s) + ( int(s) < 69 and 2000 or 1900 ) ),
+  'Y' : ( r'(\d\d\d\d)', 'year', int ),
+  'z' : ( r'(Z|[+-]\d\d:?[0-5]\d)', 'offset', lambda s: Offset(s) ),
+  'Z' : ( r'([a-z]{1,5})', None, None ),
+  'n' : ( r'\s+', None, None ),
+  't' : ( r'\s+', None, None ),
+}
+
+class DateParseError(ValueError):
+  pass
+
+class FixedOffset(datetime.tzinfo):
+
+  def __init__(self, minutes):
+    self.minutes = minutes
+
+  def utcoffset(self, dt):
+    return datetime.timedelta(minutes=self.minutes)
+
+  def dst(self, dt):
+    return datetime.timedelta(0)
+
+  def tzname(self, dt):
+    return '%+03d%02d' % ( self.minutes // 60, self.minutes % 60 )
+
+def Offset(s):
+  if s.upper() == 'Z':
+    return 0
+  minutes = int(s[1:3]) * 60 + int(s[-2:])
+  if s[0] == '-':
+    return -minutes
+  return minutes
+
+class Format:
+
+  def __init__(self, format):
+    self.format = format
+    self.fields = []
+    self.converters = []
+    parts = []
+    i = 0
+    format = self.Expand(format)
+    while i < len(format):
+      ch = format[i]
+      if ch == '%' and i + 1 < len(format):
+        directive = format[i+1]
+        i += 2
+        if directive == '%':
+          parts.append('%')
+          continue
+        if directive not in DIRECTIVES:
+          raise DateParseError("unsupported directive %%%s in format: %s" % ( directive, self.format ))
+        pattern, field, converter = DIRECTIVES[directive]
+        if field is None:
+          parts.append(pattern.replace('(', '(?:'))
+        else:
+          parts.append(pattern)
+          self.fields.append(field)
+          self.converters.append(converter)
+        continue
+      if ch.isspace():
+        while i < len(format) and format[i].isspace():
+          i += 1
+        parts.append(r'\s+')
+        continue
+      parts.append(re.escape(ch))
+      i += 1
+    self.pattern = re.compile(''.join(parts) + r'\Z', re.IGNORECASE)
+    self.has_year = 'year' in self.fields
+    self.has_date = 'month' in self.fields or 'day' in self.fields
+
+  def Expand(self, format):
+    for directive, expansion in EXPANSIONS.items():
+      format = format.replace('%' + directive, expansion)
+    return format
+
+  def Parse(self, text, infer_year=False, now=None):
+    m = self.pattern.match(text)
+    if m is None:
+      raise DateParseError("time data %r does not match format %r" % ( text, self.format ))
+
+    values = dict(zip(self.fields, map(Apply, self.converters, m.groups())))
+
+    year = values.get('year')
+    month = values.get('month', 1)
+    day = values.get('day', 1)
+    if year is None:
+      if infer_year:
+        now = now or datetime.datetime.now()
+        year = now.year
+        if self.has_date and month < now.month:
+          year += 1
+      else:
+        year = 1900
+
+    hour = values.get('hour', 0)
+    if 'hour12' in values:
+      hour = values['hour12'] % 12
+      if values.get('pm'):
+        hour += 12
+
+    julian = values.get('julian')
+    weekday = values.get('weekday')
+    if julian is None and weekday is not None and not self.has_date:
+      if 'week_sunday' in values:
+        julian = WeekToJulian(year, values['week_sunday'], weekday, False)
+      elif 'week_monday' in values:
+        julian = WeekToJulian(year, values['week_monday'], weekday, True)
+
+    if julian is not None and not self.has_date:
+      date = datetime.date(year, 1, 1) + datetime.timedelta(days=julian - 1)
+      year, month, day = date.year, date.month, date.day
+
+    tzinfo = None
+    if 'offset' in values:
+      tzinfo = FixedOffset(values['offset'])
+
+    try:
+      return datetime.datetime(year, month, day, hour, values.get('minute', 0), values.get('second', 0),
+        values.get('microsecond', 0), tzinfo)
+    except ValueError, e:
+      raise DateParseError("%s in %r" % ( e, text ))
+
+def Apply(converter, value):
+  return converter(value)
+
+def WeekToJulian(year, week, weekday, week_starts_monday):
+  first = datetime.date(year, 1, 1).weekday()
+  if not week_starts_monday:
+    first = ( first + 1 ) % 7
+    weekday = ( weekday + 1 ) % 7
+  if week == 0:
+    return 1 + weekday - first
+  return 1 + ( 7 - first ) % 7 + 7 * ( week - 1 ) + weekday
+
+formats = {}   # format string -> Format, formats come from code so this stays small
+
+def Compile(format):
+  compiled = formats.get(format)
+  if compiled is None:
+    compiled = formats[format] = Format(format)
+  return compiled
+
+def Parse(text, format, infer_year=False, now=None):
+  return Compile(format).Parse(text.strip(), infer_year, now)
+
+def ExpandRelative(text, date_format, now=None):
+  # "Today 10:00 PM" -> "Thu, July 08 10:00 PM" for date_format '%a, %B %d'
+  lowered = text.lstrip().lower()
+  for word, days in RELATIVE:
+    if lowered.startswith(word):
+      date = ( now or datetime.datetime.now() ) + datetime.timedelta(days)
+      return date.strftime(date_format) + text.lstrip()[len(word):]
+  return text
+
+def test():
+  now = datetime.datetime(2010, 7, 8, 12, 0)
+  cases = [ ( 'Thu, July 08 @ 10:00 PM', '%a, %B %d @ %I:%M %p', False, datetime.datetime(1900, 7, 8, 22, 0) ),
+            ( 'Saturday, December 1 (7:00 pm)', '%A, %B %d (%I:%M %p)', True, datetime.datetime(2010, 12, 1, 19, 0) ),
+            ( 'Monday, March 1 (12:05 am)', '%A, %B %d (%I:%M %p)', True, datetime.datetime(2011, 3, 1, 0, 5) ),
+            ( '2010-07-08 22:00', '%Y-%m-%d %H:%M', False, datetime.datetime(2010, 7, 8, 22, 0) ),
+            ( '08/07/10  9:05:03.25', '%d/%m/%y %H:%M:%S.%f', False, datetime.datetime(2010, 7, 8, 9, 5, 3, 250000) ),
+            ( '2010 189', '%Y %j', False, datetime.datetime(2010, 7, 8) ),
+            ( '2010 27 4', '%Y %W %w', False, datetime.datetime(2010, 7, 8) ),
+            ( 'Thu Jul  8 22:00:00 2010', '%c', False, datetime.datetime(2010, 7, 8, 22, 0) ) ]
+  for text, format, infer_year, expected in cases:
+    got = Parse(text, format, infer_year, now)
+    assert got == expected, ( text, got, expected )
+    if not infer_year:
+      assert got == datetime.datetime.strptime(text.strip(), format), text
+  assert ExpandRelative('Tomorrow @ 10:00 PM', '%a, %B %d', now) == 'Fri, July 09 @ 10:00 PM'
+  assert ExpandRelative('Thu, July 08', '%a, %B %d', now) == 'Thu, July 08'
+  assert Parse('2010-07-08T22:00:00-05:00', '%Y-%m-%dT%H:%M:%S%z').utcoffset() == datetime.timedelta(hours=-5)
+  for text, format in [ ( 'July 32', '%B %d' ), ( 'July 8 extra', '%B %d' ), ( 'Feb 30', '%b %d' ) ]:
+    try:
+      Parse(text, format)
+      assert False, text
+    except DateParseError:
+      pass
+  print 'dateparse: %s cases ok' % len(cases)
+
+def benchmark(n=100000):
+  format = '%a, %B %d @ %I:%M %p'
+  base = datetime.datetime(2010, 1, 1, 9, 0)
+  texts = [( base + datetime.timedelta(hours=7 * i) ).strftime(format) for i in xrange(1000)] * ( n // 1000 )
+  Compile(format)
+  for label, parse in [ ( 'dateparse', lambda text: Parse(text, format) ), ( 'strptime', lambda text: datetime.datetime.strptime(text, format) ) ]:
+    start = time.time()
+    for text in texts:
+      parse(text)
+    elapsed = time.time() - start
+    print '%s: %s strings in %.2f s, %.0f/sec' % ( label, len(texts), elapsed, len(texts) / elapsed )
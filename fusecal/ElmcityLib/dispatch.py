@@ -0,0 +1,92 @@
+import traceback
+
+import registry, cache, threadpool
+
+results = cache.ResultCache('fusecal', max_age=max([ info.ttl_seconds + info.stale_seconds for info in registry.parsers ]))   # past that nothing serves them
+
+BATCH_WORKERS = 8
+
+def Dispatch(url=None,filter=None,tz_source=None,tz_dest=None):
+
+  if not filter:
+    filter = None
+
+  if not tz_source:
+    tz_source = None
+
+  if not tz_dest:
+    tz_dest = None
+
+  info = registry.Lookup(url)
+
+  if info is None:
+    return ""
+
+  def Build():
+    parser = info.Load()(url=url, filter=filter, tz_source=tz_source, tz_dest=tz_dest)
+    parser.Parse()
+    return parser.ics
+
+  key = results.Key(url, filter, tz_source, tz_dest)
+  ics = results.Get(key, Build, ttl=info.ttl_seconds, stale=info.stale_seconds)
+  cache.Report()
+  return ics
+
+# a hub's fusecal feeds in one call: each request is a (url, filter, tz_source, tz_dest)
+# tuple, shorter ones are padded with None. distinct requests run in this process,
+# over its shared connection pool and already-loaded parsers, and each gets back
+# { 'url' : url, 'ics' : ics } or { 'url' : url, 'error' : message }.
+#
+# requests are queued by parser. a parser's queue runs one request at a time, since
+# one request already fans out up to the parser's max_concurrency fetches against
+# its site. the queues of parsers registered with batch run alongside each other;
+# the rest run afterwards, one request at a time, with nothing else running.
+
+def DispatchBatch(requests, max_workers=BATCH_WORKERS):
+
+  requests = [ tuple(( list(request) + [None] * 4 )[:4]) for request in requests ]
+
+  done = {}
+  seen = {}
+  lanes = {}    # ParserInfo -> its distinct requests, in order
+  infos = []
+  for request in requests:
+    if request in seen:
+      continue
+    seen[request] = True
+    info = registry.Lookup(request[0])
+    if info is None:
+      done[request] = { 'url' : request[0], 'error' : 'LookupError: no parser for %s' % request[0] }
+      continue
+    if info not in lanes:
+      lanes[info] = []
+      infos.append(info)
+    lanes[info].append(request)
+
+  def Run(request):
+    ics = Dispatch(*request)
+    if not ics:    # the parser logged why
+      raise ValueError('no calendar built for %s' % request[0])
+    return ics
+
+  def RunLane(lane):
+    return zip(lane, threadpool.Map(Run, lane, 1))
+
+  batched = [ lanes[info] for info in infos if info.batch ]
+  finished = [ outcome.value for outcome in threadpool.Map(RunLane, batched, max_workers) ]
+  finished += [ RunLane(lanes[info]) for info in infos if not info.batch ]
+
+  for lane in finished:
+    for request, outcome in lane:
+      if outcome.error is not None:
+        done[request] = { 'url' : request[0], 'error' : outcome.error.strip().split('\n')[-1] }
+      else:
+        done[request] = { 'url' : request[0], 'ics' : outcome.value }
+
+  return [ done[request] for request in requests ]
+
+# import every registered parser once, so a long-lived process (see pool.py) pays
+# the cost of loading BeautifulSoup and the .NET assemblies up front
+
+def Warm():
+  return registry.LoadAll()
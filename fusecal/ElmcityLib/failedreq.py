@@ -0,0 +1,234 @@
+import os, json
+
+try:
+  import clr
+  clr.AddReference("System.Xml")
+  import System.Xml
+  IPY = True
+except ImportError:
+  from xml.etree import cElementTree as ElementTree
+  IPY = False
+
+if IPY:
+  PARSE_ERRORS = ( System.Xml.XmlException, EnvironmentError )
+else:
+  PARSE_ERRORS = ( SyntaxError, EnvironmentError )   # ElementTree's ParseError is a SyntaxError
+
+import logpool
+
+# the failed-request tables charts.py used to get from six LogParser XPath queries
+# over FailedReqLogFiles, from one streaming read of each trace. a trace is one
+# failedRequest, whose url and statusCode attributes are what the tables group
+# by, counted once for each RequestURL item in its events, which is what the
+# queries counted. traces don't change once IIS has written them, so a TraceCache
+# keeps each one's result in local storage under its path, mtime and size, and a
+# run reads only traces it hasn't seen. new ones are read side by side through
+# logpool, like the W3C logs.
+#
+#   cache = TraceCache(CachePath())
+#   for title, headers, rows in cache.Update(glob.glob(trace_dir + '/*.xml')).Tables(): ...
+
+TOP = 10
+
+TABLES = [ ( 'FailedRequestsByCount', ( 'count', 'url' ) ),
+           ( 'FailedRequestsByStatus', ( 'statusCode', 'count' ) ),
+           ( 'FailedRequestTop400s', ( 'count', 'url' ) ),
+           ( 'FailedRequestTop404s', ( 'count', 'url' ) ),
+           ( 'FailedRequestTop200s', ( 'count', 'url' ) ),
+           ( 'FailedRequestTopOthers', ( 'count', 'statusCode', 'url' ) ) ]
+
+def LocalName(tag):
+  return tag.rsplit('}', 1)[-1]   # the events are in a namespace, the xpath ignored it
+
+def ReadTrace(path):
+  # ( url, statusCode, RequestURL items ); a trace that doesn't parse, say one
+  # still being written, counts for nothing, and is read again once it changes
+  try:
+    if IPY:
+      return ReadTraceXmlReader(path)
+    return ReadTraceIterparse(path)
+  except PARSE_ERRORS:
+    return None, None, 0
+
+def ReadTraceIterparse(path):
+  url = status = None
+  count = 0
+  for event, elem in ElementTree.iterparse(path, events=( 'start', 'end' )):
+    if event == 'end':
+      elem.clear()
+      continue
+    name = LocalName(elem.tag)
+    if name == 'failedRequest':
+      url = elem.get('url')
+      status = elem.get('statusCode')
+    elif name == 'Data' and elem.get('Name') == 'RequestURL':
+      count += 1
+  return url, status, count
+
+def ReadTraceXmlReader(path):
+  settings = System.Xml.XmlReaderSettings()
+  settings.DtdProcessing = System.Xml.DtdProcessing.Ignore
+  reader = System.Xml.XmlReader.Create(path, settings)
+  url = status = None
+  count = 0
+  try:
+    while reader.Read():
+      if reader.NodeType != System.Xml.XmlNodeType.Element:
+        continue
+      if reader.LocalName == 'failedRequest':
+        url = reader.GetAttribute('url')
+        status = reader.GetAttribute('statusCode')
+      elif reader.LocalName == 'Data' and reader.GetAttribute('Name') == 'RequestURL':
+        count += 1
+  finally:
+    reader.Close()
+  return url, status, count
+
+def ReadRequest(request):
+  # a logpool job
+  url, status, count = ReadTrace(request['path'])
+  return { 'url' : url, 'status' : status, 'count' : count }
+
+def MakeRequest(path):
+  return { 'kind' : 'failedreq', 'path' : path }
+
+class Summary:
+
+  def __init__(self, top=TOP):
+    self.top = top
+    self.counts = {}    # ( statusCode, url ) -> count
+
+  def Add(self, url, status, count):
+    if count:
+      key = ( status, url )
+      self.counts[key] = self.counts.get(key, 0) + count
+
+  def Group(self, key, where=None):
+    groups = {}
+    for status_url, count in self.counts.iteritems():
+      if where is None or where(status_url[0]):
+        group = key(status_url)
+        groups[group] = groups.get(group, 0) + count
+    return sorted(groups.items(), key=lambda item: ( -item[1], item[0] ))
+
+  def Rows(self, title):
+    url = lambda key: key[1]
+    if title == 'FailedRequestsByCount':
+      return [ ( count, u ) for u, count in self.Group(url) ]
+    if title == 'FailedRequestsByStatus':
+      return self.Group(lambda key: key[0])
+    for status in ( '400', '404', '200' ):
+      if title == 'FailedRequestTop%ss' % status:
+        return [ ( count, u ) for u, count in self.Group(url, lambda s: s == status)[:self.top] ]
+    if title == 'FailedRequestTopOthers':
+      others = self.Group(lambda key: key, lambda s: s not in ( '200', '400', '404' ))[:self.top]
+      return [ ( count, status, u ) for ( status, u ), count in others ]
+    raise KeyError(title)
+
+  def Tables(self):
+    return [ ( title, headers, self.Rows(title) ) for title, headers in TABLES ]
+
+def CachePath():
+  import storage
+  return os.path.join(storage.get_storage_dir('failedreq'), 'traces.json')
+
+class TraceCache:
+
+  def __init__(self, path, top=TOP):
+    self.path = path
+    self.top = top
+    self.files = {}    # trace path -> [ mtime, size, url, statusCode, count ]
+    self.read = 0      # traces read by the last Update
+    try:
+      f = open(path, 'rb')
+      try:
+        self.files = json.loads(f.read())
+      finally:
+        f.close()
+    except ( IOError, ValueError ):
+      pass
+
+  def Save(self):
+    import storage
+    storage.write_file_atomic(self.path, json.dumps(self.files))
+
+  def Update(self, paths, workers=1):
+    files = {}
+    changed = []
+    for path in sorted(paths):
+      try:
+        st = os.stat(path)
+      except OSError:
+        continue
+      cached = self.files.get(path)
+      if cached is not None and cached[0] == st.st_mtime and cached[1] == st.st_size:
+        files[path] = cached
+      else:
+        files[path] = [ st.st_mtime, st.st_size, None, None, 0 ]
+        changed.append(path)
+    for path, response in zip(changed, logpool.Map([ MakeRequest(path) for path in changed ], workers)):
+      files[path][2:] = [ response['url'], response['status'], response['count'] ]
+    self.read = len(changed)
+    self.files = files
+    summary = Summary(self.top)
+    for path in sorted(files):
+      mtime, size, url, status, count = files[path]
+      summary.Add(url, status, count)
+    return summary
+
+def test():
+  import tempfile, shutil, time
+  trace = """<?xml version="1.0" encoding="UTF-8"?>
+<?xml-stylesheet type="text/xsl" href="freb.xsl"?>
+<failedRequest url="%s" siteId="1" appPoolId="elmcity" processId="1" verb="GET" statusCode="%s" triggerStatusCode="%s" timeTaken="15" xmlns:freb="http://schemas.microsoft.com/win/2006/06/iis/freb">
+ <Event xmlns="http://schemas.microsoft.com/win/2004/08/events/event">
+  <System><Provider Name="WWW Server"/><EventID>0</EventID></System>
+  <EventData>
+   <Data Name="ContextId">{00000000-0000-0000-0000-000000000000}</Data>
+   <Data Name="RequestURL">%s</Data>
+  </EventData>
+ </Event>
+ <Event xmlns="http://schemas.microsoft.com/win/2004/08/events/event">
+  <EventData><Data Name="ErrorCode">2</Data></EventData>
+ </Event>
+</failedRequest>
+"""
+  directory = tempfile.mkdtemp(prefix='failedreq-')
+  try:
+    def Write(name, url, status):
+      path = os.path.join(directory, name)
+      f = open(path, 'wb')
+      f.write(trace % ( url, status, status, url ))
+      f.close()
+      return path
+    cases = [ ( '/services/a/html', '404' ), ( '/services/a/html', '404' ), ( '/bad?x', '400' ), ( '/slow', '200' ),
+              ( '/boom', '500' ), ( '/boom', '500' ), ( '/boom', '503' ), ( '/services/a/html', '500' ) ]
+    paths = [ Write('fr%06d.xml' % i, url, status) for i, ( url, status ) in enumerate(cases) ]
+    broken = os.path.join(directory, 'fr999999.xml')
+    f = open(broken, 'wb')
+    f.write('<failedRequest url="/half" statusCode="500"><Event>')
+    f.close()
+    cache_path = os.path.join(directory, 'traces.json')
+    cache = TraceCache(cache_path)
+    tables = dict([ ( title, rows ) for title, headers, rows in cache.Update(paths + [ broken ]).Tables() ])
+    cache.Save()
+    assert cache.read == 9
+    assert tables['FailedRequestsByCount'] == [ ( 3, '/boom' ), ( 3, '/services/a/html' ), ( 1, '/bad?x' ), ( 1, '/slow' ) ]
+    assert tables['FailedRequestsByStatus'] == [ ( '500', 3 ), ( '404', 2 ), ( '200', 1 ), ( '400', 1 ), ( '503', 1 ) ]
+    assert tables['FailedRequestTop404s'] == [ ( 2, '/services/a/html' ) ] and tables['FailedRequestTop400s'] == [ ( 1, '/bad?x' ) ]
+    assert tables['FailedRequestTop200s'] == [ ( 1, '/slow' ) ]
+    assert tables['FailedRequestTopOthers'] == [ ( 2, '500', '/boom' ), ( 1, '500', '/services/a/html' ), ( 1, '503', '/boom' ) ]
+    cache = TraceCache(cache_path)
+    again = cache.Update(paths + [ broken ])
+    assert cache.read == 0 and dict([ ( title, rows ) for title, headers, rows in again.Tables() ]) == tables
+    os.remove(paths[0])
+    Write('fr000002.xml', '/bad?x', '404')
+    os.utime(paths[2], ( time.time() + 5, ) * 2)   # same size, new mtime
+    cache = TraceCache(cache_path)
+    summary = cache.Update(paths[1:] + [ broken ])
+    assert cache.read == 1 and summary.Rows('FailedRequestTop404s') == [ ( 1, '/bad?x' ), ( 1, '/services/a/html' ) ]
+    spread = TraceCache(os.path.join(directory, 'spread.json')).Update(paths[1:] + [ broken ], workers=3)
+    assert spread.Tables() == summary.Tables()
+  finally:
+    shutil.rmtree(directory)
+  print 'failedreq: ok'
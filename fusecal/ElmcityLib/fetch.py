@@ -0,0 +1,533 @@
+import sys, os, time, socket, traceback, threading, httplib, urlparse, hashlib, json
+
+import storage, cache
+
+try:
+  import zlib
+except ImportError:
+  zlib = None   # not in IronPython 2.6, use System.IO.Compression instead
+
+# the http layer under EventParser.Fetch. connections are kept alive and pooled
+# per host, responses that carried an ETag or Last-Modified are remembered so the
+# next fetch can be conditional (a 304 is answered from the stored body), gzip and
+# deflate bodies are decoded, and every fetch made on behalf of one Dispatch draws
+# on a single time budget.
+
+USER_AGENT = 'elmcity fusecal'
+MAX_REDIRECTS = 5
+MAX_IDLE_PER_HOST = 4
+REQUEST_TIMEOUT_SECONDS = 30
+VALIDATOR_MEMORY_CAPACITY = 256   # stored bodies held in memory, the rest are read back from disk
+VALIDATOR_MAX_AGE_SECONDS = 14 * 86400   # stored responses not fetched for this long are pruned
+
+class FetchError(Exception):
+
+  def __init__(self, url, status, reason=''):
+    Exception.__init__(self, '%s: %s %s' % ( url, status, reason ))
+    self.url = url
+    self.status = status
+
+class FetchTimeout(FetchError):
+
+  def __init__(self, url):
+    FetchError.__init__(self, url, 'timeout', 'fetch budget exhausted')
+
+class Budget:
+
+  def __init__(self, seconds):
+    self.seconds = seconds
+    self.deadline = time.time() + seconds
+
+  def Remaining(self, url=None):
+    remaining = self.deadline - time.time()
+    if remaining <= 0:
+      raise FetchTimeout(url)
+    return remaining
+
+class FetchResult:
+
+  def __init__(self, url, status, body, headers, from_cache=False):
+    self.url = url
+    self.status = status
+    self.body = body
+    self.headers = headers
+    self.from_cache = from_cache
+
+  def __repr__(self):
+    return "<FetchResult: %s, %s, %s bytes, from_cache: %s>" % (self.url, self.status, len(self.body), self.from_cache)
+
+def Decompress(data, encoding):
+  if zlib is not None:
+    if encoding == 'gzip':
+      return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    try:
+      return zlib.decompress(data)
+    except zlib.error:                        # some servers send raw deflate
+      return zlib.decompress(data, -zlib.MAX_WBITS)
+  import System
+  from System.IO import MemoryStream
+  from System.IO.Compression import GZipStream, DeflateStream, CompressionMode
+  latin1 = System.Text.Encoding.GetEncoding(28591)
+  compressed = MemoryStream(latin1.GetBytes(data))
+  if encoding == 'gzip':
+    stream = GZipStream(compressed, CompressionMode.Decompress)
+  else:
+    stream = DeflateStream(compressed, CompressionMode.Decompress)
+  out = MemoryStream()
+  buffer = System.Array.CreateInstance(System.Byte, 65536)
+  while True:
+    n = stream.Read(buffer, 0, buffer.Length)
+    if n == 0:
+      break
+    out.Write(buffer, 0, n)
+  return latin1.GetString(out.ToArray())
+
+class ValidatorStore:
+
+  def __init__(self, directory, max_age=VALIDATOR_MAX_AGE_SECONDS):
+    self.directory = directory
+    self.lock = threading.Lock()
+    self.memory = cache.LruTier(VALIDATOR_MEMORY_CAPACITY)
+    self.disk = cache.DiskTier(directory)
+    self.max_age = max_age
+    self.last_pruned = time.time()
+
+  def Key(self, url):
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+  def Paths(self, url):
+    key = self.Key(url)
+    return os.path.join(self.directory, key + '.json'), os.path.join(self.directory, key + '.body')
+
+  def Get(self, url):
+    key = self.Key(url)
+    self.lock.acquire()
+    try:
+      entry = self.memory.Get(key)
+      if entry is not None:
+        return entry
+    finally:
+      self.lock.release()
+    try:
+      f = open(os.path.join(self.directory, key + '.json'), 'rb')
+      try:
+        meta = json.loads(f.read())
+      finally:
+        f.close()
+      f = open(os.path.join(self.directory, key + '.body'), 'rb')
+      try:
+        body = f.read()
+      finally:
+        f.close()
+    except (IOError, OSError, ValueError):
+      return None
+    entry = ( meta.get('etag'), meta.get('last_modified'), body )
+    self.lock.acquire()
+    try:
+      self.memory.Put(key, entry)
+    finally:
+      self.lock.release()
+    return entry
+
+  def Put(self, url, etag, last_modified, body):
+    key = self.Key(url)
+    storage.write_file_atomic(os.path.join(self.directory, key + '.body'), body)
+    meta = { 'url' : url, 'etag' : etag, 'last_modified' : last_modified }
+    storage.write_file_atomic(os.path.join(self.directory, key + '.json'), json.dumps(meta))
+    self.lock.acquire()
+    try:
+      self.memory.Put(key, ( etag, last_modified, body ))
+    finally:
+      self.lock.release()
+    self.Prune()
+
+  def Touch(self, url):
+    # a 304 keeps a stored response in use, so it isn't pruned
+    now = time.time()
+    for path in self.Paths(url):
+      try:
+        os.utime(path, ( now, now ))
+      except OSError:
+        pass
+
+  def Prune(self, force=False):
+    # every PRUNE_INTERVAL_SECONDS, like a ResultCache with a max_age
+    self.lock.acquire()
+    try:
+      if not force and time.time() - self.last_pruned < cache.PRUNE_INTERVAL_SECONDS:
+        return
+      self.last_pruned = time.time()
+    finally:
+      self.lock.release()
+    try:
+      self.disk.Prune(self.max_age)
+    except:
+      sys.stderr.write('ValidatorStore.Prune: %s\n%s' % ( self.directory, traceback.format_exc() ) )
+
+  # streamed bodies stay on disk, only their metadata is read back
+
+  def GetMeta(self, url):
+    meta_path, body_path = self.Paths(url)
+    try:
+      f = open(meta_path, 'rb')
+      try:
+        meta = json.loads(f.read())
+      finally:
+        f.close()
+    except (IOError, OSError, ValueError):
+      return None
+    if not meta.get('digest') or not os.path.exists(body_path):
+      return None
+    return meta
+
+  def PutStreamed(self, url, etag, last_modified, digest, spooled):
+    meta_path, body_path = self.Paths(url)
+    self.lock.acquire()
+    try:
+      self.memory.Remove(self.Key(url))
+    finally:
+      self.lock.release()
+    storage.replace_file(spooled, body_path)
+    meta = { 'url' : url, 'etag' : etag, 'last_modified' : last_modified, 'digest' : digest }
+    storage.write_file_atomic(meta_path, json.dumps(meta))
+    self.Prune()
+
+class ConnectionPool:
+
+  def __init__(self, max_idle_per_host=MAX_IDLE_PER_HOST):
+    self.max_idle_per_host = max_idle_per_host
+    self.idle = {}
+    self.lock = threading.Lock()
+
+  def Get(self, scheme, host, port, timeout, fresh=False):
+    conn = None
+    self.lock.acquire()
+    try:
+      conns = self.idle.get((scheme, host, port))
+      if conns and not fresh:
+        conn = conns.pop()
+    finally:
+      self.lock.release()
+    if conn is not None:
+      conn.sock.settimeout(timeout)
+      return conn, True
+    if scheme == 'https':
+      conn = httplib.HTTPSConnection(host, port, timeout=timeout)
+    else:
+      conn = httplib.HTTPConnection(host, port, timeout=timeout)
+    return conn, False
+
+  def Release(self, scheme, host, port, conn):
+    self.lock.acquire()
+    try:
+      conns = self.idle.setdefault((scheme, host, port), [])
+      if len(conns) < self.max_idle_per_host:
+        conns.append(conn)
+        return
+    finally:
+      self.lock.release()
+    conn.close()
+
+  def Close(self):
+    self.lock.acquire()
+    try:
+      for conns in self.idle.values():
+        for conn in conns:
+          conn.close()
+      self.idle = {}
+    finally:
+      self.lock.release()
+
+class Fetcher:
+
+  def __init__(self, directory=None, host_map=None):
+    self.validators = ValidatorStore(directory or storage.get_storage_dir('fetch'))
+    self.pool = ConnectionPool()
+    self.host_map = host_map or {}   # host -> (host, port), to point a parser at a stand-in server
+    self.lock = threading.Lock()
+    self.counters = { 'requests' : 0, 'connections_opened' : 0, 'connections_reused' : 0, 'not_modified' : 0, 'bytes_fetched' : 0 }
+
+  def Count(self, name, n=1):
+    self.lock.acquire()
+    try:
+      self.counters[name] += n
+    finally:
+      self.lock.release()
+
+  def Fetch(self, url, budget=None, conditional=True):
+    for i in range(MAX_REDIRECTS + 1):
+      result = self.FetchOnce(url, budget, conditional)
+      location = result.headers.get('location')
+      if result.status in (301, 302, 303, 307) and location:
+        url = urlparse.urljoin(url, location)
+        continue
+      if result.status >= 400:
+        raise FetchError(url, result.status)
+      return result
+    raise FetchError(url, result.status, 'too many redirects')
+
+  def FetchOnce(self, url, budget=None, conditional=True):
+    headers = { 'Accept-Encoding' : 'gzip, deflate' }
+    validators = conditional and self.validators.Get(url) or None
+    if validators is not None:
+      etag, last_modified, stored_body = validators
+      if etag:
+        headers['If-None-Match'] = etag
+      if last_modified:
+        headers['If-Modified-Since'] = last_modified
+
+    key, conn, response = self.Request(url, headers, budget)
+    try:
+      body = response.read()
+    except socket.timeout:
+      conn.close()
+      raise FetchTimeout(url)
+    self.Finish(key, conn, response)
+
+    self.Count('requests')
+    self.Count('bytes_fetched', len(body))
+    response_headers = dict(response.getheaders())
+
+    if response.status == 304 and validators is not None:
+      self.Count('not_modified')
+      self.validators.Touch(url)
+      return FetchResult(url, 200, stored_body, response_headers, from_cache=True)
+
+    encoding = response_headers.get('content-encoding', '').lower()
+    if encoding in ('gzip', 'deflate'):
+      body = Decompress(body, encoding)
+
+    etag = response_headers.get('etag')
+    last_modified = response_headers.get('last-modified')
+    if response.status == 200 and conditional and ( etag or last_modified ):
+      self.validators.Put(url, etag, last_modified, body)
+
+    return FetchResult(url, response.status, body, response_headers)
+
+  # for bodies too big to hold: a file-like object that decodes as it reads and
+  # hands the connection back to the pool once the body has been consumed
+
+  def Open(self, url, budget=None, conditional=False):
+    meta = conditional and self.validators.GetMeta(url) or None
+    for i in range(MAX_REDIRECTS + 1):
+      headers = {}
+      if zlib is not None:
+        headers['Accept-Encoding'] = 'gzip, deflate'
+      if meta is not None:
+        if meta.get('etag'):
+          headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+          headers['If-Modified-Since'] = meta['last_modified']
+      key, conn, response = self.Request(url, headers, budget)
+      location = response.getheader('location')
+      if ( response.status in (301, 302, 303, 307) and location ) or response.status >= 400 or ( response.status == 304 and meta is not None ):
+        response.read()
+        self.Finish(key, conn, response)
+        if response.status == 304:
+          self.Count('requests')
+          self.Count('not_modified')
+          self.validators.Touch(url)
+          return StoredResponse(url, self.validators.Paths(url)[1], meta['digest'])
+        if response.status >= 400:
+          raise FetchError(url, response.status)
+        url = urlparse.urljoin(url, location)
+        meta = None
+        continue
+      self.Count('requests')
+      stream = StreamingResponse(self, url, key, conn, response, budget)
+      if conditional and response.status == 200 and ( stream.headers.get('etag') or stream.headers.get('last-modified') ):
+        stream.Spool(self.validators)
+      return stream
+    raise FetchError(url, response.status, 'too many redirects')
+
+  def Request(self, url, headers, budget=None):
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+    default_port = scheme == 'https' and 443 or 80
+    host, port = SplitPort(netloc, default_port)
+    host, port = self.host_map.get(host, (host, port))
+    target = path or '/'
+    if query:
+      target += '?' + query
+    headers['Host'] = netloc
+    headers['User-Agent'] = USER_AGENT
+
+    for attempt in range(2):
+      timeout = REQUEST_TIMEOUT_SECONDS
+      if budget is not None:
+        timeout = min(timeout, budget.Remaining(url))
+      conn, reused = self.pool.Get(scheme, host, port, timeout, fresh=attempt > 0)
+      self.Count(reused and 'connections_reused' or 'connections_opened')
+      try:
+        conn.request('GET', target, headers=headers)
+        return ( scheme, host, port ), conn, conn.getresponse()
+      except socket.timeout:
+        conn.close()
+        raise FetchTimeout(url)
+      except (httplib.HTTPException, socket.error):
+        conn.close()
+        if not reused:
+          raise
+        # the server dropped an idle keep-alive connection, retry once on a fresh one
+
+  def Finish(self, key, conn, response):
+    if response.will_close:
+      conn.close()
+    else:
+      self.pool.Release(key[0], key[1], key[2], conn)
+
+class StreamingResponse:
+
+  def __init__(self, fetcher, url, key, conn, response, budget=None):
+    self.fetcher = fetcher
+    self.url = url
+    self.key = key
+    self.conn = conn
+    self.response = response
+    self.budget = budget
+    self.status = response.status
+    self.headers = dict(response.getheaders())
+    self.done = False
+    encoding = self.headers.get('content-encoding', '').lower()
+    self.decoder = None
+    if encoding == 'gzip':
+      self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+      self.decoder = zlib.decompressobj()
+    self.sha1 = hashlib.sha1()
+    self.digest = None     # of the decoded body, once it has all been read
+    self.from_cache = False
+    self.validators = None
+    self.spool = None
+    self.bytes_fetched = 0   # off the wire, before decoding
+
+  # keep a copy of the body on disk as it goes by, so a later conditional Open
+  # answered with a 304 can be read from there
+
+  def Spool(self, validators):
+    self.validators = validators
+    self.spool_path = storage.temp_path(validators.Paths(self.url)[1])
+    self.spool = open(self.spool_path, 'wb')
+
+  def read(self, n=-1):
+    if n is None or n < 0:
+      chunks = []
+      while True:
+        chunk = self.read(65536)
+        if not chunk:
+          return ''.join(chunks)
+        chunks.append(chunk)
+    while not self.done:
+      if self.budget is not None:
+        self.budget.Remaining(self.url)
+      try:
+        data = self.response.read(n)
+      except socket.timeout:
+        self.close()
+        raise FetchTimeout(self.url)
+      if not data:
+        self.done = True
+        self.fetcher.Finish(self.key, self.conn, self.response)
+        data = self.decoder and self.decoder.flush() or ''
+        self.Consume(data)
+        self.Complete()
+        return data
+      self.fetcher.Count('bytes_fetched', len(data))
+      self.bytes_fetched += len(data)
+      if self.decoder is not None:
+        data = self.decoder.decompress(data)
+      if data:
+        self.Consume(data)
+        return data
+    return ''
+
+  def Consume(self, data):
+    self.sha1.update(data)
+    if self.spool is not None:
+      self.spool.write(data)
+
+  def Complete(self):
+    self.digest = self.sha1.hexdigest()
+    if self.spool is not None:
+      self.spool.close()
+      self.spool = None
+      try:
+        self.validators.PutStreamed(self.url, self.headers.get('etag'), self.headers.get('last-modified'), self.digest, self.spool_path)
+      except (IOError, OSError):
+        pass   # no 304s for this url next time, that's all
+
+  def close(self):
+    if not self.done:     # abandoned mid-body, the connection can't be reused
+      self.done = True
+      self.conn.close()
+    if self.spool is not None:
+      self.spool.close()
+      self.spool = None
+      try:
+        os.remove(self.spool_path)
+      except OSError:
+        pass
+
+class StoredResponse:
+
+  # a conditional Open answered with a 304: the body spooled last time
+
+  def __init__(self, url, path, digest):
+    self.url = url
+    self.status = 200
+    self.headers = {}
+    self.digest = digest
+    self.from_cache = True
+    self.bytes_fetched = 0
+    self.f = open(path, 'rb')
+
+  def read(self, n=-1):
+    return self.f.read(n)
+
+  def close(self):
+    self.f.close()
+
+def SplitPort(netloc, default_port):
+  if '@' in netloc:
+    netloc = netloc.split('@')[-1]
+  if ':' in netloc:
+    host, port = netloc.rsplit(':', 1)
+    if port.isdigit():
+      return host, int(port)
+  return netloc, default_port
+
+shared = None
+shared_lock = threading.Lock()
+
+# one fetcher per process, so the parsers in a warm worker share connections and validators
+
+def SharedFetcher():
+  global shared
+  shared_lock.acquire()
+  try:
+    if shared is None:
+      shared = Fetcher()
+  finally:
+    shared_lock.release()
+  return shared
+
+def test():
+  import tempfile, standin
+  server = standin.StandIn()
+  server.Add('/page', '<html><body>' + 'hello ' * 1000 + '</body></html>', 'text/html')
+  server.Start()
+  try:
+    fetcher = Fetcher(directory=tempfile.mkdtemp(), host_map={ 'www.example.com' : server.address })
+    url = 'http://www.example.com/page'
+    first = fetcher.Fetch(url, budget=Budget(10))
+    second = fetcher.Fetch(url, budget=Budget(10))
+    print first, second
+    print 'same body: %s' % ( first.body == second.body )
+    print 'fetcher: %s' % fetcher.counters
+    print 'stand-in: %s' % server.counters
+    for path in fetcher.validators.Paths(url):
+      os.utime(path, ( 0, 0 ))
+    fetcher.validators.Prune(force=True)
+    print 'pruned: %s' % ( fetcher.validators.GetMeta(url) is None )
+  finally:
+    fetcher.pool.Close()
+    server.Stop()
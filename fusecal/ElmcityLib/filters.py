@@ -0,0 +1,276 @@
+import re, threading
+
+import cache
+
+# the filter argument of a fusecal url. a plain filter is one case-insensitive
+# substring of the title, as it always was. a filter that uses the query syntax
+#
+#   keene OR peterborough OR "mount monadnock"
+#   title:(story time) AND NOT location:jaffrey
+#
+# is compiled once into a matcher: terms are phrases, optionally prefixed with a
+# field (title, location, url), combined with AND, OR, NOT and parentheses.
+# operators are uppercase words; adjacent words form one phrase. the terms of an
+# OR on the same field become a single regex alternation, so a hub filtering a
+# regional feed by many town names makes one pass per title. an event that lacks
+# a field matches no term on it, negated or not.
+
+FIELDS = ( 'title', 'location', 'url' )
+OPERATORS = ( 'AND', 'OR', 'NOT' )
+CACHE_CAPACITY = 128
+
+token_pattern = re.compile(r'\s*(?:(\()|(\))|"([^"]*)"|(title|location|url):|([^\s()"]+))')
+
+compiled = cache.LruTier(CACHE_CAPACITY)
+compiled_lock = threading.Lock()
+
+class FilterError(Exception):
+  pass
+
+class Matcher:
+
+  # called with one value per name in .fields, in that order
+
+  def __init__(self, text, fields, test):
+    self.text = text
+    self.fields = fields
+    self.test = test
+
+  def __call__(self, *values):
+    return self.test(values)
+
+  def __repr__(self):
+    return "<Matcher: %s on %s>" % ( self.text, ','.join(self.fields) )
+
+def Tokenize(text):
+  tokens = []
+  pos = 0
+  text = text.rstrip()
+  while pos < len(text):
+    m = token_pattern.match(text, pos)
+    if m is None:
+      raise FilterError('unbalanced quote in filter: %s' % text)
+    open_paren, close_paren, quoted, field, word = m.groups()
+    if open_paren:
+      tokens.append(( '(', None ))
+    elif close_paren:
+      tokens.append(( ')', None ))
+    elif quoted is not None:
+      tokens.append(( 'phrase', quoted ))
+    elif field:
+      tokens.append(( 'field', field ))
+    elif word in OPERATORS:
+      tokens.append(( word, None ))
+    else:
+      tokens.append(( 'word', word ))
+    pos = m.end()
+  return tokens
+
+def IsQuery(tokens):
+  for kind, value in tokens:
+    if kind != 'word':
+      return True
+  return False
+
+class Parser:
+
+  # or := and ( OR and )*
+  # and := unary ( [AND] unary )*
+  # unary := NOT unary | [field:] ( '(' or ')' | phrase )
+
+  def __init__(self, tokens, text):
+    self.tokens = tokens
+    self.text = text
+    self.pos = 0
+
+  def Peek(self):
+    if self.pos < len(self.tokens):
+      return self.tokens[self.pos][0]
+    return None
+
+  def Next(self):
+    token = self.tokens[self.pos]
+    self.pos += 1
+    return token
+
+  def Fail(self, message):
+    raise FilterError('%s in filter: %s' % ( message, self.text ))
+
+  def Parse(self):
+    node = self.Or('title')
+    if self.Peek() is not None:
+      self.Fail('unexpected %s' % self.Peek())
+    return node
+
+  def Or(self, field):
+    nodes = [ self.And(field) ]
+    while self.Peek() == 'OR':
+      self.Next()
+      nodes.append(self.And(field))
+    if len(nodes) == 1:
+      return nodes[0]
+    return ( 'or', nodes )
+
+  def And(self, field):
+    nodes = [ self.Unary(field) ]
+    while self.Peek() not in ( None, 'OR', ')' ):
+      if self.Peek() == 'AND':
+        self.Next()
+      nodes.append(self.Unary(field))
+    if len(nodes) == 1:
+      return nodes[0]
+    return ( 'and', nodes )
+
+  def Unary(self, field):
+    kind = self.Peek()
+    if kind == 'NOT':
+      self.Next()
+      return ( 'not', self.Unary(field) )
+    if kind == 'field':
+      field = self.Next()[1]
+      kind = self.Peek()
+    if kind == '(':
+      self.Next()
+      node = self.Or(field)
+      if self.Peek() != ')':
+        self.Fail('missing )')
+      self.Next()
+      return node
+    if kind == 'phrase':
+      return ( 'term', field, self.Next()[1] )
+    if kind == 'word':
+      words = []
+      while self.Peek() == 'word':
+        words.append(self.Next()[1])
+      return ( 'term', field, ' '.join(words) )
+    self.Fail('expected a term, got %s' % kind)
+
+def Search(phrases):
+  return re.compile('|'.join([re.escape(phrase) for phrase in phrases]), re.IGNORECASE | re.UNICODE).search
+
+def Build(node, index):
+  kind = node[0]
+
+  if kind == 'term':
+    return Alternation(Search([ node[2] ]), index[node[1]])
+
+  if kind == 'not':
+    # an event missing a field the negation names doesn't match it, as ApplyFilter
+    # dropped untitled events
+    test = Build(node[1], index)
+    needed = [ index[field] for field in Fields(node[1], []) ]
+    def Not(values):
+      for i in needed:
+        if values[i] is None:
+          return False
+      return not test(values)
+    return Not
+
+  children = node[1]
+
+  if kind == 'or':
+    # one alternation per field for the plain terms, then whatever is left
+    phrases = {}
+    others = []
+    for child in children:
+      if child[0] == 'term':
+        phrases.setdefault(child[1], []).append(child[2])
+      else:
+        others.append(child)
+    tests = []
+    for field, terms in phrases.items():
+      tests.append(Alternation(Search(terms), index[field]))
+    tests.extend([Build(child, index) for child in others])
+    if len(tests) == 1:
+      return tests[0]
+    def AnyOf(values):
+      for test in tests:
+        if test(values):
+          return True
+      return False
+    return AnyOf
+
+  tests = [Build(child, index) for child in children]
+  def AllOf(values):
+    for test in tests:
+      if not test(values):
+        return False
+    return True
+  return AllOf
+
+def Alternation(search, i):
+  return lambda values: values[i] is not None and search(values[i]) is not None
+
+def Fields(node, found):
+  if node[0] == 'term':
+    if node[1] not in found:
+      found.append(node[1])
+  elif node[0] == 'not':
+    Fields(node[1], found)
+  else:
+    for child in node[1]:
+      Fields(child, found)
+  return found
+
+def Substring(text):
+  # the old behavior, also the fallback for a filter that doesn't parse
+  return Matcher(text, ( 'title', ), Build(( 'term', 'title', text ), { 'title' : 0 }))
+
+def Compile(text):
+  if text is None or text.strip() == '':
+    return None
+
+  compiled_lock.acquire()
+  try:
+    matcher = compiled.Get(text)
+  finally:
+    compiled_lock.release()
+  if matcher is not None:
+    return matcher
+
+  tokens = Tokenize(text)
+  if IsQuery(tokens):
+    node = Parser(tokens, text).Parse()
+    fields = tuple([field for field in FIELDS if field in Fields(node, [])])
+    index = {}
+    for i in range(len(fields)):
+      index[fields[i]] = i
+    matcher = Matcher(text, fields, Build(node, index))
+  else:
+    matcher = Substring(text)   # plain filter, the whole string is one substring
+
+  compiled_lock.acquire()
+  try:
+    compiled.Put(text, matcher)
+  finally:
+    compiled_lock.release()
+  return matcher
+
+def test():
+  def Row(title, location=None, url=None):
+    return { 'title' : title, 'location' : location, 'url' : url }
+  rows = [ Row(u'Story time, Keene Public Library', 'Keene', 'http://keene.lib/1'),
+           Row(u'Book sale, Peterborough Town Library', 'Peterborough'),
+           Row(u'Poetry night, Jaffrey Civic Center', 'Jaffrey', 'http://jaffrey.org/2'),
+           Row(None) ]
+  cases = [ ( 'keene public', [0] ),
+            ( 'Library', [0, 1] ),
+            ( 'keene OR peterborough OR jaffrey', [0, 1, 2] ),
+            ( 'library AND NOT keene', [1] ),
+            ( 'location:(keene OR jaffrey) AND url:http', [0, 2] ),
+            ( 'NOT title:library', [2] ),
+            ( 'NOT location:(keene OR peterborough)', [2] ),
+            ( 'NOT url:jaffrey', [0] ),
+            ( '"story time, keene" OR (book AND sale)', [0, 1] ) ]
+  for text, expected in cases:
+    matcher = Compile(text)
+    got = [i for i in range(len(rows)) if matcher(*[rows[i][field] for field in matcher.fields])]
+    assert got == expected, ( text, got, expected )
+    assert Compile(text) is matcher
+  for bad in [ 'keene OR', '(keene', '"keene' ]:
+    try:
+      Compile(bad)
+      assert False, bad
+    except FilterError:
+      pass
+  print 'filters: %s cases ok' % len(cases)
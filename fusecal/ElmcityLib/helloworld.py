@@ -7,7 +7,7 @@ class HelloWorldParser(ElmcityEventParser.EventParser):
     try:
       self.ParsePage()
     except: 
-      self.LogMsg('exception', 'HelloWorldParser.Parse', traceback.format_exc())
+      self.LogFailure('HelloWorldParser.Parse', traceback.format_exc())
     self.BuildICS()
 
   def ParsePage(self):
@@ -0,0 +1,250 @@
+import re, time
+
+from HTMLParser import HTMLParser, HTMLParseError
+
+try:
+  import clr
+  IPY = True
+except ImportError:
+  IPY = False
+
+# pulls a few elements out of a page without building a tree for the rest of it.
+# a selector is ( tag, attrs ), matched the way BeautifulSoup's find matches, except
+# that a class matches any one of an element's classes and True means present. only
+# a matching element and what is inside it become Nodes; everything else is
+# skipped as it streams past, and parsing stops once limit matches have been
+# found. pages HTMLParser can't make sense of go through BeautifulSoup instead.
+# the page is decoded first, as BeautifulSoup decoded it: by the charset the
+# Content-Type header names, then a meta charset, then as utf-8, then latin-1.
+#
+#   for item in Extract(html, ( 'div', { 'class' : 'eventitem' } ), content_type=headers.get('content-type')):
+#     title = item.Find('div', { 'class' : 'event-titleinfo' }).Text()
+
+VOID_TAGS = ( 'area', 'base', 'br', 'col', 'hr', 'img', 'input', 'link', 'meta', 'param' )
+
+HTTP_CHARSET = re.compile(r'charset\s*=\s*["\']?([-\w:.]+)', re.I)
+META_CHARSET = re.compile(r'<meta[^>]+charset\s*=\s*["\']?([-\w:.]+)', re.I)
+
+def Decode(html, content_type=None):
+  # under IronPython a page is a str of byte values, which decode takes as bytes
+  if isinstance(html, unicode) and not IPY:
+    return html
+  charsets = [ 'utf-8', 'latin-1' ]
+  meta = META_CHARSET.search(html)
+  if meta:
+    charsets.insert(0, meta.group(1))
+  http = content_type and HTTP_CHARSET.search(content_type)
+  if http:
+    charsets.insert(0, http.group(1))
+  for charset in charsets:
+    try:
+      return html.decode(charset)
+    except ( LookupError, UnicodeError ):
+      pass
+  return html
+
+class Node:
+
+  def __init__(self, tag, attrs, parent=None):
+    self.tag = tag
+    self.attrs = attrs
+    self.parent = parent
+    self.children = []   # Nodes and strings
+
+  def __repr__(self):
+    return "<Node: %s %s>" % ( self.tag, self.attrs )
+
+  def Get(self, name, default=None):
+    return self.attrs.get(name, default)
+
+  def Text(self):
+    # like BeautifulSoup's .text: the strings underneath, joined, entities left as they were
+    parts = []
+    stack = [ self ]
+    while stack:
+      node = stack.pop()
+      if isinstance(node, Node):
+        stack.extend(reversed(node.children))
+      else:
+        parts.append(node)
+    return u''.join(parts)
+
+  def FindAll(self, tag=None, attrs=None, limit=None):
+    found = []
+    stack = list(reversed(self.children))
+    while stack:
+      node = stack.pop()
+      if not isinstance(node, Node):
+        continue
+      if Matches(node.tag, node.attrs, tag, attrs):
+        found.append(node)
+        if limit is not None and len(found) >= limit:
+          break
+      stack.extend(reversed(node.children))
+    return found
+
+  def Find(self, tag=None, attrs=None):
+    found = self.FindAll(tag, attrs, limit=1)
+    return found and found[0] or None
+
+def Matches(node_tag, node_attrs, tag, attrs):
+  if tag is not None and node_tag != tag:
+    return False
+  for name, wanted in ( attrs or {} ).items():
+    value = node_attrs.get(name)
+    if wanted is True:
+      if value is None:
+        return False
+    elif name == 'class':
+      if value is None or wanted not in value.split():
+        return False
+    elif value != wanted:
+      return False
+  return True
+
+class Done(Exception):
+  pass
+
+class Extractor(HTMLParser):
+
+  def __init__(self, selectors, limit=None):
+    HTMLParser.__init__(self)
+    self.selectors = selectors
+    self.limit = limit
+    self.found = []
+    self.open = []    # the Nodes being built, innermost last
+
+  def Match(self, tag, attrs):
+    for selector_tag, selector_attrs in self.selectors:
+      if Matches(tag, attrs, selector_tag, selector_attrs):
+        return True
+    return False
+
+  def handle_starttag(self, tag, attrs):
+    if not self.open:
+      attrs = dict(attrs)
+      if not self.Match(tag, attrs):
+        return
+      node = Node(tag, attrs)
+      self.found.append(node)
+    else:
+      parent = self.open[-1]
+      node = Node(tag, dict(attrs), parent)
+      parent.children.append(node)
+    if tag in VOID_TAGS:
+      self.Closed()
+    else:
+      self.open.append(node)
+
+  def handle_startendtag(self, tag, attrs):
+    self.handle_starttag(tag, attrs)
+    if self.open and self.open[-1].tag == tag:
+      self.open.pop()
+      self.Closed()
+
+  def handle_endtag(self, tag):
+    if not self.open:
+      return
+    for i in range(len(self.open) - 1, -1, -1):   # close anything left open inside it, as browsers do
+      if self.open[i].tag == tag:
+        del self.open[i:]
+        self.Closed()
+        return
+
+  def Closed(self):
+    if not self.open and self.limit is not None and len(self.found) >= self.limit:
+      raise Done()
+
+  def handle_data(self, data):
+    if self.open:
+      self.open[-1].children.append(data)
+
+  def handle_entityref(self, name):
+    if self.open:
+      self.open[-1].children.append(u'&%s;' % name)
+
+  def handle_charref(self, name):
+    if self.open:
+      self.open[-1].children.append(u'&#%s;' % name)
+
+def Extract(html, *selectors, **options):
+  limit = options.get('limit')
+  html = Decode(html, options.get('content_type'))
+  extractor = Extractor(selectors, limit)
+  try:
+    extractor.feed(html)
+    extractor.close()
+  except Done:
+    pass
+  except HTMLParseError:
+    return ExtractFromSoup(html, selectors, limit)
+  return extractor.found
+
+def ExtractFromSoup(html, selectors, limit=None):
+  from BeautifulSoup import BeautifulSoup, Tag
+  def Convert(tag, parent=None):
+    node = Node(tag.name, dict(tag.attrs), parent)
+    for child in tag.contents:
+      if isinstance(child, Tag):
+        node.children.append(Convert(child, node))
+      else:
+        node.children.append(unicode(child))
+    return node
+  found = []
+  for tag in BeautifulSoup(html).findAll(lambda tag: MatchesAny(tag, selectors)):
+    if not [parent for parent in tag.findParents() if MatchesAny(parent, selectors)]:   # outermost only, like Extract
+      found.append(Convert(tag))
+      if limit is not None and len(found) >= limit:
+        break
+  return found
+
+def MatchesAny(tag, selectors):
+  attrs = dict(tag.attrs)
+  for selector_tag, selector_attrs in selectors:
+    if Matches(tag.name, attrs, selector_tag, selector_attrs):
+      return True
+  return False
+
+def test():
+  html = """<html><head><script>if (a < b) document.write('<div class="eventitem">')</script></head><body>
+<div id="profile_bandschedule"><h3>Shows</h3><a href="/shows?a=1&amp;b=2">all shows</a><br></div>
+<div class="eventitem first"><div class="event-cal">Sat, October 23 @ 9:00 PM</div>
+<div class="event-titleinfo"><a href="http://events.myspace.com/1">Jatoba&nbsp;Iron Horse, <b>Northampton</b></a></div></div>
+<div class="eventitem"><div class="event-cal">Fri, October 29 @ 8:00 PM<p>unclosed</div>
+<div class="event-titleinfo"><a href="http://events.myspace.com/2">Colonial&#160;Theatre</a></div></div>
+</body></html>"""
+  items = Extract(html, ( 'div', { 'class' : 'eventitem' } ))
+  assert len(items) == 2, items
+  assert items[0].Find('div', { 'class' : 'event-titleinfo' }).Text() == u'Jatoba&nbsp;Iron Horse, Northampton'
+  assert items[1].Find('div', { 'class' : 'event-cal' }).Text() == u'Fri, October 29 @ 8:00 PMunclosed'
+  assert [item.Find('a', { 'href' : True }).Get('href') for item in items] == [ 'http://events.myspace.com/1', 'http://events.myspace.com/2' ]
+  schedule = Extract(html, ( 'div', { 'id' : 'profile_bandschedule' } ), limit=1)
+  assert len(schedule) == 1 and schedule[0].Find('a').Get('href') == '/shows?a=1&b=2'
+  broken = '<div class="eventitem"><a href="x" <<>>>one</a></div><div class="eventitem">two</div><! junk'
+  assert [item.Text() for item in Extract(broken, ( 'div', { 'class' : 'eventitem' } ))][-1] == u'two'
+  title = lambda page, content_type=None: Extract(page, ( 'div', { 'class' : 'event-titleinfo' } ), content_type=content_type)[0].Text()
+  utf8 = '<html><head><meta charset="utf-8"></head><body><div class="event-titleinfo">Caf\xc3\xa9 R\xc3\xa9servoir \xe2\x80\x94 live</div></body></html>'
+  assert title(utf8) == u'Caf\xe9 R\xe9servoir \u2014 live'
+  assert title(utf8.replace('<meta charset="utf-8">', '')) == u'Caf\xe9 R\xe9servoir \u2014 live'   # no charset said, utf-8 first
+  latin1 = '<html><head><meta http-equiv="Content-Type" content="text/html; charset=iso-8859-1"></head><body><div class="event-titleinfo">Caf\xe9</div></body></html>'
+  assert title(latin1) == u'Caf\xe9' and title(latin1.replace('charset=iso-8859-1', '')) == u'Caf\xe9'
+  assert title(latin1.replace('iso-8859-1', 'utf-8'), 'text/html; charset=ISO-8859-1') == u'Caf\xe9'   # the header wins
+  assert title(latin1.replace('iso-8859-1', 'no-such-charset')) == u'Caf\xe9'
+  print 'htmlextract: ok'
+
+def benchmark(items=2000, n=5):
+  from BeautifulSoup import BeautifulSoup
+  filler = '<div class="module"><ul>%s</ul><p>' % ''.join(['<li><a href="/friend/%s"><img src="/pic/%s.jpg" /></a></li>' % ( i, i ) for i in range(50)])
+  item = '<div class="eventitem"><div class="event-cal">Sat, October 23 @ 9:00 PM</div><div class="event-titleinfo"><a href="http://events.myspace.com/%s">Show %s&nbsp;Venue</a></div></div>\n'
+  html = '<html><body>%s<div id="shows">%s</div>%s</body></html>' % ( filler * 20, ''.join([item % ( i, i ) for i in range(items)]), filler * 20 )
+  def Soup():
+    return [ tag.findAll('div', { 'class' : 'event-titleinfo' })[0].text for tag in BeautifulSoup(html).findAll('div', { 'class' : 'eventitem' }) ]
+  def Selective():
+    return [ node.Find('div', { 'class' : 'event-titleinfo' }).Text() for node in Extract(html, ( 'div', { 'class' : 'eventitem' } )) ]
+  assert Soup() == Selective()
+  for label, extract in [ ( 'BeautifulSoup', Soup ), ( 'htmlextract', Selective ) ]:
+    start = time.time()
+    for i in range(n):
+      extract()
+    elapsed = time.time() - start
+    print '%s: %s items from %.1f KB, %.3f s per page' % ( label, items, len(html) / 1024.0, elapsed / n )
@@ -0,0 +1,191 @@
+import datetime, time
+
+# reads properties out of upstream iCalendar text without building a calendar.
+# lines are unfolded as they are read, and for each component of the kind asked
+# for (VEVENT by default) only the properties asked for are split into params
+# and value; the rest, and everything inside nested components such as VALARM,
+# are passed over. the counterpart of icswriter.py.
+#
+#   for props in IterComponents(text, properties=( 'SUMMARY', 'DTSTART' )):
+#     start, is_utc, tzid = DateTime(props['DTSTART'])
+
+class ICSReadError(ValueError):
+  pass
+
+class Property:
+
+  def __init__(self, name, params, value):
+    self.name = name
+    self.params = params
+    self.value = value
+
+  def __repr__(self):
+    return "<Property: %s %s %r>" % ( self.name, self.params, self.value )
+
+  def Text(self):
+    return Unescape(self.value)
+
+def Lines(source):
+  if isinstance(source, basestring):
+    return source.splitlines()
+  return source
+
+def Unfold(source):
+  # folded lines continue with a space or a tab; CRLF, LF and blank lines all happen
+  current = None
+  for line in Lines(source):
+    line = line.rstrip('\r\n')
+    if line[:1] in ( ' ', '\t' ):
+      if current is not None:
+        current += line[1:]
+      continue
+    if current is not None:
+      yield current
+    current = line or None
+  if current is not None:
+    yield current
+
+def Name(line):
+  # the property name, without parsing anything else
+  end = len(line)
+  for sep in ( ';', ':' ):
+    i = line.find(sep)
+    if i >= 0 and i < end:
+      end = i
+  return line[:end].upper()
+
+def ParseLine(line):
+  if not isinstance(line, unicode):
+    line = line.decode('utf-8', 'replace')
+  name = Name(line)
+  params = {}
+  i = len(name)
+  while i < len(line) and line[i] == ';':
+    eq = line.find('=', i)
+    if eq < 0:
+      raise ICSReadError('parameter without a value: %s' % line)
+    param = line[i+1:eq].upper()
+    i = eq + 1
+    if line[i:i+1] == '"':
+      close = line.find('"', i + 1)
+      if close < 0:
+        raise ICSReadError('unterminated quote: %s' % line)
+      params[param] = line[i+1:close]
+      i = close + 1
+    else:
+      end = i
+      while end < len(line) and line[end] not in ';:':
+        end += 1
+      params[param] = line[i:end]
+      i = end
+  if line[i:i+1] != ':':
+    raise ICSReadError('no value: %s' % line)
+  return Property(name, params, line[i+1:])
+
+def Unescape(text):
+  if '\\' not in text:
+    return text
+  out = []
+  i = 0
+  while i < len(text):
+    ch = text[i]
+    if ch == '\\' and i + 1 < len(text):
+      nxt = text[i+1]
+      out.append(nxt in 'nN' and u'\n' or nxt)
+      i += 2
+      continue
+    out.append(ch)
+    i += 1
+  return u''.join(out)
+
+def IterComponents(source, component='VEVENT', properties=None):
+  # yields { NAME : Property } per component, first occurrence of each name
+  wanted = properties and dict([ ( name.upper(), True ) for name in properties ]) or None
+  begin = 'BEGIN:' + component
+  end = 'END:' + component
+  props = None
+  depth = 0     # of components nested inside this one
+  for line in Unfold(source):
+    upper = line[:6].upper()
+    if props is None:
+      if upper == 'BEGIN:' and line.upper() == begin:
+        props = {}
+      continue
+    if upper == 'BEGIN:':
+      depth += 1
+      continue
+    if upper[:4] == 'END:':
+      if depth:
+        depth -= 1
+      elif line.upper() == end:
+        yield props
+        props = None
+      continue
+    if depth:
+      continue
+    name = Name(line)
+    if name in props or ( wanted is not None and name not in wanted ):
+      continue
+    props[name] = ParseLine(line)
+
+def DateTime(prop):
+  # ( datetime, is_utc, tzid ). a UTC time comes back naive; so does a floating
+  # or TZID time, which is wall-clock time in tzid (None if floating). a DATE is
+  # midnight of that day
+  value = prop.value.strip()
+  try:
+    if prop.params.get('VALUE', '').upper() == 'DATE' or len(value) == 8:
+      return datetime.datetime(int(value[0:4]), int(value[4:6]), int(value[6:8])), False, prop.params.get('TZID')
+    if value[8:9].upper() != 'T' or len(value) not in ( 15, 16 ):
+      raise ValueError(value)
+    dt = datetime.datetime(int(value[0:4]), int(value[4:6]), int(value[6:8]), int(value[9:11]), int(value[11:13]), int(value[13:15]))
+  except ValueError:
+    raise ICSReadError('bad %s: %s' % ( prop.name, prop.value ))
+  if value[-1:].upper() == 'Z':
+    return dt, True, None
+  return dt, False, prop.params.get('TZID')
+
+def test():
+  text = '\r\n'.join([ 'BEGIN:VCALENDAR', 'VERSION:2.0',
+    'BEGIN:VTIMEZONE', 'TZID:Eastern Standard Time', 'BEGIN:STANDARD', 'DTSTART:16011104T020000', 'END:STANDARD', 'END:VTIMEZONE',
+    'BEGIN:VEVENT', 'UID:1', 'DTSTART:20101025T143000Z', 'SUMMARY:Toddler Story Time\\, ages 2-3', 'LOCATION;LANGUAGE=en:Children\'s',
+    '  Room', 'BEGIN:VALARM', 'DESCRIPTION:Reminder', 'SUMMARY:not this one', 'END:VALARM', 'DESCRIPTION:Keene', 'END:VEVENT',
+    'BEGIN:VEVENT', 'UID:2', 'DTSTART;TZID="Eastern Standard Time":20101028T190000', 'summary:Book sale', 'END:VEVENT',
+    'BEGIN:VEVENT', 'UID:3', 'DTSTART;VALUE=DATE:20101101', 'SUMMARY:All day', 'END:VEVENT',
+    'END:VCALENDAR', '' ])
+  events = list(IterComponents(text, properties=( 'SUMMARY', 'LOCATION', 'DTSTART' )))
+  assert len(events) == 3, events
+  assert events[0]['SUMMARY'].Text() == u'Toddler Story Time, ages 2-3'
+  assert events[0]['LOCATION'].Text() == u"Children's Room" and events[0]['LOCATION'].params == { 'LANGUAGE' : 'en' }
+  assert 'DESCRIPTION' not in events[0] and 'UID' not in events[0]
+  assert DateTime(events[0]['DTSTART']) == ( datetime.datetime(2010, 10, 25, 14, 30), True, None )
+  assert DateTime(events[1]['DTSTART']) == ( datetime.datetime(2010, 10, 28, 19, 0), False, 'Eastern Standard Time' )
+  assert events[1]['SUMMARY'].Text() == u'Book sale'
+  assert DateTime(events[2]['DTSTART']) == ( datetime.datetime(2010, 11, 1), False, None )
+  assert [props['TZID'].value for props in IterComponents(text.split('\r\n'), 'VTIMEZONE')] == [ 'Eastern Standard Time' ]
+  for bad in [ 'DTSTART:2010-10-25', 'DTSTART;TZID="Eastern:20101028T190000' ]:
+    try:
+      DateTime(ParseLine(bad))
+      assert False, bad
+    except ICSReadError:
+      pass
+  print 'icsreader: ok'
+
+def benchmark(n=2000):
+  import os, icalendar
+  path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'libraryinsight_287809.ics')
+  f = open(path, 'rb')
+  text = f.read()
+  f.close()
+  def Reader():
+    props = IterComponents(text, properties=( 'SUMMARY', 'LOCATION', 'DTSTART' )).next()
+    return props['SUMMARY'].Text(), DateTime(props['DTSTART'])[0]
+  def Calendar():
+    evt = icalendar.Calendar.from_string(text).walk('vevent')[0]
+    return evt['summary'], evt['dtstart'].dt
+  for label, read in [ ( 'icsreader', Reader ), ( 'icalendar', Calendar ) ]:
+    start = time.time()
+    for i in xrange(n):
+      read()
+    elapsed = time.time() - start
+    print '%s: %s events in %.2f s, %.0f/sec' % ( label, n, elapsed, n / elapsed )
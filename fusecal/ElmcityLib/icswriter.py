@@ -0,0 +1,116 @@
+import base64, datetime
+
+# writes VCALENDAR text straight from Event objects, as a generator of chunks,
+# without building a DDay.iCal object graph or holding the whole calendar as one
+# string. UIDs are computed the way CalendarAggregator.Event.MakeEventUid does it:
+# base64(utf8(summary)) + '-' + DTStart.Ticks + '@' + appdomain.
+
+APPDOMAIN = 'elmcity.cloudapp.net'
+PRODID = '-//elmcity.cloudapp.net//NONSGML fusecal//EN'
+FOLD_OCTETS = 75
+CHUNK_LINES = 256
+
+def Ticks(dt):
+  # .NET ticks: 100ns intervals since 0001-01-01, of the wall-clock value
+  delta = dt.replace(tzinfo=None) - datetime.datetime(1, 1, 1)
+  return ( delta.days * 86400 + delta.seconds ) * 10000000 + delta.microseconds * 10
+
+def MakeEventUid(title, start):
+  if isinstance(title, unicode):
+    summary = title.encode('utf-8')
+  else:
+    summary = title
+  return '%s-%s@%s' % ( base64.b64encode(summary), Ticks(start), APPDOMAIN )
+
+def TzidFromName(name):
+  # same normalization as CalendarAggregator.Utils.TzinfoFromName
+  name = ' '.join([word.capitalize() for word in name.lower().split(' ')])
+  if not name.endswith('Standard Time'):
+    name = name + ' Standard Time'
+  return name
+
+def Escape(text):
+  return text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n')
+
+def Octets(ch):
+  n = ord(ch)
+  if n < 0x80:
+    return 1
+  if n < 0x800:
+    return 2
+  if n >= 0x10000:   # wide builds hold astral characters whole
+    return 4
+  if 0xD800 <= n < 0xDC00:   # high surrogate, the pair encodes as 4
+    return 4
+  if 0xDC00 <= n < 0xE000:
+    return 0
+  return 3
+
+def Fold(line):
+  # fold at 75 octets of utf-8, never inside a character. works on unicode so
+  # the result can go back to the .NET side as text
+  if not isinstance(line, unicode):
+    line = line.decode('utf-8', 'replace')
+  if len(line) <= FOLD_OCTETS // 4 or len(line.encode('utf-8')) <= FOLD_OCTETS:
+    return line + u'\r\n'
+  parts = []
+  start = 0
+  octets = 0
+  limit = FOLD_OCTETS
+  for i in range(len(line)):
+    n = Octets(line[i])
+    if octets + n > limit:
+      parts.append(line[start:i])
+      start = i
+      octets = 0
+      limit = FOLD_OCTETS - 1    # continuation lines start with a space
+    octets += n
+  parts.append(line[start:])
+  return u'\r\n '.join(parts) + u'\r\n'
+
+def FormatDateTime(dt):
+  return '%04d%02d%02dT%02d%02d%02d' % ( dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second )
+
+def EventLines(title, start, start_is_utc, tzid, dtstamp):
+  yield 'BEGIN:VEVENT'
+  yield 'DTSTAMP:' + dtstamp
+  if start_is_utc:
+    yield 'DTSTART:%sZ' % FormatDateTime(start)
+  elif tzid:
+    yield 'DTSTART;TZID=%s:%s' % ( tzid, FormatDateTime(start) )
+  else:
+    yield 'DTSTART:' + FormatDateTime(start)
+  yield u'SUMMARY:' + Escape(title)   # same properties the DDay backend sets
+  yield 'UID:' + MakeEventUid(title, start)
+  yield 'END:VEVENT'
+
+def Rows(events):
+  if hasattr(events, 'Rows'):   # an EventBatch, read its columns directly
+    return events.Rows('title', 'start', 'start_is_utc')
+  return ( ( evt.title, evt.start, evt.start_is_utc ) for evt in events )
+
+def IterICS(events, tzid=None, vtimezone=None, now=None):
+  dtstamp = FormatDateTime(now or datetime.datetime.utcnow()) + 'Z'
+  lines = [ Fold('BEGIN:VCALENDAR'), Fold('VERSION:2.0'), Fold('PRODID:' + PRODID) ]
+  if vtimezone:
+    lines.append(vtimezone)
+  for title, start, start_is_utc in Rows(events):
+    for line in EventLines(title, start, start_is_utc, tzid, dtstamp):
+      lines.append(Fold(line))
+    if len(lines) >= CHUNK_LINES:
+      yield u''.join(lines)
+      lines = []
+  lines.append(Fold('END:VCALENDAR'))
+  yield u''.join(lines)
+
+def test():
+  import ElmcityEventParser
+  evt = ElmcityEventParser.Event()
+  evt.title = u'Caf\xe9 reading, with a title long enough that the SUMMARY line has to be folded onto a second line'
+  evt.start = datetime.datetime(2010, 7, 8, 22, 0)
+  evt.location = 'Keene, NH'
+  print ''.join(IterICS([evt], tzid=TzidFromName('eastern'))).encode('utf-8')
+  for text in ( u'SUMMARY:' + u'\U0001f3b8\U0001f941' * 30, u'SUMMARY:a' + u'\U0001f3b6' * 40, u'SUMMARY:' + u'\xe9\u2014\U0001f3b8' * 20 ):
+    folded = Fold(text)
+    assert folded.endswith(u'\r\n') and folded[:-2].replace(u'\r\n ', u'') == text
+    assert max([ len(line.encode('utf-8')) for line in folded[:-2].split(u'\r\n') ]) <= FOLD_OCTETS, folded
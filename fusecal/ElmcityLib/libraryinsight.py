@@ -1,66 +1,128 @@
-import ElmcityEventParser
+import ElmcityEventParser, registry, threadpool, cache, dateparse, icsreader, timezones
 
-import sys, re, urllib2, traceback, icalendar, traceback, datetime
+import sys, re, traceback, datetime, json
+
+FRAGMENT_TTL_SECONDS = 7 * 86400
+FRAGMENT_FORMAT = 2   # bumped when what a fragment holds changes: 2 has TZID starts in utc
+
+fragments = cache.ResultCache('libraryinsight_fragments', capacity=4096, max_age=FRAGMENT_TTL_SECONDS)   # sha1 of one event's ics -> the event, as json
 
 class LibraryInsightParser(ElmcityEventParser.EventParser):
 
   def Parse(self):
 
     try:
-      self.LogMsg("info", "LibraryInsightParser.Parse", ','.join(sys.path))
+      self.LogMsg("info", "LibraryInsightParser.Parse", None)
       self.ParsePage()
     except:
-      self.LogMsg('exception', 'LibraryInsightParser.Parse', traceback.format_exc())
+      self.LogFailure('LibraryInsightParser.Parse', traceback.format_exc())
 
     self.BuildICS()
 
   def ParsePage(self):
 
-     html = urllib2.urlopen(self.url).read()
-     ids = re.findall('lmx=(\d+)',html)  # 287809
+     html = self.Fetch(self.url)
+     self.Source(self.url, html)
+     ids = self.UniqueIds(re.findall('lmx=(\d+)',html))  # 287809
 
-     uniques = {}
+     info = registry.Lookup(self.url)
+     max_workers = info and info.max_concurrency or 1
 
-     for id in ids:
+     outcomes = threadpool.Map(self.FetchEvent, ids, max_workers)
 
-       ical_url = 'http://www.libraryinsight.com/tvCalSendHome.asp?po=1&jx=eap&ijSchedule=' + id
-       ical_text = urllib2.urlopen(ical_url).read()
-       #print "ical_text: " + ical_text
-       pat = re.compile('BEGIN:VALARM[\n\s\S]+END:VALARM\s')
-       ical_text = re.sub(pat,'',ical_text)
+     found = ElmcityEventParser.EventBatch()
 
-       cal = icalendar.Calendar.from_string(ical_text)
+     for id, outcome in zip(ids, outcomes):
 
-       ical_event = cal.walk('vevent')[0]
-      
-       evt = ElmcityEventParser.Event()
+       if outcome.error is not None:
+         self.LogFailure('LibraryInsightParser.FetchEvent: ' + id, outcome.error)
+         continue
 
-       evt.title = ical_event['summary']
+       ical_url, digest, evt = outcome.value
 
-       evt.start_is_utc = True
+       self.Source(ical_url, digest=digest)
+
+       found.append(evt)
+
+     if self.Unchanged():
+       return
+
+     found = found.Dedup('title', 'start')
+
+     for evt in found:
+       print evt
+
+     self.events.Extend(found)
 
-       try:
-         evt.location = ical_event['location']
-         evt.title += ', ' + evt.location
-       except:
-         pass
-
-       try:
-         evt.start = ical_event['dtstart'].dt
-       except:
-         print traceback.print_exc()
-           
+  def UniqueIds(self, ids):
+     seen = {}
+     uniques = []
+     for id in ids:
+       if id not in seen:
+         seen[id] = True
+         uniques.append(id)
+     return uniques
+
+  # each event is its own small ics document. the fetch is conditional, and an
+  # event whose text hasn't changed comes back from the fragment cache instead
+  # of being parsed again
+
+  def FetchEvent(self, id):
+
+     ical_url = 'http://www.libraryinsight.com/tvCalSendHome.asp?po=1&jx=eap&ijSchedule=' + id
+     ical_text = self.Fetch(ical_url)
+     #print "ical_text: " + ical_text
+     digest = ElmcityEventParser.Digest(ical_text)
+
+     key = fragments.Key(FRAGMENT_FORMAT, digest)
+     fragment = fragments.Peek(key, FRAGMENT_TTL_SECONDS)
+     if fragment is not None:
+       stored = json.loads(fragment)
+       evt = ElmcityEventParser.Event()
+       evt.title = stored['title']
+       evt.start = dateparse.Parse(stored['start'], '%Y-%m-%d %H:%M:%S')
+       evt.start_is_utc = stored['start_is_utc']
+       evt.location = stored['location']
        evt.url = ical_url
+       return ical_url, digest, evt
 
-       uniques[evt.title + ', ' + evt.start.isoformat()] = evt
+     evt = self.ParseEvent(ical_text)
+     evt.url = ical_url
+     fragments.Store(key, json.dumps({ 'title' : evt.title, 'start' : evt.start.strftime('%Y-%m-%d %H:%M:%S'),
+       'start_is_utc' : evt.start_is_utc, 'location' : evt.location }))
 
-     for key in uniques.keys():
+     return ical_url, digest, evt
 
-       evt = uniques[key]
+  def ParseEvent(self, ical_text):
 
-       print evt
+     # only the first VEVENT's summary, location and start are read, its VALARMs are skipped
+
+     for props in icsreader.IterComponents(ical_text, properties=( 'SUMMARY', 'LOCATION', 'DTSTART' )):
+       break
+     else:
+       raise icsreader.ICSReadError('no VEVENT')
+    
+     evt = ElmcityEventParser.Event()
+
+     evt.title = props['SUMMARY'].Text()
+
+     if 'LOCATION' in props:
+       evt.location = props['LOCATION'].Text()
+       evt.title += ', ' + evt.location
+
+     # a utc start stays utc, and a TZID start becomes utc, so BuildICS converts
+     # both to tz_dest. a floating start, or one in a zone we don't know, is the
+     # library's wall-clock time, taken to be in the hub's zone. an all-day date
+     # stays the date it says
+
+     evt.start, evt.start_is_utc, tzid = icsreader.DateTime(props['DTSTART'])
+
+     zone = tzid and timezones.FromTzid(tzid)
+     if zone is not None and not evt.start_is_utc and len(props['DTSTART'].value.strip()) > 8:
+       evt.start = zone.ToUtc(evt.start)
+       evt.start_is_utc = True
 
-       self.events.append(evt)
+     return evt
 
 def test():
   parser = LibraryInsightParser(url='http://www.libraryinsight.com/calendar.asp?jx=ea')
@@ -1,96 +1,163 @@
-import ElmcityEventParser 
+import ElmcityEventParser, registry, threadpool, cache
 
 from BeautifulSoup import BeautifulSoup
-import sys, datetime, re, urllib2, xml.dom.minidom, traceback
+import sys, datetime, re, traceback
+
+try:
+  from xml.etree.cElementTree import iterparse
+except ImportError:
+  from xml.etree.ElementTree import iterparse
+
+VENUE_TTL_SECONDS = 7 * 24 * 3600
+
+ITEM_CHUNK = 64   # items whose venues are resolved together
+
+venue_cache = cache.ResultCache('librarything_venues', capacity=2048, max_age=VENUE_TTL_SECONDS)
+
+dateTime_reg = re.compile("<b>(.*)</b>")
 
 class LibraryThingParser(ElmcityEventParser.EventParser):
 
+  ics_backend = 'stream'   # city feeds run to thousands of items
+
   def Parse(self):
 
     try:
       self.LogMsg("info", "LibraryThingParser.Parse", None)
       self.ParsePage() 
     except:
-      self.LogMsg('exception', 'LibraryThingParser.Parse', traceback.format_exc())
+      self.LogFailure('LibraryThingParser.Parse', traceback.format_exc())
 
     self.BuildICS()    
 
   def ParsePage(self):
 
-    rss = urllib2.urlopen(self.url).read()
-    xmldoc = xml.dom.minidom.parseString(rss)
+    stream = self.Open(self.url)
+
+    try:
+      if stream.from_cache:      # a 304, the feed is the copy spooled last time
+        self.Source(self.url, digest=stream.digest)
+        if self.Unchanged():
+          return
+      for evt in self.IterEvents(stream):
+        print evt
+        self.events.append(evt)
+    finally:
+      stream.close()
+
+    if not stream.from_cache and stream.digest is not None:
+      self.Source(self.url, digest=stream.digest)
+      self.Unchanged()   # same bytes without a 304: already parsed, but BuildICS can be skipped
 
-    if not xmldoc:
-      return
+  def Salt(self):
+    return datetime.date.today().strftime('%Y-%m')   # the inferred year turns over with the month
 
-    for node in xmldoc.getElementsByTagName('item'):
+  # read the feed as it arrives and let go of each item once it has become an
+  # event, so memory doesn't grow with the size of the feed
 
-        evt = ElmcityEventParser.Event()
+  def IterItems(self, stream):
+
+    channel = None
+
+    for event, node in iterparse(stream, events=('start', 'end')):
+
+        if event == 'start':
+          if node.tag == 'channel':
+            channel = node
+          continue
+
+        if node.tag != 'item':
+          continue
 
         #add event title and summary, handles more than 1 : in the title tag
         #(ex. "Seminary Co-op Bookstore: Mark Weiss discusses and signs The Whole Island: Six Decades of Cuban Poetry")
 
-        title = node.getElementsByTagName('title')[0].firstChild.nodeValue.split(": ")
+        title = node.findtext('title').split(": ")
         locName = title[0].strip()
         eventTitle = ": ".join(title[1:]).strip()
 
-        locationLink = node.getElementsByTagName('link')[0].firstChild.nodeValue
+        locationLink = node.findtext('link')
 
-        description = node.getElementsByTagName('description')[0].firstChild.nodeValue
+        description = node.findtext('description')
 
-        evt.location = locName +  " " + self.ExtractEventLocation(locationLink)
+        yield ( locName, eventTitle, locationLink, description )
 
-        evt.title = eventTitle + ', ' + evt.location
+        node.clear()
+        if channel is not None:
+          channel.remove(node)
 
-        evt.start = self.ExtractEventDateTime(description)
+  def IterEvents(self, stream):
 
-        print evt
+    chunk = []
 
-        self.events.append(evt)
+    for item in self.IterItems(stream):
+      chunk.append(item)
+      if len(chunk) == ITEM_CHUNK:
+        for evt in self.MakeEvents(chunk):
+          yield evt
+        chunk = []
 
+    for evt in self.MakeEvents(chunk):
+      yield evt
 
-  def ExtractEventDateTime(self,eventStr):
+  def MakeEvents(self, items):
 
-    #returns a string like September 26 at 3:45pm
-    dateTime_reg = re.compile("<b>(.*)</b>")
-    dateTime = re.search(dateTime_reg, eventStr).groups()[0]
-   
-    #parses dateTime to get month, day, hour, and minute
-    date, time = dateTime.split(" (");
-    time = time[:-1]
+    venues = self.ResolveVenues([item[2] for item in items])
+
+    for locName, eventTitle, locationLink, description in items:
+
+        evt = ElmcityEventParser.Event()
+
+        evt.location = locName +  " " + venues.get(locationLink, "")
 
-    month, day = date.split(", ")
-    month, day = day.split(" ")
+        evt.title = eventTitle + ', ' + evt.location
 
-    hour,minute = time.split(":")
-    amPm = minute[3:]
-    minute = minute[:2]
+        evt.start = self.ExtractEventDateTime(description)
 
+        yield evt
 
-    if amPm.upper() == 'PM' and int(hour) < 12:
-        hour = int(hour) + 12
+  # most items in a city feed share a handful of venues, so look each distinct
+  # venue up once, several at a time, through a cache that outlives the request
 
-    elif amPm.upper() == 'AM' and int(hour) >= 12:
-        hour = int(hour) - 12
+  def ResolveVenues(self, locationLinks):
 
-    currDateTime = datetime.datetime.now()
+    uniques = []
+    for link in locationLinks:
+      if link not in uniques:
+        uniques.append(link)
 
-    year = currDateTime.year
-    if currDateTime.month > self.month_dict[month]:
-        year += 1
+    info = registry.Lookup(self.url)
+    max_workers = info and info.max_concurrency or 1
 
-    dateTime = datetime.datetime(year,self.month_dict[month],int(day),int(hour),int(minute))
+    venues = {}
+    for link, outcome in zip(uniques, threadpool.Map(self.ExtractEventLocation, uniques, max_workers)):
+      if outcome.error is not None:
+        self.LogFailure('LibraryThingParser.ExtractEventLocation: ' + link, outcome.error)
+        continue
+      venues[link] = outcome.value
 
-    return dateTime
+    return venues
 
+  def ExtractEventDateTime(self,eventStr):
+
+    #a string like Saturday, September 26 (3:45 pm), the weekday isn't needed
+    dateTime = re.search(dateTime_reg, eventStr).groups()[0]
+    dateTime = dateTime.split(", ", 1)[1]
+
+    return self.ParseDateTime(dateTime, '%B %d (%I:%M %p)', infer_year=True)
 
   def ExtractEventLocation(self,locationUrl):
 
-    location_page = urllib2.urlopen(locationUrl)
+    key = venue_cache.Key(locationUrl)
+    return venue_cache.Get(key, lambda: self.FetchEventLocation(locationUrl), ttl=VENUE_TTL_SECONDS)
+
+  def FetchEventLocation(self,locationUrl):
+
+    location_page = self.Fetch(locationUrl)
     soup = BeautifulSoup(location_page)
     element_soup = soup.find(attrs={'class' : re.compile("^venueAddress$")})
 
-    return self.ParseLocationString(element_soup)
+    return self.ParseLocationString(str(element_soup))
    
   def ParseLocationString(self,element_soup):
 
@@ -111,3 +178,42 @@ class LibraryThingParser(ElmcityEventParser.EventParser):
 def test():
   parser = LibraryThingParser(url='http://www.librarything.com/rss/events/location/toronto',tz_source='eastern')
   parser.Parse()
+
+def WriteSyntheticFeed(f, items, venues=10, venue_url='http://www.librarything.com/venue/%s'):
+  f.write('<?xml version="1.0" encoding="utf-8"?>\n<rss version="2.0"><channel><title>LibraryThing events</title>\n')
+  months = ['January','February','March','April','May','June','July','August','September','October','November','December']
+  for i in xrange(items):
+    f.write('<item><title>Venue %s: Author %s discusses and signs Book %s</title><link>%s</link>' % ( i % venues, i, i, venue_url % ( i % venues ) ) )
+    f.write('<description>&lt;b&gt;Saturday, %s %s (%s:%02d pm)&lt;/b&gt; at Venue %s</description></item>\n' % ( months[i % 12], 1 + i % 28, 1 + i % 11, i % 60, i % venues ) )
+  f.write('</channel></rss>\n')
+
+def benchmark(items=50000, venues=10):
+  import os, time, tempfile, standin, fetch, metrics
+  global venue_cache
+  server = standin.StandIn()
+  for v in range(venues):
+    server.Add('/venue/%s' % v, '<html><body><div class="venueAddress">%s Main St<a href="/city"><br />Toronto</a></div></body></html>' % v)
+  server.Start()
+  fetch.shared = fetch.Fetcher(directory=tempfile.mkdtemp(), host_map={ 'www.librarything.com' : server.address })
+  venue_cache = cache.ResultCache('librarything_venues', directory=tempfile.mkdtemp())
+  fd, path = tempfile.mkstemp(suffix='.rss')
+  f = os.fdopen(fd, 'wb')
+  WriteSyntheticFeed(f, items, venues)
+  f.close()
+  try:
+    parser = LibraryThingParser(url='http://www.librarything.com/rss/events/location/toronto', tz_source='eastern')
+    baseline = metrics.PeakMemoryBytes()
+    start = time.time()
+    f = open(path, 'rb')
+    count = 0
+    for evt in parser.IterEvents(f):
+      count += 1
+    f.close()
+    elapsed = time.time() - start
+    peak = metrics.PeakMemoryBytes()
+    print '%s items (%.1f MB feed) in %.2f s, %.0f items/sec, peak memory %.1f MB (%.1f MB over baseline), %s fetches' % ( count,
+      os.path.getsize(path) / 1048576.0, elapsed, count / elapsed, peak / 1048576.0, ( peak - baseline ) / 1048576.0, parser.fetches )
+  finally:
+    os.remove(path)
+    fetch.shared.pool.Close()
+    server.Stop()
@@ -0,0 +1,145 @@
+import sys, os, json, traceback, Queue
+
+try:
+  import clr
+  clr.AddReference("System")
+  import System
+  IPY = True
+except ImportError:
+  IPY = False
+
+import threadpool
+
+# reads log files and failed-request traces side by side on the cores a role
+# instance otherwise leaves idle. a job is a json-able request naming one of
+# HANDLERS, and what comes back is a json-able partial (counters, histograms,
+# top-k heaps) for the caller to merge.
+# under CPython each worker is a child interpreter, started the way pool.py starts
+# its workers and fed one json line at a time; IronPython has no global lock, so
+# there threads do the same work in-process. either way the partials come back in
+# the order the jobs went out, so a caller that merges them in that order gets
+# what a serial run gets.
+#
+#   for response in Map([ w3clog.MakeRequest(path) for path in paths ], workers=4): ...
+
+HANDLERS = { 'w3c' : ( 'w3clog', 'ReadRequest' ),
+             'failedreq' : ( 'failedreq', 'ReadRequest' ) }
+
+CALL_TIMEOUT_SECONDS = 600
+STOP_GRACE_SECONDS = 2
+
+class LogPoolError(Exception):
+  pass
+
+def Handle(request):
+  module, name = HANDLERS[request['kind']]
+  return getattr(__import__(module), name)(request)
+
+def CpuCount():
+  if IPY:
+    return System.Environment.ProcessorCount
+  try:
+    import multiprocessing
+    return multiprocessing.cpu_count()
+  except ( ImportError, NotImplementedError ):
+    return 1
+
+def Map(requests, workers=None):
+  # the responses, in request order. a job that fails fails the lot, since a
+  # partial total would look like a quiet hour
+  requests = list(requests)
+  workers = min(workers or CpuCount(), len(requests))
+  if workers <= 1 or IPY:
+    outcomes = threadpool.Map(Handle, requests, max(workers, 1))
+  else:
+    outcomes = MapProcesses(requests, workers)
+  responses = []
+  for outcome in outcomes:
+    if outcome.error is not None:
+      raise LogPoolError(outcome.error)
+    responses.append(outcome.value)
+  return responses
+
+def MapProcesses(requests, workers):
+  import pool
+  started = [ pool.WorkerProcess('worker', script='logpool.py') for i in range(workers) ]
+  idle = Queue.Queue()
+  try:
+    for worker in started:
+      worker.WaitReady()
+      idle.put(worker)
+    def Call(request):
+      worker = idle.get()
+      try:
+        response = worker.Call(request, CALL_TIMEOUT_SECONDS)
+      finally:
+        idle.put(worker)
+      if 'error' in response:
+        raise LogPoolError(response['error'])
+      return response
+    return threadpool.Map(Call, requests, workers)
+  finally:
+    for worker in started:
+      worker.Stop(STOP_GRACE_SECONDS)
+
+def ServeWorker():
+  out = sys.stdout
+  sys.stdout = open(os.devnull, 'w')
+  import pool
+  sys.path[0:0] = pool.SearchPaths()
+  out.write(json.dumps({ 'ready' : True }) + '\n')
+  out.flush()
+  while True:
+    line = sys.stdin.readline()
+    if not line:
+      return
+    try:
+      response = Handle(json.loads(line))
+    except:
+      response = { 'error' : traceback.format_exc() }
+    out.write(json.dumps(response, encoding='latin-1') + '\n')   # log bytes, whatever they are
+    out.flush()
+
+def test():
+  import tempfile, shutil, w3clog
+  directory = tempfile.mkdtemp(prefix='logpool-')
+  try:
+    paths = []
+    for n in range(5):
+      path = os.path.join(directory, 'u_ex1010%02d.log' % ( n + 20 ))
+      f = open(path, 'wb')
+      f.write('#Fields: date time c-ip cs-uri-stem sc-status sc-bytes time-taken\n')
+      for i in range(400 + n * 50):
+        if i == 200:
+          f.write('#Fields: date time cs-uri-stem c-ip time-taken sc-status\n')
+        uri = '/services/%s/html' % ( i * 7 % 90 )
+        if i % 97 == 0:
+          uri = '/caf\xe9/%s' % n   # not ascii, not utf-8 either
+        ip = '10.0.%s.%s' % ( n, i % 70 )
+        status = ( 200, 200, 304, 400, 404, 500 )[i % 6]
+        if i < 200:
+          f.write('2010-10-%s %02d:%02d:00 %s %s %s %s %s\n' % ( n + 20, i % 24, i % 60, ip, uri, status, i * 13, i * 31 % 1700 ))
+        else:
+          f.write('2010-10-%s %02d:%02d:00 %s %s %s %s\n' % ( n + 20, i % 24, i % 60, uri, ip, i * 31 % 1700, status ))
+      f.close()
+      paths.append(path)
+    serial = w3clog.Aggregates(top=20)
+    serial.AddFiles(paths)
+    one = w3clog.ReadFiles(paths, workers=1, top=20)
+    many = w3clog.ReadFiles(paths, workers=3, top=20)
+    expected = serial.Tables() + serial.Charts()
+    assert one.Tables() + one.Charts() == expected
+    assert many.Tables() + many.Charts() == expected
+    assert many.lines == serial.lines == 2500
+    try:
+      Map([ w3clog.MakeRequest(os.path.join(directory, 'missing.log')), w3clog.MakeRequest(paths[0]) ], workers=2)
+      assert False
+    except LogPoolError:
+      pass
+  finally:
+    shutil.rmtree(directory)
+  print 'logpool: ok'
+
+if __name__ == '__main__':
+  if sys.argv[1:2] == [ 'worker' ]:
+    ServeWorker()
@@ -0,0 +1,255 @@
+import sys, os, time, datetime, json, atexit, threading, traceback
+
+try:
+  import clr
+  IPY = True
+except ImportError:
+  IPY = False
+
+if IPY:
+  clr.AddReference("System")
+  clr.AddReference("mscorlib")
+  import System
+
+  clr.AddReference("ElmcityUtils")
+  import ElmcityUtils
+
+import metrics, icswriter
+
+# one log sink per process, shared by the parsers, fusecal.py and the admin
+# scripts, in place of a table write per message. records are queued and a
+# background thread writes them a batch at a time, stamped with the time they
+# were logged rather than written. when the table falls behind, info records are
+# turned away first, then warnings; exceptions and priority records are only
+# lost if the queue is full of nothing else. the sink is closed at exit, and
+# the scripts that run in a hosted engine close it themselves at the end.
+#
+# LogMsg and PriorityLogMsg take the same arguments as their GenUtils namesakes,
+# and WriteLogMessage the same as TableStorage's: its rows are neither titled nor
+# filtered by loglevel, as they never were.
+# ELMCITY_LOG_FILE sends records to a file instead, one json object per line,
+# which is what the tests read back.
+
+BATCH_SIZE = 100
+FLUSH_SECONDS = 2
+MAX_PENDING = 10000
+HIGH_WATER = 2000    # past this many queued records, only warnings and worse get in
+
+LEVELS = { 'info' : 0, 'status' : 1, 'warning' : 1, 'exception' : 2 }
+PRIORITY_LEVEL = 3
+
+class LogSink(metrics.BatchingSink):
+
+  def __init__(self, write, batch_size=BATCH_SIZE, flush_seconds=FLUSH_SECONDS, max_pending=MAX_PENDING, high_water=HIGH_WATER, min_level=0):
+    metrics.BatchingSink.__init__(self, write, batch_size, flush_seconds, max_pending)
+    self.high_water = high_water
+    self.min_level = min_level
+    self.dropped_by_type = {}
+    self.last_ticks = 0
+    self.lock = threading.Lock()
+
+  def Ticks(self):
+    self.lock.acquire()   # distinct, so they can be row keys
+    try:
+      self.last_ticks = max(icswriter.Ticks(datetime.datetime.utcnow()), self.last_ticks + 1)
+      return self.last_ticks
+    finally:
+      self.lock.release()
+
+  def Log(self, type, message, data=None, priority=False, raw=False):
+    level = ( priority or raw ) and PRIORITY_LEVEL or LEVELS.get(type, 1)
+    if level < self.min_level:
+      return
+    self.Put({ 'ticks' : self.Ticks(), 'type' : type, 'message' : message, 'data' : data, 'priority' : priority, 'raw' : raw, 'level' : level })
+
+  def Drop(self, record):
+    self.dropped += 1
+    self.dropped_by_type[record['type']] = self.dropped_by_type.get(record['type'], 0) + 1
+
+  def Admit(self, record):
+    pending = len(self.pending)
+    if pending >= self.high_water and record['level'] < LEVELS['status']:
+      self.Drop(record)
+      return False
+    if pending < self.max_pending:
+      return True
+    # full: make room by dropping the oldest of the least important records queued
+    levels = [queued['level'] for queued in self.pending]
+    lowest = min(levels)
+    if lowest < record['level']:
+      self.Drop(self.pending.pop(levels.index(lowest)))
+      return True
+    self.Drop(record)
+    return False
+
+# writers take a list of records
+
+class TableLogWriter:
+
+  # the rows TableStorage.WriteLogMessage writes, titled the way GenUtils.LogMsg titles them unless raw
+
+  def __init__(self):
+    self.ts = None
+    self.prefix = None
+
+  def __call__(self, records):
+    if self.ts is None:
+      self.ts = ElmcityUtils.TableStorage.MakeDefaultTableStorage()
+      self.prefix = ElmcityUtils.GenUtils.MakeLogMsgTitle('')
+    for i, record in enumerate(records):
+      table = record['priority'] and ElmcityUtils.Configurator.azure_priority_log_table or ElmcityUtils.Configurator.azure_log_table
+      entity = System.Collections.Generic.Dictionary[str, object]()
+      entity['PartitionKey'] = 'log'
+      entity['RowKey'] = str(record['ticks'])
+      entity['type'] = record['type'] or ''
+      entity['message'] = ( not record.get('raw') and self.prefix or '' ) + ( record['message'] or '' )
+      entity['data'] = record['data'] or ''
+      try:
+        self.ts.InsertEntity(table, entity)
+      except:
+        raise metrics.PartialWrite(records[i:], traceback.format_exc())
+
+class FileLogWriter:
+
+  def __init__(self, path):
+    self.path = path
+
+  def __call__(self, records):
+    f = open(self.path, 'ab')
+    try:
+      for record in records:
+        f.write(json.dumps(record) + '\n')
+    finally:
+      f.close()
+
+class PrintLogWriter:
+
+  # plain python without a log file: the lines LogMsg always printed
+
+  def __call__(self, records):
+    for record in records:
+      sys.stdout.write('%s, %s, %s\n' % ( record['type'], record['message'], record['data'] ))
+
+def ReadLogFile(path):
+  records = []
+  f = open(path, 'rb')
+  try:
+    for line in f:
+      records.append(json.loads(line))
+  finally:
+    f.close()
+  return records
+
+def MinLevel():
+  # ElmcityUtils.Logger's rule: loglevel 2 skips info, 3 skips status and warnings too
+  try:
+    loglevel = int(ElmcityUtils.GenUtils.GetSettingsFromAzureTable()['loglevel'])
+  except:
+    return 0
+  return max(loglevel - 1, 0)
+
+def DefaultSink():
+  path = os.environ.get('ELMCITY_LOG_FILE')
+  if path:
+    return LogSink(FileLogWriter(path))
+  if IPY:
+    return LogSink(TableLogWriter(), min_level=MinLevel())
+  return LogSink(PrintLogWriter())
+
+sink = None
+sink_lock = threading.Lock()
+
+def Sink():
+  global sink
+  if sink is None:
+    sink_lock.acquire()
+    try:
+      if sink is None:
+        sink = DefaultSink()
+    finally:
+      sink_lock.release()
+  return sink
+
+def SetSink(new_sink):
+  global sink
+  old = sink
+  sink = new_sink
+  return old
+
+def Log(type, message, data=None, priority=False):
+  Sink().Log(type, message, data, priority)
+
+def LogMsg(type, title, blurb=None):
+  Sink().Log(type, title, blurb)
+
+def PriorityLogMsg(type, title, blurb=None):
+  Sink().Log(type, title, blurb, priority=True)
+
+def WriteLogMessage(type, message, data=None):
+  Sink().Log(type, message, data, raw=True)
+
+def Flush():
+  if sink is not None:
+    sink.Flush()
+
+def Close():
+  # stops the writer thread too, for a hosted engine that is about to be shut down
+  if sink is not None:
+    sink.Close()
+
+atexit.register(Close)   # stops the writer before the interpreter tears down under it
+
+def test():
+  import tempfile
+  fd, path = tempfile.mkstemp(suffix='.log')
+  os.close(fd)
+  test_sink = LogSink(FileLogWriter(path), batch_size=10, flush_seconds=60, max_pending=6, high_water=4)
+  old = SetSink(test_sink)
+  test_sink.condition.acquire()   # hold off the writer so the queue fills
+  try:
+    for i in range(5):
+      LogMsg('info', 'info %s' % i)
+    LogMsg('warning', 'warning')
+    LogMsg('exception', 'exception', 'traceback')
+    PriorityLogMsg('exception', 'priority')
+    PriorityLogMsg('exception', 'priority again')
+  finally:
+    test_sink.condition.release()
+  try:
+    test_sink.Close()
+    records = ReadLogFile(path)
+    messages = [record['message'] for record in records]
+    # info 4 met the high water mark, then the priority records pushed out the two oldest infos
+    assert messages == [ 'info 2', 'info 3', 'warning', 'exception', 'priority', 'priority again' ], messages
+    assert test_sink.dropped_by_type == { 'info' : 3 }, test_sink.dropped_by_type
+    ticks = [record['ticks'] for record in records]
+    assert ticks == sorted(ticks) and len(set(ticks)) == len(ticks)
+    assert records[-1]['priority'] and records[3]['data'] == 'traceback'
+  finally:
+    SetSink(old)
+    os.remove(path)
+  written = []
+  def Flaky(records):
+    if not written:   # the table goes away after two rows of the first batch
+      written.extend(records[:2])
+      raise metrics.PartialWrite(records[2:], 'InsertEntity failed\n')
+    written.extend(records)
+  flaky = LogSink(Flaky, batch_size=5, flush_seconds=0.05)
+  for i in range(5):
+    flaky.Log('info', 'row %s' % i)
+  deadline = time.time() + 2
+  while len(written) < 5 and time.time() < deadline:
+    time.sleep(0.01)
+  flaky.Close()
+  assert [record['message'] for record in written] == [ 'row %s' % i for i in range(5) ], written
+  kept = metrics.MemoryWriter()
+  filtered = LogSink(kept, min_level=2)   # loglevel 3
+  old = SetSink(filtered)
+  try:
+    LogMsg('warning', 'skipped')
+    WriteLogMessage('/reset/elmcity', '')
+    filtered.Close()
+  finally:
+    SetSink(old)
+  assert [( record['type'], record['raw'], record['priority'] ) for record in kept.rows] == [ ( '/reset/elmcity', True, False ) ], kept.rows
+  print 'logsink: ok'
@@ -0,0 +1,329 @@
+import sys, time, datetime, socket, threading, traceback
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+try:
+  import clr
+  IPY = True
+except ImportError:
+  IPY = False
+
+if IPY:
+  clr.AddReference("System")
+  clr.AddReference("mscorlib")
+  import System
+
+  clr.AddReference("ElmcityUtils")
+  import ElmcityUtils
+
+import icswriter
+
+# per-parse timings and counts. an EventParser keeps a Sample, adds the time it
+# spends in each phase and counts what goes in and out, and hands it to the sink
+# when it is done. the sink queues samples as rows shaped like the ones
+# ElmcityUtils.Monitor stores (PartitionKey 'monitor', RowKey ticks, HostName,
+# ProcName) and a background thread writes them a batch at a time, so monitor.py
+# can chart them next to the process counters.
+
+PROC_NAME = 'fusecal'
+CACHE_PROC_NAME = 'fusecal_cache'   # cache counters, kept apart from the per-parse rows
+MONITOR_TABLE = 'monitor'
+
+PHASES = ( 'fetch', 'parse', 'filter', 'build', 'serialize' )
+COUNTERS = ( 'fetches', 'bytes_fetched', 'events_in', 'events_out' )
+
+BATCH_SIZE = 50
+FLUSH_SECONDS = 60
+MAX_PENDING = 5000   # rows held while the table can't be written, then new ones are dropped
+
+def PeakMemoryBytes():
+  if sys.platform == 'cli':
+    return System.Diagnostics.Process.GetCurrentProcess().PeakWorkingSet64
+  if resource is not None:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+      return peak
+    return peak * 1024   # linux reports kilobytes
+  return 0
+
+hostname = None
+
+def HostName():
+  global hostname
+  if hostname is None:
+    if IPY:
+      hostname = System.Net.Dns.GetHostName()
+    else:
+      hostname = socket.gethostname()
+  return hostname
+
+class Sample:
+
+  def __init__(self, name):
+    self.name = name
+    self.seconds = {}
+    self.counters = {}
+    self.lock = threading.Lock()   # fetches are timed and counted from several threads
+
+  def __repr__(self):
+    return "<Sample: %s, %s>" % ( self.name, ', '.join(['%s=%s' % item for item in sorted(self.Row().items())]) )
+
+  def Time(self, phase, seconds):
+    self.lock.acquire()
+    try:
+      self.seconds[phase] = self.seconds.get(phase, 0.0) + seconds
+    finally:
+      self.lock.release()
+
+  def Count(self, counter, n=1):
+    self.lock.acquire()
+    try:
+      self.counters[counter] = self.counters.get(counter, 0) + n
+    finally:
+      self.lock.release()
+
+  def Timed(self, phase, func, *args):
+    start = time.time()
+    try:
+      return func(*args)
+    finally:
+      self.Time(phase, time.time() - start)
+
+  def Row(self):
+    row = { 'ProcName' : PROC_NAME, 'HostName' : HostName(), 'parser' : self.name }
+    for phase in PHASES:
+      row[phase + '_ms'] = int(round(self.seconds.get(phase, 0.0) * 1000))
+    for counter in COUNTERS:
+      row[counter] = self.counters.get(counter, 0)
+    for name, value in self.counters.items():
+      row[name] = value
+    return row
+
+# writers take a list of rows
+
+class MonitorTableWriter:
+
+  def __init__(self, table=MONITOR_TABLE):
+    self.table = table
+    self.ts = None
+    self.last_ticks = 0
+
+  def RowKey(self):
+    # utc ticks like Monitor.StoreSnapshot, kept distinct within a batch
+    ticks = max(icswriter.Ticks(datetime.datetime.utcnow()), self.last_ticks + 1)
+    self.last_ticks = ticks
+    return str(ticks)
+
+  def __call__(self, rows):
+    if self.ts is None:
+      self.ts = ElmcityUtils.TableStorage.MakeDefaultTableStorage()
+    for i, row in enumerate(rows):
+      entity = System.Collections.Generic.Dictionary[str, object]()
+      entity['PartitionKey'] = self.table
+      entity['RowKey'] = self.RowKey()
+      for name, value in row.items():
+        entity[name] = value
+      try:
+        self.ts.InsertEntity(self.table, entity)
+      except:
+        raise PartialWrite(rows[i:], traceback.format_exc())
+
+class PrintWriter:
+
+  # off azure: one line per row
+
+  def __init__(self, out=None):
+    self.out = out
+
+  def __call__(self, rows):
+    out = self.out or sys.stdout
+    for row in rows:
+      out.write('%s\n' % ', '.join(['%s=%s' % item for item in sorted(row.items())]))
+
+class MemoryWriter:
+
+  def __init__(self):
+    self.rows = []
+
+  def __call__(self, rows):
+    self.rows.extend(rows)
+
+class PartialWrite(Exception):
+
+  # raised by a writer that stopped partway through a batch, with the rows it didn't write
+
+  def __init__(self, rows, details):
+    Exception.__init__(self, details)
+    self.rows = rows
+    self.details = details
+
+class BatchingSink:
+
+  def __init__(self, write, batch_size=BATCH_SIZE, flush_seconds=FLUSH_SECONDS, max_pending=MAX_PENDING):
+    self.write = write
+    self.batch_size = batch_size
+    self.flush_seconds = flush_seconds
+    self.max_pending = max_pending
+    self.pending = []
+    self.dropped = 0
+    self.writing = False
+    self.closed = False
+    self.condition = threading.Condition()
+    self.thread = None
+
+  def Admit(self, row):
+    # called with the lock held. subclasses can make room or turn rows away here
+    if len(self.pending) >= self.max_pending:
+      self.dropped += 1
+      return False
+    return True
+
+  def Put(self, row):
+    self.condition.acquire()
+    try:
+      if not self.Admit(row):
+        return
+      self.pending.append(row)
+      if self.thread is None:
+        self.thread = threading.Thread(target=self.Run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+      if len(self.pending) >= self.batch_size:
+        self.condition.notifyAll()
+    finally:
+      self.condition.release()
+
+  def Take(self):
+    rows = self.pending[:self.batch_size]
+    del self.pending[:self.batch_size]
+    return rows
+
+  def Write(self, rows):
+    # the rows that didn't get written, so a retry doesn't write the others twice
+    try:
+      self.write(rows)
+      return []
+    except PartialWrite, e:
+      sys.stderr.write('%s: cannot write %s of %s rows\n%s' % ( self.__class__.__name__, len(e.rows), len(rows), e.details ))
+      return e.rows
+    except:
+      sys.stderr.write('%s: cannot write %s rows\n%s' % ( self.__class__.__name__, len(rows), traceback.format_exc() ))
+      return rows
+
+  def Run(self):
+    while True:
+      self.condition.acquire()
+      try:
+        if len(self.pending) < self.batch_size and not self.closed:
+          self.condition.wait(self.flush_seconds)
+        if self.closed:
+          return
+        rows = self.Take()
+        self.writing = bool(rows)
+      finally:
+        self.condition.release()
+      failed = rows and self.Write(rows)
+      if failed:
+        self.Requeue(failed)
+        time.sleep(self.flush_seconds)   # the table is down, don't spin
+      self.condition.acquire()
+      try:
+        self.writing = False
+        self.condition.notifyAll()
+      finally:
+        self.condition.release()
+
+  def Requeue(self, rows):
+    self.condition.acquire()
+    try:
+      room = max(self.max_pending - len(self.pending), 0)
+      self.dropped += max(len(rows) - room, 0)
+      self.pending[0:0] = rows[:room]
+    finally:
+      self.condition.release()
+
+  def Flush(self):
+    # write whatever is queued now, from the calling thread
+    self.condition.acquire()
+    try:
+      while self.writing:
+        self.condition.wait()
+      rows = self.pending
+      self.pending = []
+    finally:
+      self.condition.release()
+    while rows:
+      self.Write(rows[:self.batch_size])
+      rows = rows[self.batch_size:]
+
+  def Close(self):
+    self.condition.acquire()
+    try:
+      self.closed = True
+      self.condition.notifyAll()
+      thread = self.thread
+    finally:
+      self.condition.release()
+    if thread is not None:
+      thread.join()
+    self.Flush()
+
+def DefaultSink():
+  if IPY:
+    return BatchingSink(MonitorTableWriter())
+  return None   # plain python: samples are only kept on the parser unless a sink is set
+
+sink = DefaultSink()
+
+def SetSink(new_sink):
+  global sink
+  old = sink
+  sink = new_sink
+  return old
+
+def Emit(sample):
+  if sink is not None:
+    sink.Put(sample.Row())
+
+def EmitCache(name, counters):
+  if sink is not None:
+    row = { 'ProcName' : CACHE_PROC_NAME, 'HostName' : HostName(), 'cache' : name }
+    row.update(counters)
+    sink.Put(row)
+
+def Flush():
+  if sink is not None:
+    sink.Flush()
+
+def Close():
+  # stops the writer thread too, for a hosted engine that is about to be shut down
+  if sink is not None:
+    sink.Close()
+
+def test():
+  writer = MemoryWriter()
+  test_sink = BatchingSink(writer, batch_size=2, flush_seconds=0.05)
+  old = SetSink(test_sink)
+  try:
+    for i in range(3):
+      sample = Sample('TestParser')
+      sample.Timed('parse', time.sleep, 0.01)
+      sample.Count('events_in', 10)
+      sample.Count('events_out', 7)
+      Emit(sample)
+    deadline = time.time() + 2
+    while len(writer.rows) < 2 and time.time() < deadline:
+      time.sleep(0.01)
+    assert len(writer.rows) >= 2, writer.rows   # a full batch goes without waiting for a flush
+    test_sink.Close()
+    assert len(writer.rows) == 3, writer.rows
+    row = writer.rows[0]
+    assert row['ProcName'] == PROC_NAME and row['parser'] == 'TestParser'
+    assert row['parse_ms'] >= 10 and row['fetch_ms'] == 0
+    assert row['events_in'] == 10 and row['events_out'] == 7 and row['bytes_fetched'] == 0
+  finally:
+    SetSink(old)
+  print 'metrics: ok'
@@ -1,7 +1,6 @@
-import ElmcityEventParser
+import ElmcityEventParser, dateparse, htmlextract
 
-from BeautifulSoup import BeautifulSoup
-import re, urllib2, datetime, traceback
+import datetime, traceback
 
 class MySpaceParser(ElmcityEventParser.EventParser):
 
@@ -11,49 +10,39 @@ class MySpaceParser(ElmcityEventParser.EventParser):
       self.LogMsg("info", "MySpaceParser.Parse", None)
       self.ParsePage()
     except:
-      self.LogMsg('exception', 'MySpaceParser.Parse', traceback.format_exc())
+      self.LogFailure('MySpaceParser.Parse', traceback.format_exc())
 
     self.BuildICS()
 
   def ParsePage(self):
 
-    html = self.GetTourPage()
+    page = self.GetTourPage()
 
-    if not html:
+    if not page:
       return 
 
-    soup = BeautifulSoup(html)
-    items = soup.findAll("div", {'class' : 'eventitem'} )
+    html = page.body
 
-    for item in items:
-      
-      title = item.findAll('div', { 'class' : 'event-titleinfo' })[0].text
-      title = title.replace('&nbsp;','')
-
-      url = item.findAll('a', { 'href' : True } )[0]['href']
+    self.Source(self.url, html)
 
-      start = item.findAll('div', { 'class' : 'event-cal' })[0].text
+    if self.Unchanged():
+      return
 
-      start = self.ExpandTodayAndTomorrow(start)   # normalize to, e.g., Thu, July 08 10:00 PM
-
-      dtstart = self.ParseDateTime(start, '%a, %B %d @ %I:%M %p')
+    # only the event blocks become nodes, the rest of the page streams past
+    items = htmlextract.Extract(html, ( 'div', { 'class' : 'eventitem' } ), content_type=page.headers.get('content-type'))
 
+    for item in items:
+      
+      title = item.Find('div', { 'class' : 'event-titleinfo' }).Text()
+      title = title.replace('&nbsp;','')
 
-      this_year = datetime.datetime.now().year
-      this_month = datetime.datetime.now().month
+      url = item.Find('a', { 'href' : True } ).Get('href')
 
-      if ( dtstart.month < this_month ):
-        year = this_year + 1
-      else:
-        year = this_year
+      start = item.Find('div', { 'class' : 'event-cal' }).Text()
 
-      month = dtstart.month
-      day   = dtstart.day
-      hour  = dtstart.hour
-      min   = dtstart.minute
-      sec   = dtstart.second
+      start = dateparse.ExpandRelative(start, '%a, %B %d')   # normalize to, e.g., Thu, July 08 10:00 PM
 
-      dtstart = datetime.datetime(year,month,day,hour,min,sec)
+      dtstart = self.ParseDateTime(start, '%a, %B %d @ %I:%M %p', infer_year=True)
       
       evt = ElmcityEventParser.Event()
       evt.title = title
@@ -65,31 +54,18 @@ class MySpaceParser(ElmcityEventParser.EventParser):
       self.events.append(evt)
 
 
-  def ExpandTodayAndTomorrow(self,start):
-
-    format = '%a, %B %d'
-
-    if ( start.find('Today') == 0 ):
-      dt = datetime.datetime.today()
-      start = start.replace('Today', dt.strftime(format))
-
-    if ( start.find('Tomorrow') == 0 ):
-      dt = datetime.datetime.today() + datetime.timedelta(1)
-      start = start.replace('Tomorrow', dt.strftime(format))
-
-    return start    
+  def Salt(self):
+    return datetime.date.today().isoformat()   # Today and Tomorrow move, so does the inferred year
 
   def GetTourPage(self):
-      html = urllib2.urlopen(self.url).read()
-      soup = BeautifulSoup(html)
-      div = soup.find("div", {"id":"profile_bandschedule"})
-      if (div):
-          a = div.find("a")
-          url = a.get("href")
-          html = urllib2.urlopen(url).read()
-          return html
+      page = self.FetchPage(self.url)
+      divs = htmlextract.Extract(page.body, ( "div", {"id":"profile_bandschedule"} ), limit=1, content_type=page.headers.get('content-type'))   # stops reading there
+      if (divs):
+          a = divs[0].Find("a")
+          url = a.Get("href")
+          return self.FetchPage(url)
       else:
-          return ""
+          return None
 
 def test():
   parser = MySpaceParser(url='http://www.myspace.com/jatobamusic',filter='Vermont',tz_source='eastern')
@@ -0,0 +1,365 @@
+import sys, os, time, socket, threading, traceback, json, Queue, SocketServer
+
+try:
+  import clr
+  clr.AddReference("System")
+  import System
+  IPY = True
+except ImportError:
+  import subprocess
+  IPY = False
+
+# a long-lived pool of warm fusecal workers. each worker is a separate interpreter
+# that imports the ElmcityLib parsers once and then serves Dispatch requests, one
+# json line in and one json line out over its stdin/stdout. the pool listens on a
+# local socket so fusecal.py (run in a fresh engine per request) can hand its work
+# to an already-warm worker instead of reloading everything itself.
+
+POOL_HOST = '127.0.0.1'
+POOL_PORT = 8299
+POOL_SIZE = 4
+MAX_REQUESTS_PER_WORKER = 200    # recycle workers to bound leaks in parsers and libraries
+CONNECT_TIMEOUT_SECONDS = 2
+REQUEST_TIMEOUT_SECONDS = 120
+BATCH_TIMEOUT_SECONDS = 600
+STOP_GRACE_SECONDS = 10          # for a retiring worker to write out its metrics
+
+IPY_EXE = 'e:\\approot\\bin\\ipy.exe'   # console host used when we are running inside a hosted engine
+
+lib_dir = os.path.dirname(os.path.abspath(__file__))
+
+class PoolError(Exception):
+  pass
+
+def Interpreter():
+  exe = os.environ.get('ELMCITY_IPY')
+  if exe:
+    return exe
+  if IPY and not sys.executable.lower().endswith('ipy.exe'):
+    return IPY_EXE
+  return sys.executable
+
+def SearchPaths():
+  local_storage = os.path.dirname(lib_dir)
+  return [ lib_dir, os.path.join(local_storage, 'Lib'), os.path.join(local_storage, 'Lib', 'site-packages') ]
+
+class WorkerProcess:
+
+  def __init__(self, mode='worker', script='pool.py', args=()):
+    args = [ Interpreter(), os.path.join(lib_dir, script), mode ] + list(args)
+    if IPY:
+      info = System.Diagnostics.ProcessStartInfo(args[0], ' '.join(['"%s"' % arg for arg in args[1:]]))
+      info.UseShellExecute = False
+      info.CreateNoWindow = True
+      info.RedirectStandardInput = True
+      info.RedirectStandardOutput = True
+      self.process = System.Diagnostics.Process.Start(info)
+    else:
+      self.process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    self.served = 0
+    self.started = time.time()
+
+  def Send(self, line):
+    if IPY:
+      self.process.StandardInput.WriteLine(line)
+      self.process.StandardInput.Flush()
+    else:
+      self.process.stdin.write(line + '\n')
+      self.process.stdin.flush()
+
+  def Receive(self):
+    if IPY:
+      line = self.process.StandardOutput.ReadLine()
+    else:
+      line = self.process.stdout.readline()
+    if not line:
+      raise PoolError('worker exited')
+    return json.loads(line)
+
+  def WaitReady(self):
+    return self.Receive()
+
+  def Call(self, request, timeout=REQUEST_TIMEOUT_SECONDS):
+    timer = threading.Timer(timeout, self.Kill)
+    timer.start()
+    try:
+      self.Send(json.dumps(request))
+      response = self.Receive()
+    finally:
+      timer.cancel()
+    self.served += 1
+    return response
+
+  def Stop(self, grace=STOP_GRACE_SECONDS):
+    # closing stdin lets the worker flush and exit by itself, Kill is for one that doesn't
+    try:
+      if IPY:
+        self.process.StandardInput.Close()
+        self.process.WaitForExit(int(grace * 1000))
+      else:
+        self.process.stdin.close()
+        deadline = time.time() + grace
+        while self.process.poll() is None and time.time() < deadline:
+          time.sleep(0.1)
+    except:
+      pass
+    self.Kill()
+
+  def Kill(self):
+    try:
+      if IPY:
+        if not self.process.HasExited:
+          self.process.Kill()
+      elif self.process.poll() is None:
+        self.process.kill()
+    except:
+      pass
+
+class Pool:
+
+  def __init__(self, size=POOL_SIZE, max_requests=MAX_REQUESTS_PER_WORKER):
+    self.size = size
+    self.max_requests = max_requests
+    self.idle = Queue.Queue()
+    self.recycled = 0
+    self.workers = []    # every live worker, idle or busy, so Close can reach them all
+    self.closed = False
+    self.lock = threading.Lock()
+    workers = [self.Start() for i in range(size)]   # start them all, then wait, so they warm up in parallel
+    for worker in workers:
+      worker.WaitReady()
+      self.idle.put(worker)
+
+  def Start(self):
+    worker = WorkerProcess()
+    self.lock.acquire()
+    try:
+      self.workers.append(worker)
+      closed = self.closed
+    finally:
+      self.lock.release()
+    if closed:
+      worker.Kill()
+      raise PoolError('pool closed')
+    return worker
+
+  def Discard(self, worker):
+    self.lock.acquire()
+    try:
+      if worker in self.workers:
+        self.workers.remove(worker)
+    finally:
+      self.lock.release()
+
+  def Call(self, request):
+    # the wait for a worker counts against the request's timeout, which is what the client allows
+    timeout = request.get('batch') is not None and BATCH_TIMEOUT_SECONDS or REQUEST_TIMEOUT_SECONDS
+    deadline = time.time() + timeout
+    try:
+      worker = self.idle.get(True, timeout)
+    except Queue.Empty:
+      return { 'error' : 'no idle worker after %s seconds' % timeout }
+    remaining = deadline - time.time()
+    if remaining <= 0:
+      self.idle.put(worker)
+      return { 'error' : 'no idle worker after %s seconds' % timeout }
+    try:
+      response = worker.Call(request, remaining)
+    except:
+      self.Retire(worker)
+      return { 'error' : traceback.format_exc() }
+    if worker.served >= self.max_requests:
+      self.Retire(worker)
+    else:
+      self.idle.put(worker)
+    return response
+
+  def Retire(self, worker):
+    t = threading.Thread(target=self.Replace, args=(worker,))
+    t.setDaemon(True)
+    t.start()
+
+  def Replace(self, worker):
+    worker.Stop()
+    self.Discard(worker)
+    self.recycled += 1
+    while not self.closed:
+      try:
+        fresh = self.Start()
+        fresh.WaitReady()
+        self.idle.put(fresh)
+        return
+      except:
+        if self.closed:
+          return
+        sys.stderr.write('pool: cannot start worker\n%s' % traceback.format_exc())
+        time.sleep(5)
+
+  def Close(self):
+    # busy workers too: a request still running on one fails, rather than outliving the pool
+    self.lock.acquire()
+    try:
+      self.closed = True
+      workers = self.workers
+      self.workers = []
+    finally:
+      self.lock.release()
+    for worker in workers:
+      worker.Kill()
+    while True:
+      try:
+        self.idle.get_nowait()
+      except Queue.Empty:
+        return
+
+class DispatchHandler(SocketServer.StreamRequestHandler):
+
+  def handle(self):
+    line = self.rfile.readline()
+    if not line:
+      return
+    try:
+      request = json.loads(line)
+    except:
+      response = { 'error' : traceback.format_exc() }
+    else:
+      response = self.server.pool.Call(request)
+    self.wfile.write(json.dumps(response) + '\n')
+
+class PoolServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+
+  daemon_threads = True
+  allow_reuse_address = False   # the bind is what keeps a second pool from starting
+
+  def __init__(self, pool, host=POOL_HOST, port=POOL_PORT):
+    SocketServer.TCPServer.__init__(self, (host, port), DispatchHandler)
+    self.pool = pool
+
+def MakeRequest(url, filter=None, tz_source=None, tz_dest=None):
+  return { 'url' : url, 'filter' : filter, 'tz_source' : tz_source, 'tz_dest' : tz_dest }
+
+def Send(request, host=POOL_HOST, port=POOL_PORT, timeout=REQUEST_TIMEOUT_SECONDS):
+  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  sock.settimeout(CONNECT_TIMEOUT_SECONDS)
+  try:
+    sock.connect((host, port))
+    sock.settimeout(timeout + CONNECT_TIMEOUT_SECONDS)   # past the pool's own deadline, so its answer gets here
+    sock.sendall(json.dumps(request) + '\n')
+    chunks = []
+    while True:
+      chunk = sock.recv(65536)
+      if not chunk:
+        break
+      chunks.append(chunk)
+      if chunk.endswith('\n'):
+        break
+  finally:
+    sock.close()
+  response = json.loads(''.join(chunks))
+  if 'error' in response:
+    raise PoolError(response['error'])
+  return response
+
+def PoolDispatch(url=None, filter=None, tz_source=None, tz_dest=None, host=POOL_HOST, port=POOL_PORT):
+  return Send(MakeRequest(url, filter, tz_source, tz_dest), host, port)['ics']
+
+# the whole batch goes to one worker, which runs it concurrently over its own
+# connections and parsers (see dispatch.DispatchBatch)
+
+def PoolDispatchBatch(requests, host=POOL_HOST, port=POOL_PORT):
+  return Send({ 'batch' : [ list(request) for request in requests ] }, host, port, BATCH_TIMEOUT_SECONDS)['results']
+
+def StartPool():
+  args = [ Interpreter(), os.path.join(lib_dir, 'pool.py'), 'serve' ]
+  if IPY:
+    info = System.Diagnostics.ProcessStartInfo(args[0], '"%s" %s' % ( args[1], args[2] ) )
+    info.UseShellExecute = False
+    info.CreateNoWindow = True
+    System.Diagnostics.Process.Start(info)
+  else:
+    subprocess.Popen(args)
+
+def Serve(host=POOL_HOST, port=POOL_PORT, size=POOL_SIZE):
+  server = PoolServer(None, host, port)   # bind first: if another pool owns the port, don't start workers
+  server.pool = Pool(size)
+  try:
+    server.serve_forever()
+  finally:
+    server.pool.Close()
+
+def ServeWorker():
+  out = sys.stdout
+  sys.stdout = open(os.devnull, 'w')   # parsers print their events, keep that off the protocol channel
+  sys.path[0:0] = SearchPaths()
+  import dispatch, metrics, logsink, cache
+  loaded = dispatch.Warm()
+  out.write(json.dumps({ 'ready' : loaded }) + '\n')
+  out.flush()
+  while True:
+    line = sys.stdin.readline()
+    if not line:
+      cache.Report(force=True)
+      metrics.Flush()
+      logsink.Flush()
+      return
+    try:
+      r = json.loads(line)
+      if r.get('batch') is not None:
+        response = { 'results' : dispatch.DispatchBatch(r['batch']) }
+      else:
+        response = { 'ics' : dispatch.Dispatch(url=r['url'], filter=r['filter'], tz_source=r['tz_source'], tz_dest=r['tz_dest']) }
+    except:
+      response = { 'error' : traceback.format_exc() }
+    out.write(json.dumps(response) + '\n')
+    out.flush()
+
+# cold: a fresh interpreter per request, which is what RunIronPython does today
+# warm: the same request through a running pool
+
+def Benchmark(url, filter=None, tz_source=None, tz_dest=None, n=20):
+  request = MakeRequest(url, filter, tz_source, tz_dest)
+
+  cold = []
+  for i in range(n):
+    start = time.time()
+    worker = WorkerProcess()
+    try:
+      worker.WaitReady()
+      worker.Call(request)
+    finally:
+      worker.Kill()
+    cold.append(time.time() - start)
+
+  server = PoolServer(Pool(size=1), port=0)
+  t = threading.Thread(target=server.serve_forever)
+  t.setDaemon(True)
+  t.start()
+  port = server.server_address[1]
+  warm = []
+  try:
+    for i in range(n):
+      start = time.time()
+      try:
+        Send(request, port=port)
+      except PoolError:
+        pass
+      warm.append(time.time() - start)
+  finally:
+    server.shutdown()
+    server.pool.Close()
+
+  for name, samples in [ ('cold', cold), ('warm', warm) ]:
+    samples.sort()
+    print '%s: n %s, mean %.1f ms, median %.1f ms, p95 %.1f ms' % ( name, len(samples),
+      1000 * sum(samples) / len(samples), 1000 * samples[len(samples) // 2], 1000 * samples[int(len(samples) * .95) - 1] )
+  return cold, warm
+
+if __name__ == '__main__':
+  mode = sys.argv[1:] and sys.argv[1] or 'serve'
+  if mode == 'worker':
+    ServeWorker()
+  elif mode == 'serve':
+    Serve()
+  elif mode == 'benchmark':
+    n = len(sys.argv) > 3 and int(sys.argv[3]) or 20
+    Benchmark(sys.argv[2], n=n)
@@ -0,0 +1,94 @@
+import sys, urlparse, threading, traceback
+
+# which parser handles which site. each entry names the module and class of an
+# ElmcityEventParser subclass, the host suffixes it handles, and what it can do.
+# entries are declared here rather than on the classes themselves so that finding
+# a parser never imports one: only the module that matches a request gets loaded.
+#
+# lookups walk a trie of reversed host labels (com -> myspace -> www), so the cost
+# depends on the length of the host, not on how many parsers are registered.
+
+class ParserInfo:
+
+  def __init__(self, module, classname, hosts, conditional_get=False, batch=False, max_concurrency=1, ttl_seconds=3600, stale_seconds=86400):
+    self.module = module
+    self.classname = classname
+    self.hosts = hosts
+    self.conditional_get = conditional_get    # honors ETag / If-Modified-Since on its fetches
+    self.batch = batch                        # safe to run alongside other requests in one process
+    self.max_concurrency = max_concurrency    # upper bound on simultaneous fetches against the site
+    self.ttl_seconds = ttl_seconds            # how long a built calendar is served without rebuilding
+    self.stale_seconds = stale_seconds        # after that, how long it may be served while a rebuild runs
+    self.parser_class = None
+
+  def __repr__(self):
+    return "<ParserInfo: %s.%s, %s>" % (self.module, self.classname, ','.join(self.hosts))
+
+  def Load(self):
+    if self.parser_class is None:
+      module = __import__(self.module)
+      self.parser_class = getattr(module, self.classname)
+    return self.parser_class
+
+parsers = []
+
+index = {}
+
+lock = threading.Lock()
+
+def Register(info):
+  lock.acquire()
+  try:
+    parsers.append(info)
+    for host in info.hosts:
+      node = index
+      for label in reversed(host.lower().strip('.').split('.')):
+        node = node.setdefault(label, {})
+      node[None] = info   # None can't collide with a label
+  finally:
+    lock.release()
+  return info
+
+def HostOf(url):
+  host = urlparse.urlparse(url)[1].lower()
+  if '@' in host:
+    host = host.split('@')[-1]
+  return host.split(':')[0]
+
+def LookupHost(host):
+  node = index
+  match = None
+  for label in reversed(host.lower().strip('.').split('.')):
+    node = node.get(label)
+    if node is None:
+      break
+    match = node.get(None, match)
+  return match
+
+def Lookup(url):
+  if not url:
+    return None
+  return LookupHost(HostOf(url))
+
+def LoadAll():
+  loaded = []
+  for info in parsers:
+    try:
+      info.Load()
+      loaded.append(info.module)
+    except:
+      sys.stderr.write('registry.LoadAll: cannot load %s\n%s' % ( info, traceback.format_exc() ) )
+  return loaded
+
+# all three keep their working state on the parser object, and what they share
+# with other requests (the fetcher, the result and snapshot caches, timezones,
+# compiled filters) is behind locks, so they can be batched
+
+Register(ParserInfo('myspace', 'MySpaceParser', ['myspace.com'], conditional_get=True, batch=True, ttl_seconds=6*3600))
+Register(ParserInfo('libraryinsight', 'LibraryInsightParser', ['libraryinsight.com'], conditional_get=True, batch=True, max_concurrency=4))
+Register(ParserInfo('librarything', 'LibraryThingParser', ['librarything.com'], conditional_get=True, batch=True, max_concurrency=4))
+
+def test():
+  for url in [ 'http://www.myspace.com/jatobamusic', 'http://www.libraryinsight.com/calendar.asp?jx=ea',
+               'http://www.librarything.com/rss/events/location/toronto', 'http://notmyspace.com/', 'http://example.com/myspace.com' ]:
+    print url, Lookup(url)
@@ -0,0 +1,208 @@
+import math, heapq, random
+
+# fixed-size summaries of streams too big, or too varied, to count exactly.
+#
+# SpaceSaving keeps counts for at most capacity keys. a key that arrives when
+# the table is full takes the place of the smallest count and inherits it as
+# its error, so a count can be over by at most its error and never under, and
+# no error exceeds total / capacity. any key more frequent than that is in the
+# table. it behaves like a dict of counts for the counts[key] = counts.get(key, 0) + n
+# idiom, so code written against a dict can count into one unchanged.
+#
+# LogHistogram puts values in buckets whose bounds grow by a fixed ratio, as HDR
+# histograms do, so any quantile it reports is within relative_error of a value
+# actually seen, with one bucket per step of that ratio from 1 to the largest value.
+#
+# both merge, which is how partials from separate files or workers combine.
+
+def Capacity(error):
+  # the table size that keeps every count within error * total of the truth
+  return int(math.ceil(1.0 / error))
+
+class SpaceSaving:
+
+  def __init__(self, capacity):
+    self.capacity = capacity
+    self.counts = {}
+    self.errors = {}    # key -> the most its count may be over by
+    self.heap = []      # ( count, key ), counts possibly out of date, never above the real one
+    self.total = 0
+
+  def __len__(self):
+    return len(self.counts)
+
+  def __contains__(self, key):
+    return key in self.counts
+
+  def get(self, key, default=0):
+    return self.counts.get(key, default)
+
+  def __setitem__(self, key, count):
+    counts = self.counts
+    if key in counts:
+      self.total += count - counts[key]
+      counts[key] = count
+      return
+    self.total += count
+    if len(counts) < self.capacity:
+      counts[key] = count
+      self.errors[key] = 0
+      heapq.heappush(self.heap, ( count, key ))
+      return
+    floor, victim = self.PopSmallest()
+    del counts[victim]
+    del self.errors[victim]
+    counts[key] = floor + count
+    self.errors[key] = floor
+    heapq.heappush(self.heap, ( floor + count, key ))
+
+  def PopSmallest(self):
+    heap = self.heap
+    while True:
+      count, key = heapq.heappop(heap)
+      current = self.counts[key]
+      if current == count:
+        return count, key
+      heapq.heappush(heap, ( current, key ))
+
+  def Floor(self):
+    # what a key not in a full table may have been counted at
+    if len(self.counts) < self.capacity:
+      return 0
+    return min(self.counts.values())
+
+  def Bound(self):
+    return self.total // self.capacity
+
+  def Top(self, n=None):
+    # ( key, count, error ), most frequent first, ties by key
+    items = [ ( key, count, self.errors[key] ) for key, count in self.counts.iteritems() ]
+    key = lambda item: ( -item[1], item[0] )
+    if n is None:
+      return sorted(items, key=key)
+    return heapq.nsmallest(n, items, key=key)
+
+  def Merge(self, other):
+    floor, other_floor = self.Floor(), other.Floor()
+    merged = []
+    for key in set(self.counts.keys()) | set(other.counts.keys()):
+      count = self.counts.get(key, floor) + other.counts.get(key, other_floor)
+      error = self.errors.get(key, floor) + other.errors.get(key, other_floor)
+      merged.append(( key, count, error ))
+    merged = heapq.nsmallest(self.capacity, merged, key=lambda item: ( -item[1], item[0] ))
+    self.Load(merged)
+    self.total += other.total
+    return self
+
+  def Load(self, items):
+    self.counts = dict([ ( key, count ) for key, count, error in items ])
+    self.errors = dict([ ( key, error ) for key, count, error in items ])
+    self.heap = [ ( count, key ) for key, count, error in items ]
+    heapq.heapify(self.heap)
+
+  def State(self):
+    return { 'capacity' : self.capacity, 'total' : self.total, 'items' : self.Top() }
+
+def SpaceSavingFromState(state, convert=None):
+  sketch = SpaceSaving(state['capacity'])
+  items = state['items']
+  if convert is not None:
+    items = [ ( convert(key), count, error ) for key, count, error in items ]
+  sketch.Load(items)
+  sketch.total = state['total']
+  return sketch
+
+class LogHistogram:
+
+  def __init__(self, relative_error=0.01):
+    self.relative_error = relative_error
+    self.gamma = ( 1 + relative_error ) / ( 1 - relative_error )
+    self.log_gamma = math.log(self.gamma)
+    self.buckets = {}   # index -> count; bucket i holds ( gamma ** (i-1), gamma ** i ], -1 holds values under 1
+    self.count = 0
+    self.max = None
+
+  def Add(self, value, n=1):
+    if value < 1:
+      index = -1
+    else:
+      index = int(math.ceil(math.log(value) / self.log_gamma))
+    self.buckets[index] = self.buckets.get(index, 0) + n
+    self.count += n
+    if self.max is None or value > self.max:
+      self.max = value
+
+  def Value(self, index):
+    if index < 0:
+      return 0
+    return 2 * self.gamma ** index / ( self.gamma + 1 )
+
+  def Quantile(self, q):
+    if not self.count:
+      return None
+    if q >= 1:
+      return self.max
+    rank = q * ( self.count - 1 )
+    seen = 0
+    for index in sorted(self.buckets.keys()):
+      seen += self.buckets[index]
+      if seen > rank:
+        return min(self.Value(index), self.max)
+    return self.max
+
+  def Merge(self, other):
+    assert other.relative_error == self.relative_error
+    for index, count in other.buckets.iteritems():
+      self.buckets[index] = self.buckets.get(index, 0) + count
+    self.count += other.count
+    if other.max is not None and ( self.max is None or other.max > self.max ):
+      self.max = other.max
+    return self
+
+  def State(self):
+    return { 'relative_error' : self.relative_error, 'buckets' : self.buckets.items(), 'count' : self.count, 'max' : self.max }
+
+def LogHistogramFromState(state):
+  histogram = LogHistogram(state['relative_error'])
+  histogram.buckets = dict([ ( index, count ) for index, count in state['buckets'] ])
+  histogram.count = state['count']
+  histogram.max = state['max']
+  return histogram
+
+def test():
+  rnd = random.Random(42)
+  # a few heavy hitters in a long tail of keys seen once or twice
+  stream = [ 'heavy%s' % ( i % 5 ) for i in range(5000) ] + [ 'tail%s' % rnd.randint(0, 20000) for i in range(20000) ]
+  rnd.shuffle(stream)
+  exact = {}
+  sketch = SpaceSaving(Capacity(0.01))
+  for key in stream:
+    exact[key] = exact.get(key, 0) + 1
+    sketch[key] = sketch.get(key, 0) + 1
+  assert len(sketch) == 100 and sketch.total == len(stream)
+  for key, count, error in sketch.Top():
+    assert exact[key] <= count <= exact[key] + error and error <= sketch.Bound(), ( key, exact[key], count, error )
+  assert sorted([ key for key, count, error in sketch.Top(5) ]) == [ 'heavy%s' % i for i in range(5) ]
+  halves = [ SpaceSaving(100), SpaceSaving(100) ]
+  for i, key in enumerate(stream):
+    half = halves[i % 2]
+    half[key] = half.get(key, 0) + 1
+  merged = halves[0].Merge(SpaceSavingFromState(halves[1].State()))
+  assert merged.total == len(stream) and len(merged) == 100
+  for key, count, error in merged.Top():
+    assert exact[key] <= count <= exact[key] + error and error <= merged.Bound(), ( key, exact[key], count, error )
+  assert sorted([ key for key, count, error in merged.Top(5) ]) == [ 'heavy%s' % i for i in range(5) ]
+
+  values = [ int(rnd.expovariate(1 / 300.0)) for i in range(20000) ]
+  histogram = LogHistogram(0.01)
+  for value in values:
+    histogram.Add(value)
+  assert len(histogram.buckets) < 1000
+  values.sort()
+  for q in ( 0.5, 0.9, 0.99 ):
+    actual = values[int(q * ( len(values) - 1 ))]
+    assert abs(histogram.Quantile(q) - actual) <= 0.01 * actual + 1, ( q, histogram.Quantile(q), actual )
+  assert histogram.Quantile(1.0) == values[-1]
+  other = LogHistogramFromState(histogram.State())
+  assert other.Merge(histogram).count == 2 * len(values) and other.Quantile(0.5) == histogram.Quantile(0.5)
+  print 'sketches: ok'
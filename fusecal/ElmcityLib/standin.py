@@ -0,0 +1,121 @@
+import os, time, socket, threading, hashlib, BaseHTTPServer, SocketServer, StringIO
+
+try:
+  import gzip
+except ImportError:
+  gzip = None
+
+# a local stand-in for the sites the parsers scrape, so fetch behavior (keep-alive,
+# ETag / If-Modified-Since, gzip) and the parsers themselves can be exercised
+# offline. pages are registered by path, or served from a fixtures directory.
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  protocol_version = 'HTTP/1.1'   # keep connections open between requests
+
+  def setup(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    # headers and body go out in separate writes; without this, nagle and the
+    # client's delayed ack add ~40ms to every request on a kept-alive connection
+    self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.server.standin.Count('connections')
+
+  def log_message(self, format, *args):
+    pass
+
+  def do_GET(self):
+    standin = self.server.standin
+    standin.Count('requests')
+    page = standin.Lookup(self.path)
+    if page is None:
+      self.Reply(404, 'not found', 'text/plain')
+      return
+    body, content_type, etag, last_modified = page
+    if self.headers.get('if-none-match') is not None:   # an etag, when sent, decides on its own
+      not_modified = self.headers.get('if-none-match') == etag
+    else:
+      not_modified = self.headers.get('if-modified-since') == last_modified
+    if not_modified:
+      standin.Count('not_modified')
+      self.send_response(304)
+      self.send_header('ETag', etag)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      return
+    headers = { 'ETag' : etag, 'Last-Modified' : last_modified }
+    if gzip is not None and 'gzip' in self.headers.get('accept-encoding', ''):
+      buf = StringIO.StringIO()
+      f = gzip.GzipFile(fileobj=buf, mode='wb')
+      f.write(body)
+      f.close()
+      body = buf.getvalue()
+      headers['Content-Encoding'] = 'gzip'
+      standin.Count('gzipped')
+    self.Reply(200, body, content_type, headers)
+
+  def Reply(self, status, body, content_type, headers=None):
+    self.send_response(status)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    for name, value in (headers or {}).items():
+      self.send_header(name, value)
+    self.end_headers()
+    self.wfile.write(body)
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+class StandIn:
+
+  def __init__(self, fixtures=None, port=0):
+    self.fixtures = fixtures
+    self.pages = {}
+    self.lock = threading.Lock()
+    self.counters = { 'connections' : 0, 'requests' : 0, 'not_modified' : 0, 'gzipped' : 0 }
+    self.server = StandInServer(('127.0.0.1', port), StandInHandler)
+    self.server.standin = self
+    self.address = self.server.server_address
+
+  def Count(self, name):
+    self.lock.acquire()
+    try:
+      self.counters[name] += 1
+    finally:
+      self.lock.release()
+
+  def Add(self, path, body, content_type='text/html'):
+    etag = '"%s"' % hashlib.md5(body).hexdigest()
+    last_modified = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime())
+    self.pages[path] = ( body, content_type, etag, last_modified )
+
+  def Lookup(self, path):
+    if path in self.pages:
+      return self.pages[path]
+    if self.fixtures is None:
+      return None
+    name = path.lstrip('/').split('?')[0]
+    filename = os.path.join(self.fixtures, name)
+    if not name or not os.path.isfile(filename):
+      return None
+    f = open(filename, 'rb')
+    try:
+      self.Add(path, f.read(), ContentType(filename))
+    finally:
+      f.close()
+    return self.pages[path]
+
+  def Start(self):
+    t = threading.Thread(target=self.server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+
+  def Stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+def ContentType(filename):
+  if filename.endswith('.ics'):
+    return 'text/calendar'
+  if filename.endswith('.xml') or filename.endswith('.rss'):
+    return 'application/rss+xml'
+  return 'text/html'
@@ -0,0 +1,39 @@
+import os, thread
+
+# ElmcityLib.zip is unpacked into the role's local storage resource (see startup.py),
+# so local storage is the parent of this directory. ELMCITY_LOCAL_STORAGE overrides
+# that for local testing.
+
+lib_dir = os.path.dirname(os.path.abspath(__file__))
+
+def get_local_storage():
+  return os.environ.get('ELMCITY_LOCAL_STORAGE') or os.path.dirname(lib_dir)
+
+def get_storage_dir(*names):
+  directory = os.path.join(get_local_storage(), *names)
+  if not os.path.isdir(directory):
+    try:
+      os.makedirs(directory)
+    except OSError:
+      if not os.path.isdir(directory):   # lost a race with another worker, which is fine
+        raise
+  return directory
+
+def temp_path(path):
+  return '%s.%s.%s.tmp' % ( path, os.getpid(), thread.get_ident() )
+
+def replace_file(tmp, path):
+  try:
+    os.rename(tmp, path)
+  except OSError:   # windows won't rename over an existing file
+    os.remove(path)
+    os.rename(tmp, path)
+
+def write_file_atomic(path, data, mode='wb'):
+  tmp = temp_path(path)
+  f = open(tmp, mode)
+  try:
+    f.write(data)
+  finally:
+    f.close()
+  replace_file(tmp, path)
@@ -0,0 +1,46 @@
+import threading, traceback, Queue
+
+# bounded-concurrency map for parsers that fan out one fetch per item. results come
+# back in the order of the inputs, and a failure in one item is captured in its
+# Outcome instead of sinking the rest.
+
+class Outcome:
+
+  def __init__(self, value=None, error=None):
+    self.value = value
+    self.error = error
+
+  def __repr__(self):
+    if self.error is not None:
+      return "<Outcome: error: %s>" % self.error.strip().split('\n')[-1]
+    return "<Outcome: %r>" % (self.value,)
+
+def Map(func, items, max_workers=4):
+  items = list(items)
+  outcomes = [None] * len(items)
+  work = Queue.Queue()
+  for i in range(len(items)):
+    work.put(i)
+
+  def Worker():
+    while True:
+      try:
+        i = work.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        outcomes[i] = Outcome(value=func(items[i]))
+      except:
+        outcomes[i] = Outcome(error=traceback.format_exc())
+
+  if max_workers <= 1 or len(items) <= 1:
+    Worker()
+    return outcomes
+
+  threads = [threading.Thread(target=Worker) for i in range(min(max_workers, len(items)))]
+  for t in threads:
+    t.setDaemon(True)
+    t.start()
+  for t in threads:
+    t.join()
+  return outcomes
@@ -0,0 +1,294 @@
+import datetime, threading
+
+try:
+  import clr
+  IPY = True
+except ImportError:
+  IPY = False
+
+if IPY:
+  clr.AddReference("System")
+  import System
+
+  clr.AddReference("CalendarAggregator")
+  import CalendarAggregator
+
+  clr.AddReference("DDay.iCal")
+  import DDay.iCal
+  import DDay.iCal.Serialization
+
+import icswriter
+
+# zones by the names hubs use (eastern, central, ...), resolved once per process.
+# a Zone keeps its standard offset and daylight rules in the shape of .NET's
+# TimeZoneInfo adjustment rules, works out each year's transitions the first time
+# that year comes up, and converts wall-clock times to and from utc with a table
+# lookup. its VTIMEZONE text is made once too. under IronPython the rules come
+# from TimeZoneInfo; plain python has the US zones built in, for local testing.
+
+SUNDAY = 6   # python weekday numbering
+
+class Transition:
+
+  # like TimeZoneInfo.TransitionTime: a fixed month and day, or the week'th
+  # weekday of the month (week 5 is the last one), at hour:minute local time
+
+  def __init__(self, month, week=None, weekday=None, hour=2, minute=0, day=None):
+    self.month = month
+    self.week = week
+    self.weekday = weekday
+    self.hour = hour
+    self.minute = minute
+    self.day = day
+
+  def Date(self, year):
+    if self.day is not None:
+      day = self.day
+    else:
+      first = datetime.date(year, self.month, 1)
+      day = 1 + ( self.weekday - first.weekday() ) % 7 + 7 * ( self.week - 1 )
+      while day > DaysIn(year, self.month):
+        day -= 7
+    return datetime.datetime(year, self.month, day, self.hour, self.minute)
+
+def DaysIn(year, month):
+  if month == 12:
+    return 31
+  return ( datetime.date(year, month + 1, 1) - datetime.date(year, month, 1) ).days
+
+class Rule:
+
+  def __init__(self, first_year, last_year, delta_minutes, start, end):
+    self.first_year = first_year
+    self.last_year = last_year
+    self.delta = datetime.timedelta(minutes=delta_minutes)
+    self.start = start    # in standard time
+    self.end = end        # in daylight time, as .NET has it
+
+US_RULES = [ Rule(2007, 9999, 60, Transition(3, 2, SUNDAY), Transition(11, 1, SUNDAY)),
+             Rule(1987, 2006, 60, Transition(4, 1, SUNDAY), Transition(10, 5, SUNDAY)) ]
+
+# tzid -> ( standard offset minutes, rules )
+BUILTIN = {
+  'Atlantic Standard Time' : ( -240, US_RULES ),
+  'Eastern Standard Time' : ( -300, US_RULES ),
+  'Central Standard Time' : ( -360, US_RULES ),
+  'Mountain Standard Time' : ( -420, US_RULES ),
+  'US Mountain Standard Time' : ( -420, [] ),
+  'Pacific Standard Time' : ( -480, US_RULES ),
+  'Alaskan Standard Time' : ( -540, US_RULES ),
+  'Hawaiian Standard Time' : ( -600, [] ),
+  'UTC' : ( 0, [] ),
+}
+
+class Zone:
+
+  def __init__(self, name, tzid, standard_minutes, rules, tzinfo=None):
+    self.name = name
+    self.tzid = tzid
+    self.standard = datetime.timedelta(minutes=standard_minutes)
+    self.rules = rules
+    self.tzinfo = tzinfo      # the TimeZoneInfo, under IronPython
+    self.years = {}           # year -> ( daylight start, daylight end, delta ) in standard time, or None
+    self.vtimezone = None
+    self.lock = threading.Lock()
+
+  def __repr__(self):
+    return "<Zone: %s, %s>" % ( self.name, self.tzid )
+
+  def Transitions(self, year):
+    try:
+      return self.years[year]
+    except KeyError:
+      pass
+    found = None
+    for rule in self.rules:
+      if rule.first_year <= year <= rule.last_year:
+        found = ( rule.start.Date(year), rule.end.Date(year) - rule.delta, rule.delta )
+        break
+    self.years[year] = found
+    return found
+
+  def Daylight(self, standard_time):
+    t = self.Transitions(standard_time.year)
+    if t is None:
+      return None
+    start, end, delta = t
+    if start <= end:
+      inside = start <= standard_time < end
+    else:                                      # southern hemisphere
+      inside = standard_time >= start or standard_time < end
+    return inside and delta or None
+
+  def ToUtc(self, local):
+    # a wall time in the hour skipped in spring counts as daylight time, one in the
+    # hour repeated in the fall as standard time, which is what .NET does
+    delta = self.Daylight(local)
+    if delta is not None:
+      return local - self.standard - delta
+    return local - self.standard
+
+  def FromUtc(self, utc):
+    standard_time = utc + self.standard
+    delta = self.Daylight(standard_time)
+    if delta is not None:
+      return standard_time + delta
+    return standard_time
+
+  def VTimezone(self):
+    if self.vtimezone is None:
+      self.lock.acquire()
+      try:
+        if self.vtimezone is None:
+          if IPY:
+            self.vtimezone = DDayVTimezone(self.tzinfo)
+          else:
+            self.vtimezone = MakeVTimezone(self)
+      finally:
+        self.lock.release()
+    return self.vtimezone
+
+def DDayVTimezone(tzinfo):
+  # let DDay write the VTIMEZONE, as the dday backend does, and keep its text
+  cal = DDay.iCal.iCalendar()
+  CalendarAggregator.Collector.AddTimezoneToDDayICal(cal, tzinfo)
+  text = DDay.iCal.Serialization.iCalendar.iCalendarSerializer().SerializeToString(cal)
+  start = text.find('BEGIN:VTIMEZONE')
+  end = text.find('END:VTIMEZONE')
+  if start < 0 or end < 0:
+    return None
+  return text[start:end] + 'END:VTIMEZONE\r\n'
+
+def FormatOffset(offset):
+  minutes = offset.days * 1440 + offset.seconds // 60
+  sign = minutes < 0 and '-' or '+'
+  return '%s%02d%02d' % ( sign, abs(minutes) // 60, abs(minutes) % 60 )
+
+def ByDay(transition):
+  days = [ 'MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU' ]
+  week = transition.week == 5 and -1 or transition.week
+  return 'RRULE:FREQ=YEARLY;BYDAY=%s%s;BYMONTH=%s' % ( week, days[transition.weekday], transition.month )
+
+def MakeVTimezone(zone, year=None):
+  # from the rule in effect this year
+  year = year or datetime.date.today().year
+  standard = FormatOffset(zone.standard)
+  lines = [ 'BEGIN:VTIMEZONE', 'TZID:' + zone.tzid ]
+  rule = None
+  for candidate in zone.rules:
+    if candidate.first_year <= year <= candidate.last_year and candidate.start.day is None:
+      rule = candidate
+      break
+  if rule is None:
+    lines.extend([ 'BEGIN:STANDARD', 'DTSTART:16010101T000000', 'TZOFFSETFROM:' + standard, 'TZOFFSETTO:' + standard, 'END:STANDARD' ])
+  else:
+    daylight = FormatOffset(zone.standard + rule.delta)
+    lines.extend([ 'BEGIN:STANDARD', 'DTSTART:' + icswriter.FormatDateTime(rule.end.Date(1601)), ByDay(rule.end),
+                   'TZOFFSETFROM:' + daylight, 'TZOFFSETTO:' + standard, 'END:STANDARD',
+                   'BEGIN:DAYLIGHT', 'DTSTART:' + icswriter.FormatDateTime(rule.start.Date(1601)), ByDay(rule.start),
+                   'TZOFFSETFROM:' + standard, 'TZOFFSETTO:' + daylight, 'END:DAYLIGHT' ])
+  lines.append('END:VTIMEZONE')
+  return u''.join([icswriter.Fold(line) for line in lines])
+
+def FromTimeZoneInfo(name, tzinfo):
+  rules = []
+  for adjustment in tzinfo.GetAdjustmentRules():
+    rules.append(Rule(adjustment.DateStart.Year, adjustment.DateEnd.Year, adjustment.DaylightDelta.TotalMinutes,
+      FromTransitionTime(adjustment.DaylightTransitionStart), FromTransitionTime(adjustment.DaylightTransitionEnd)))
+  return Zone(name, tzinfo.Id, tzinfo.BaseUtcOffset.TotalMinutes, rules, tzinfo)
+
+def FromTransitionTime(t):
+  time_of_day = t.TimeOfDay
+  if t.IsFixedDateRule:
+    return Transition(t.Month, hour=time_of_day.Hour, minute=time_of_day.Minute, day=t.Day)
+  weekday = ( int(t.DayOfWeek) + 6 ) % 7    # System.DayOfWeek starts on sunday
+  return Transition(t.Month, t.Week, weekday, time_of_day.Hour, time_of_day.Minute)
+
+zones = {}   # name -> Zone
+zones_lock = threading.Lock()
+
+def Resolve(name):
+  if IPY:
+    return FromTimeZoneInfo(name, CalendarAggregator.Utils.TzinfoFromName(name))
+  tzid = icswriter.TzidFromName(name)
+  if tzid not in BUILTIN:
+    tzid = 'UTC'   # TzinfoFromName falls back to GMT
+  standard, rules = BUILTIN[tzid]
+  return Zone(name, tzid, standard, rules)
+
+def Get(name):
+  if name is None:
+    return None
+  key = name.strip().lower()
+  zone = zones.get(key)
+  if zone is None:
+    zone = Resolve(name)
+    zones_lock.acquire()
+    try:
+      zone = zones.setdefault(key, zone)
+    finally:
+      zones_lock.release()
+  return zone
+
+tzids = {}   # TZID -> Zone, or None if it isn't one we know
+
+def FromTzid(tzid):
+  # the Zone an ics TZID parameter names, by its Windows id as the feeds write
+  # them. unlike Get, an id nobody knows comes back None rather than as utc
+  try:
+    return tzids[tzid]
+  except KeyError:
+    pass
+  zone = None
+  if IPY:
+    try:
+      zone = FromTimeZoneInfo(tzid, System.TimeZoneInfo.FindSystemTimeZoneById(tzid))
+    except ( System.TimeZoneNotFoundException, System.InvalidTimeZoneException ):
+      pass
+  elif tzid in BUILTIN:
+    standard, rules = BUILTIN[tzid]
+    zone = Zone(tzid, tzid, standard, rules)
+  zones_lock.acquire()
+  try:
+    return tzids.setdefault(tzid, zone)
+  finally:
+    zones_lock.release()
+
+def Convert(starts, utc_flags, source, dest):
+  # one pass over a column of starts: utc ones, and wall-clock ones in source
+  # (floating if source is None), become wall-clock times in dest
+  converted = []
+  append = converted.append
+  for start, is_utc in zip(starts, utc_flags):
+    if is_utc:
+      append(dest.FromUtc(start))
+    elif source is None:
+      append(start)
+    else:
+      append(dest.FromUtc(source.ToUtc(start)))
+  return converted
+
+def test():
+  eastern = Get('eastern')
+  pacific = Get('Pacific')
+  assert eastern is Get('Eastern') and eastern.tzid == 'Eastern Standard Time'
+  dt = datetime.datetime
+  cases = [ ( dt(2010, 7, 8, 22, 0), dt(2010, 7, 9, 2, 0) ),      # daylight
+            ( dt(2010, 12, 1, 19, 0), dt(2010, 12, 2, 0, 0) ),    # standard
+            ( dt(2010, 3, 14, 2, 30), dt(2010, 3, 14, 6, 30) ),   # skipped in spring, read as daylight
+            ( dt(2010, 11, 7, 1, 30), dt(2010, 11, 7, 6, 30) ),   # repeated in the fall, read as standard
+            ( dt(2006, 4, 2, 3, 0), dt(2006, 4, 2, 7, 0) ) ]      # the pre-2007 rule
+  for local, utc in cases:
+    assert eastern.ToUtc(local) == utc, ( local, eastern.ToUtc(local), utc )
+  assert eastern.FromUtc(dt(2010, 11, 7, 5, 30)) == dt(2010, 11, 7, 1, 30)
+  assert eastern.FromUtc(dt(2010, 11, 7, 6, 30)) == dt(2010, 11, 7, 1, 30)
+  assert Convert([ dt(2010, 7, 8, 22, 0), dt(2010, 7, 9, 2, 0) ], [ 0, 1 ], eastern, pacific) == [ dt(2010, 7, 8, 19, 0) ] * 2
+  assert Convert([ dt(2010, 7, 8, 22, 0) ], [ 0 ], None, pacific) == [ dt(2010, 7, 8, 22, 0) ]
+  assert Get('nowhere').ToUtc(dt(2010, 7, 8)) == dt(2010, 7, 8)
+  assert FromTzid('Pacific Standard Time').ToUtc(dt(2010, 7, 8, 19, 0)) == dt(2010, 7, 9, 2, 0)
+  assert FromTzid('America/Nowhere') is None and FromTzid('Eastern Standard Time') is FromTzid('Eastern Standard Time')
+  if not IPY:
+    text = eastern.VTimezone()
+    assert 'RRULE:FREQ=YEARLY;BYDAY=1SU;BYMONTH=11' in text and 'TZOFFSETTO:-0400' in text, text
+    assert eastern.VTimezone() is text
+  print 'timezones: ok'
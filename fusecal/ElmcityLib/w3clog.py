@@ -0,0 +1,648 @@
+import sys, os, re, glob, heapq, json, time
+
+try:
+  import clr
+  IPY = True
+except ImportError:
+  IPY = False
+
+import w3cmap, logpool, sketches
+
+# the IIS log queries charts.py used to hand LogParser one at a time, answered in
+# one pass over the W3C logs. lines are split on the columns the most recent
+# #Fields directive names, so a header that changes partway through a file (IIS
+# writes a new one when logging settings change) is followed. Tables() gives the
+# rows each query gave, in the order it gave them: ties, which LogParser left
+# to chance, are broken by key.
+#
+#   aggregates = Aggregates()
+#   aggregates.AddFiles(glob.glob(log_dir + '/*.log'))
+#   for title, headers, rows in aggregates.Tables(): ...
+#
+# run as a script it writes the html tables and svg charts for a directory of
+# logs, which works anywhere, LogParser or no.
+
+TOP = 50
+
+# the columns the queries use, in the order Read yields them
+COLUMNS = ( 'date', 'time', 'cs-uri-stem', 'sc-status', 'sc-bytes', 'time-taken', 'c-ip' )
+
+# ( title, headers ) for make_html and make_chart, in the order charts.py runs them
+TABLES = [ ( 'Top400Urls', ( 'c', 'cs-uri-stem' ) ),
+           ( 'TopSlowUrlsStatusEq200', ( 'millis', 'sc-bytes', 'cs-uri-stem' ) ),
+           ( 'TopSlowUrlsStatusGt200', ( 'millis', 'sc-status', 'sc-bytes', 'cs-uri-stem' ) ),
+           ( 'TopUrls', ( 'c', 'cs-uri-stem' ) ) ]
+
+CHARTS = [ ( 'LoadTimesHtmlOnly', ( 'millis', 'pageloads' ) ),
+           ( 'LoadTimes', ( 'millis', 'pageloads' ) ),
+           ( 'RequestsByStatus', ( 'sc-status', 'requests' ) ),
+           ( 'RequestsByHour', ( 'hourly', 'requests' ) ),
+           ( 'RequestsByIp', ( 'dnsname', 'requests' ) ) ]
+
+def Positions(fields, columns):
+  positions = []
+  for column in columns:
+    if column in fields:
+      positions.append(fields.index(column))
+    else:
+      positions.append(-1)
+  return positions
+
+def Read(lines, columns=COLUMNS, fields=None):
+  # a tuple of the wanted columns per log line, None where a column is missing or '-'.
+  # fields is the #Fields directive in effect, when starting partway into a file
+  positions = fields and Positions(fields, columns) or None
+  for line in lines:
+    if line[:1] == '#':
+      if line[:8] == '#Fields:':
+        positions = Positions(line[8:].split(), columns)
+      continue
+    if positions is None:   # no directive yet, nothing to go by
+      continue
+    values = line.split()
+    if not values:
+      continue
+    count = len(values)
+    row = []
+    for i in positions:
+      if i < 0 or i >= count or values[i] == '-':
+        row.append(None)
+      else:
+        row.append(values[i])
+    yield tuple(row)
+
+def ReadFile(path, columns=COLUMNS):
+  f = open(path, 'rb')
+  try:
+    for row in Read(f, columns):
+      yield row
+  finally:
+    f.close()
+
+def RoundToDigits(value, digits=2):
+  # LogParser's QNTROUND_TO_DIGIT
+  magnitude = 1
+  while abs(value) >= 10 ** digits * magnitude:
+    magnitude *= 10
+  if magnitude == 1:
+    return value
+  return ( ( abs(value) + magnitude // 2 ) // magnitude * magnitude ) * ( value < 0 and -1 or 1 )
+
+def Hour(date, time):
+  # LogParser's QUANTIZE(TO_TIMESTAMP(date, time), 3600), as it prints timestamps
+  return '%s %s:00:00' % ( date, time[:2] )
+
+def ToInt(value):
+  try:
+    return int(value)
+  except ( TypeError, ValueError ):
+    return None
+
+COUNTS = ( 'urls_400', 'urls_200', 'load_times', 'load_times_html', 'by_status', 'by_hour', 'by_ip' )
+HEAPS = ( 'slow_200', 'slow_other' )
+
+# approximate mode. urls and client ips are the counts that grow with every
+# crawler and query string, so given an error, Aggregates counts those into
+# SpaceSaving tables big enough that no count is over by more than error times
+# the lines counted (see sketches.py), and memory stays put however many
+# distinct keys turn up. the rest are bounded already: statuses, hours, two-digit
+# load times, and the top-k heaps. it also keeps time-taken in a LogHistogram,
+# for a table of quantiles good to QUANTILE_ERROR. the tables say how far off
+# their counts may be. partials merge as before, though a merged SpaceSaving
+# table is only as exact as its bound, not equal to a serial run's.
+
+SKETCHED = ( 'urls_400', 'urls_200', 'by_ip' )
+QUANTILE_ERROR = 0.01
+QUANTILES = ( 0.5, 0.9, 0.95, 0.99 )
+
+QUANTILE_TABLES = [ ( 'LoadTimeQuantiles', ( 'quantile', 'millis', 'within' ) ) ]
+
+class Aggregates:
+
+  def __init__(self, top=TOP, error=None, quantile_error=QUANTILE_ERROR):
+    self.top = top
+    self.error = error    # None counts exactly
+    self.quantile_error = quantile_error
+    self.lines = 0
+    self.urls_400 = {}
+    self.urls_200 = {}
+    self.slow_200 = []      # min-heaps of the top slowest: ( millis, sc-bytes, cs-uri-stem )
+    self.slow_other = []    # ( millis, sc-status, sc-bytes, cs-uri-stem )
+    self.load_times = {}
+    self.load_times_html = {}
+    self.by_status = {}
+    self.by_hour = {}
+    self.by_ip = {}
+    self.times = None
+    if error is not None:
+      for name in SKETCHED:
+        setattr(self, name, sketches.SpaceSaving(sketches.Capacity(error)))
+      self.times = sketches.LogHistogram(quantile_error)
+
+  def State(self):
+    # json-able, for TailState and logpool
+    state = { 'lines' : self.lines, 'top' : self.top, 'error' : self.error, 'quantile_error' : self.quantile_error }
+    for name in COUNTS:
+      counts = getattr(self, name)
+      if isinstance(counts, sketches.SpaceSaving):
+        state[name] = counts.State()
+      else:
+        state[name] = counts.items()
+    for name in HEAPS:
+      state[name] = getattr(self, name)
+    if self.times is not None:
+      state['times'] = self.times.State()
+    return state
+
+  def Merge(self, other):
+    self.lines += other.lines
+    for name in COUNTS:
+      counts = getattr(self, name)
+      if isinstance(counts, sketches.SpaceSaving):
+        counts.Merge(getattr(other, name))
+        continue
+      for key, count in getattr(other, name).iteritems():
+        counts[key] = counts.get(key, 0) + count
+    for name in HEAPS:
+      heap = getattr(self, name)
+      for entry in getattr(other, name):
+        self.Keep(heap, entry)
+    if self.times is not None:
+      self.times.Merge(other.times)
+    return self
+
+  def Keep(self, heap, entry):
+    if len(heap) < self.top:
+      heapq.heappush(heap, entry)
+    elif entry > heap[0]:
+      heapq.heapreplace(heap, entry)
+
+  def Add(self, row):
+    date, time, uri, status, bytes, taken, ip = row
+    self.lines += 1
+    status = ToInt(status)
+    taken = ToInt(taken)
+    if status is not None:
+      self.by_status[status] = self.by_status.get(status, 0) + 1
+      if status == 400:
+        self.urls_400[uri] = self.urls_400.get(uri, 0) + 1
+      elif status == 200:
+        self.urls_200[uri] = self.urls_200.get(uri, 0) + 1
+      if taken is not None:
+        if status == 200:
+          self.Keep(self.slow_200, ( taken, ToInt(bytes), uri ))
+        elif status > 200:
+          self.Keep(self.slow_other, ( taken, status, ToInt(bytes), uri ))
+    if taken is not None:
+      if self.times is not None:
+        self.times.Add(taken)
+      millis = RoundToDigits(taken)
+      self.load_times[millis] = self.load_times.get(millis, 0) + 1
+      if uri is not None and 'html' in uri.lower():
+        self.load_times_html[millis] = self.load_times_html.get(millis, 0) + 1
+    if date is not None and time is not None:
+      hour = Hour(date, time)
+      self.by_hour[hour] = self.by_hour.get(hour, 0) + 1
+    if ip is not None:
+      self.by_ip[ip] = self.by_ip.get(ip, 0) + 1
+
+  def AddRows(self, rows):
+    add = self.Add
+    for row in rows:
+      add(row)
+
+  def AddLines(self, lines, fields=None):
+    self.AddRows(Read(lines, fields=fields))
+
+  def AddFiles(self, paths):
+    for path in paths:
+      if w3cmap.AVAILABLE:
+        self.AddRows(w3cmap.MappedReader(path, COLUMNS).Rows())
+        continue
+      f = open(path, 'rb')
+      try:
+        self.AddLines(f)
+      finally:
+        f.close()
+
+  def MostCommon(self, counts, limit=None):
+    if isinstance(counts, sketches.SpaceSaving):
+      return [ ( key, count ) for key, count, error in counts.Top(limit) ]
+    items = counts.items()
+    key = lambda item: ( -item[1], item[0] )
+    if limit is None:
+      return sorted(items, key=key)
+    return heapq.nsmallest(limit, items, key=key)
+
+  def Slowest(self, heap):
+    return sorted(heap, reverse=True)
+
+  def UrlRows(self, counts):
+    if self.error is None:
+      return [ ( c, uri ) for uri, c in self.MostCommon(counts, self.top) ]
+    return [ ( c, uri, over ) for uri, c, over in counts.Top(self.top) ]
+
+  def QuantileRows(self):
+    within = '%g%%' % ( self.quantile_error * 100 )
+    rows = [ ( 'p%g' % ( q * 100 ), self.Quantile(q), within ) for q in QUANTILES ]
+    return rows + [ ( 'max', self.times.max, '0%' ) ]
+
+  def Quantile(self, q):
+    value = self.times.Quantile(q)
+    if value is None:
+      return None
+    return int(round(value))
+
+  def Rows(self, title):
+    if title == 'Top400Urls':
+      return self.UrlRows(self.urls_400)
+    if title == 'TopSlowUrlsStatusEq200':
+      return self.Slowest(self.slow_200)
+    if title == 'TopSlowUrlsStatusGt200':
+      return self.Slowest(self.slow_other)
+    if title == 'TopUrls':
+      return self.UrlRows(self.urls_200)
+    if title == 'LoadTimesHtmlOnly':
+      return sorted(self.load_times_html.items())
+    if title == 'LoadTimes':
+      return sorted(self.load_times.items())
+    if title == 'RequestsByStatus':
+      return self.MostCommon(self.by_status)
+    if title == 'RequestsByHour':
+      return sorted(self.by_hour.items())
+    if title == 'RequestsByIp':
+      return self.MostCommon(self.by_ip, self.top)
+    if title == 'LoadTimeQuantiles':
+      return self.QuantileRows()
+    raise KeyError(title)
+
+  def Headers(self, title, headers):
+    # in approximate mode, with the bounds on the counts
+    if self.error is None:
+      return headers
+    if title in ( 'Top400Urls', 'TopUrls' ):
+      return headers + ( 'at most over by', )
+    if title == 'RequestsByIp':   # a chart: the legend says it
+      return ( headers[0], '%s (each at most %s over)' % ( headers[1], self.by_ip.Bound() ) )
+    return headers
+
+  def Tables(self):
+    tables = TABLES
+    if self.error is not None:
+      tables = TABLES + QUANTILE_TABLES
+    return [ ( title, self.Headers(title, headers), self.Rows(title) ) for title, headers in tables ]
+
+  def Charts(self):
+    return [ ( title, self.Headers(title, headers), self.Rows(title) ) for title, headers in CHARTS ]
+
+def Bytes(value):
+  # json hands back unicode; the log's bytes went in as latin-1
+  if isinstance(value, unicode):
+    return value.encode('latin-1')
+  return value
+
+def FromState(state):
+  aggregates = Aggregates(state['top'], state['error'], state['quantile_error'])
+  aggregates.lines = state['lines']
+  for name in COUNTS:
+    if isinstance(state[name], dict):
+      setattr(aggregates, name, sketches.SpaceSavingFromState(state[name], Bytes))
+    else:
+      setattr(aggregates, name, dict([ ( Bytes(key), count ) for key, count in state[name] ]))
+  for name in HEAPS:
+    heap = [ tuple([ Bytes(value) for value in entry ]) for entry in state[name] ]   # json made them lists
+    heapq.heapify(heap)
+    setattr(aggregates, name, heap)
+  if 'times' in state:
+    aggregates.times = sketches.LogHistogramFromState(state['times'])
+  return aggregates
+
+def CompleteLines(f, position):
+  # the whole lines from where position left off, moving its offset and fields
+  # along; a line still being written is left for next time
+  for line in f:
+    if not line.endswith('\n'):
+      break
+    position['offset'] += len(line)
+    if line[:8] == '#Fields:':
+      position['fields'] = line[8:].split()
+    yield line
+
+def ReadPart(path, offset=0, fields=None, top=TOP, error=None):
+  # what the complete lines past offset add up to: ( Aggregates, offset after them, #Fields in effect there )
+  aggregates = Aggregates(top, error)
+  if w3cmap.AVAILABLE:
+    reader = w3cmap.MappedReader(path, COLUMNS, offset, fields)
+    aggregates.AddRows(reader.Rows())
+    return aggregates, reader.offset, reader.fields
+  position = { 'offset' : offset, 'fields' : fields }
+  f = open(path, 'rb')
+  try:
+    f.seek(offset)
+    aggregates.AddLines(CompleteLines(f, position), fields)
+  finally:
+    f.close()
+  return aggregates, position['offset'], position['fields']
+
+def ReadRequest(request):
+  # a logpool job
+  aggregates, offset, fields = ReadPart(request['path'], request['offset'], request['fields'], request['top'], request['error'])
+  return { 'state' : aggregates.State(), 'offset' : offset, 'fields' : fields }
+
+def MakeRequest(path, offset=0, fields=None, top=TOP, error=None):
+  return { 'kind' : 'w3c', 'path' : path, 'offset' : offset, 'fields' : fields, 'top' : top, 'error' : error }
+
+def ReadFiles(paths, workers=1, top=TOP, error=None):
+  # AddFiles, spread over workers (see logpool.py)
+  totals = Aggregates(top, error)
+  for response in logpool.Map([ MakeRequest(path, top=top, error=error) for path in sorted(paths) ], workers):
+    totals.Merge(FromState(response['state']))
+  return totals
+
+# incremental runs. charts.py runs every few minutes over logs that mostly haven't
+# changed since last time, so a TailState remembers, per log file, how far it has
+# been read, the #Fields directive in effect there, and the aggregates of what
+# was read. a run reads only what has been appended since, as complete lines, and
+# merges the per-file aggregates into the totals. a file that is replaced or cut
+# short starts over; one that is gone, or hasn't been written within the window,
+# drops out of the totals. IIS starts a new file every day (or hour), so the window
+# is kept a file at a time.
+
+STATE_VERSION = 2
+HEAD_BYTES = 128    # the #Software/#Version/#Date lines, to tell a reused inode from the same file
+
+def StatePath():
+  import storage
+  return os.path.join(storage.get_storage_dir('w3clog'), 'tail.json')
+
+def FileId(st):
+  # st_ino is 0 on windows, where st_ctime is the creation time instead
+  return st.st_ino or int(st.st_ctime)
+
+def Head(path):
+  f = open(path, 'rb')
+  try:
+    return f.read(HEAD_BYTES)
+  finally:
+    f.close()
+
+class TailState:
+
+  def __init__(self, path, window_days=None, top=TOP, error=None):
+    self.path = path
+    self.window_days = window_days
+    self.top = top
+    self.error = error
+    self.files = {}    # log path -> { id, head, offset, fields, mtime, state }
+    self.Load()
+
+  def Load(self):
+    try:
+      f = open(self.path, 'rb')
+      try:
+        saved = json.loads(f.read())
+      finally:
+        f.close()
+    except ( IOError, ValueError ):
+      return
+    if saved.get('version') == STATE_VERSION and saved.get('top') == self.top and saved.get('error') == self.error:
+      self.files = saved['files']
+
+  def Save(self):
+    import storage
+    storage.write_file_atomic(self.path, json.dumps({ 'version' : STATE_VERSION, 'top' : self.top, 'error' : self.error, 'files' : self.files }, encoding='latin-1'))
+
+  def Expired(self, mtime, now):
+    return self.window_days is not None and mtime < now - self.window_days * 86400
+
+  def Update(self, paths, now=None, workers=1):
+    # reads what is new in paths, workers files at a time, and returns the totals over the window
+    now = now or time.time()
+    files = {}
+    grown = []
+    for path in sorted(paths):
+      try:
+        st = os.stat(path)
+      except OSError:
+        continue
+      if self.Expired(st.st_mtime, now):
+        continue
+      entry = self.files.get(path)
+      if entry is None or entry['id'] != FileId(st) or st.st_size < entry['offset'] or Bytes(entry['head']) != Head(path)[:len(entry['head'])]:
+        entry = { 'id' : FileId(st), 'head' : '', 'offset' : 0, 'fields' : None, 'state' : None }
+      entry['mtime'] = st.st_mtime
+      files[path] = entry
+      if st.st_size > entry['offset']:
+        grown.append(path)
+    requests = [ MakeRequest(path, files[path]['offset'], files[path]['fields'], self.top, self.error) for path in grown ]
+    for path, response in zip(grown, logpool.Map(requests, workers)):
+      entry = files[path]
+      aggregates = FromState(response['state'])
+      if entry['state']:
+        aggregates = FromState(entry['state']).Merge(aggregates)
+      entry['state'] = aggregates.State()
+      entry['offset'] = response['offset']
+      entry['fields'] = response['fields']
+      if len(entry['head']) < HEAD_BYTES:
+        entry['head'] = Head(path)[:min(entry['offset'], HEAD_BYTES)]
+    totals = Aggregates(self.top, self.error)
+    for path in sorted(files):
+      if files[path]['state']:
+        totals.Merge(FromState(files[path]['state']))
+    self.files = files
+    return totals
+
+# output
+
+def Escape(value):
+  if value is None:
+    return ''
+  return unicode(value).replace('&', '&amp;').replace('<', '&lt;')
+
+def Cell(value):
+  # as make_html_table cleans up a value
+  if value is None:
+    return ''
+  value = unicode(value).replace('\r', '').replace('\n', '').replace('<', '&lt;')
+  return re.sub('[ ]+', ' ', value)
+
+def HtmlRows(headers, rows):
+  # the header and value rows of make_html_table
+  lines = [ '<tr>%s</tr>\n' % ''.join([ '<td>%s</td>' % header for header in headers ]) ]
+  for row in rows:
+    lines.append('<tr>%s</tr>\n' % ''.join([ '<td>%s</td>' % Cell(value) for value in row ]))
+  return u''.join(lines)
+
+def WriteChart(path, title, headers, rows, width=1500, height=800):
+  # a column chart of a two-column result, the shape LogParser's CHART output had:
+  # a gif from the .NET chart control under IronPython, an svg otherwise
+  if IPY:
+    WriteGifChart(path, title, headers, rows, width, height)
+  else:
+    f = open(path, 'wb')
+    try:
+      f.write(SvgChart(title, headers, rows, width, height).encode('utf-8'))
+    finally:
+      f.close()
+
+def WriteGifChart(path, title, headers, rows, width, height):
+  clr.AddReference('System.Windows.Forms.DataVisualization')
+  from System.Windows.Forms.DataVisualization.Charting import Chart, ChartArea, Series, SeriesChartType, Legend, Title, ChartImageFormat
+  chart = Chart()
+  chart.Width = width
+  chart.Height = height
+  chart.ChartAreas.Add(ChartArea('main'))
+  chart.Titles.Add(Title(title))
+  chart.Legends.Add(Legend())
+  series = Series(headers[1])
+  series.ChartType = SeriesChartType.Column
+  for category, value in rows:
+    series.Points.AddXY(str(category), value)
+  chart.Series.Add(series)
+  chart.SaveImage(path, ChartImageFormat.Gif)
+
+def SvgChart(title, headers, rows, width, height):
+  left, top, bottom = 60, 40, 120
+  plot_height = height - top - bottom
+  peak = max([ value for category, value in rows ] + [ 1 ])
+  step = float(width - left - 20) / max(len(rows), 1)
+  parts = [ '<svg xmlns="http://www.w3.org/2000/svg" width="%s" height="%s" font-family="sans-serif" font-size="11">' % ( width, height ),
+            '<text x="%s" y="24" font-size="16" text-anchor="middle">%s</text>' % ( width // 2, Escape(title) ),
+            '<text x="%s" y="24" text-anchor="end">%s</text>' % ( width - 20, Escape(headers[1]) ),
+            '<text x="4" y="%s">%s</text>' % ( top + 4, peak ),
+            '<line x1="%s" y1="%s" x2="%s" y2="%s" stroke="black"/>' % ( left, top + plot_height, width - 20, top + plot_height ) ]
+  for i, ( category, value ) in enumerate(rows):
+    bar = plot_height * value / float(peak)
+    x = left + i * step
+    parts.append('<rect x="%.1f" y="%.1f" width="%.1f" height="%.1f" fill="steelblue"><title>%s: %s</title></rect>' % ( x + step * 0.1, top + plot_height - bar, step * 0.8, bar, Escape(category), value ))
+    parts.append('<text transform="translate(%.1f,%s) rotate(60)">%s</text>' % ( x + step / 2, top + plot_height + 12, Escape(category) ))
+  parts.append('</svg>')
+  return u'\n'.join(parts)
+
+def WriteReport(aggregates, out_dir, prefix='web_'):
+  for title, headers, rows in aggregates.Tables():
+    f = open(os.path.join(out_dir, '%s%s.html' % ( prefix, title )), 'wb')
+    try:
+      f.write(( u'<html>\n<head><title>%s</title></head>\n<body>\n<h1>%s</h1>\n<table>\n%s</table>\n</body>\n</html>' % ( title, title, HtmlRows(headers, rows) ) ).encode('utf-8'))
+    finally:
+      f.close()
+  for title, headers, rows in aggregates.Charts():
+    WriteChart(os.path.join(out_dir, '%s%s.%s' % ( prefix, title, IPY and 'gif' or 'svg' )), title, headers, rows)
+
+def test():
+  log = """#Software: Microsoft Internet Information Services 7.0
+#Version: 1.0
+#Date: 2010-10-25 14:02:11
+#Fields: date time s-ip cs-method cs-uri-stem cs-uri-query s-port cs-username c-ip cs(User-Agent) sc-status sc-substatus sc-win32-status time-taken
+2010-10-25 14:02:11 10.0.0.1 GET /services/elmcity/html - 80 - 1.2.3.4 Mozilla/5.0 200 0 0 1234
+2010-10-25 14:03:00 10.0.0.1 GET /services/elmcity/ics - 80 - 1.2.3.4 Mozilla/5.0 200 0 0 15
+2010-10-25 14:05:00 10.0.0.1 GET /bad - 80 - 5.6.7.8 Bot 400 0 0 3
+2010-10-25 15:00:00 10.0.0.1 GET /missing - 80 - 5.6.7.8 Bot 404 0 2 99
+#Software: Microsoft Internet Information Services 7.0
+#Fields: date time c-ip cs-uri-stem sc-status sc-bytes time-taken
+2010-10-25 15:10:00 1.2.3.4 /services/elmcity/HTML 200 5120 1251
+2010-10-25 15:11:00 9.9.9.9 /bad 400 100 -
+"""
+  aggregates = Aggregates()
+  aggregates.AddLines(log.splitlines(True))
+  assert aggregates.lines == 6
+  rows = dict([ ( title, rows ) for title, headers, rows in aggregates.Tables() + aggregates.Charts() ])
+  assert rows['Top400Urls'] == [ ( 2, '/bad' ) ], rows['Top400Urls']
+  assert rows['TopUrls'] == [ ( 1, '/services/elmcity/HTML' ), ( 1, '/services/elmcity/html' ), ( 1, '/services/elmcity/ics' ) ]
+  assert rows['TopSlowUrlsStatusEq200'] == [ ( 1251, 5120, '/services/elmcity/HTML' ), ( 1234, None, '/services/elmcity/html' ), ( 15, None, '/services/elmcity/ics' ) ]
+  assert rows['TopSlowUrlsStatusGt200'] == [ ( 99, 404, None, '/missing' ), ( 3, 400, None, '/bad' ) ]
+  assert rows['LoadTimes'] == [ ( 3, 1 ), ( 15, 1 ), ( 99, 1 ), ( 1200, 1 ), ( 1300, 1 ) ], rows['LoadTimes']
+  assert rows['LoadTimesHtmlOnly'] == [ ( 1200, 1 ), ( 1300, 1 ) ]
+  assert rows['RequestsByStatus'] == [ ( 200, 3 ), ( 400, 2 ), ( 404, 1 ) ]
+  assert rows['RequestsByHour'] == [ ( '2010-10-25 14:00:00', 3 ), ( '2010-10-25 15:00:00', 3 ) ]
+  assert rows['RequestsByIp'] == [ ( '1.2.3.4', 3 ), ( '5.6.7.8', 2 ), ( '9.9.9.9', 1 ) ]
+  assert [ RoundToDigits(n) for n in ( 0, 7, 99, 100, 149, 150, 1234, 98765 ) ] == [ 0, 7, 99, 100, 150, 150, 1200, 99000 ]
+  assert HtmlRows(( 'c', 'cs-uri-stem' ), [ ( 2, '/a<b' ) ]) == u'<tr><td>c</td><td>cs-uri-stem</td></tr>\n<tr><td>2</td><td>/a&lt;b</td></tr>\n'
+  assert '<rect' in SvgChart('LoadTimes', ( 'millis', 'pageloads' ), rows['LoadTimes'], 1500, 800)
+  TestTailState(log)
+  TestApproximate()
+  print 'w3clog: ok'
+
+def TestApproximate():
+  import random
+  rnd = random.Random(7)
+  lines = [ '#Fields: date time c-ip cs-uri-stem sc-status time-taken\n' ]
+  for i in range(20000):
+    if i % 4:
+      ip, uri = '66.249.%s.%s' % ( rnd.randint(0, 255), rnd.randint(0, 255) ), '/q/%s' % rnd.randint(0, 50000)   # a bot storm
+    else:
+      ip, uri = '10.0.0.%s' % ( i % 3 ), '/services/%s/html' % ( i % 3 )
+    lines.append('2010-10-25 %02d:00:00 %s %s %s %s\n' % ( i % 24, ip, uri, i % 10 and 200 or 400, int(rnd.expovariate(1 / 200.0)) ))
+  exact = Aggregates()
+  exact.AddLines(lines)
+  approximate = Aggregates(error=0.005)
+  approximate.AddLines(lines)
+  assert len(approximate.by_ip) == 200 and len(exact.by_ip) > 10000
+  tables = dict([ ( title, ( headers, rows ) ) for title, headers, rows in approximate.Tables() + approximate.Charts() ])
+  headers, rows = tables['TopUrls']
+  assert headers == ( 'c', 'cs-uri-stem', 'at most over by' )
+  for c, uri, over in rows:
+    assert exact.urls_200.get(uri, 0) <= c <= exact.urls_200.get(uri, 0) + over and over <= approximate.urls_200.Bound()
+  assert [ uri for c, uri, over in rows[:3] ] == [ uri for c, uri in exact.Rows('TopUrls')[:3] ]
+  headers, rows = tables['RequestsByIp']
+  assert headers[1] == 'requests (each at most %s over)' % approximate.by_ip.Bound() and rows[:3] == exact.Rows('RequestsByIp')[:3]
+  assert tables['RequestsByHour'][1] == exact.Rows('RequestsByHour') and tables['LoadTimes'][1] == exact.Rows('LoadTimes')
+  times = sorted([ int(line.split()[-1]) for line in lines[1:] ])
+  headers, rows = tables['LoadTimeQuantiles']
+  assert [ row[0] for row in rows ] == [ 'p50', 'p90', 'p95', 'p99', 'max' ] and rows[-1][1] == times[-1]
+  for q, ( label, millis, within ) in zip(QUANTILES, rows):
+    actual = times[int(q * ( len(times) - 1 ))]
+    assert abs(millis - actual) <= actual * QUANTILE_ERROR + 1, ( label, millis, actual )
+  restored = FromState(json.loads(json.dumps(approximate.State())))
+  assert restored.Tables() + restored.Charts() == approximate.Tables() + approximate.Charts()
+  assert 'LoadTimeQuantiles' not in [ title for title, headers, rows in exact.Tables() ]
+
+def TestTailState(log):
+  import tempfile, shutil
+  directory = tempfile.mkdtemp(prefix='w3clog-')
+  try:
+    state_path = os.path.join(directory, 'tail.json')
+    today = os.path.join(directory, 'u_ex101025.log')
+    old = os.path.join(directory, 'u_ex100925.log')
+    def Write(path, text, mode='ab'):
+      f = open(path, mode)
+      f.write(text)
+      f.close()
+    lines = log.splitlines(True)
+    whole = Aggregates()
+    whole.AddLines(lines)
+    Write(old, ''.join(lines[:5]))
+    os.utime(old, ( time.time() - 30 * 86400, ) * 2)
+    Write(today, ''.join(lines[:6]) + lines[6][:20])   # the last line half written
+    first = TailState(state_path, window_days=7).Update([ today, old ])
+    assert first.lines == 2, first.lines
+    tail = TailState(state_path, window_days=7)
+    tail.Update([ today, old ])
+    tail.Save()
+    Write(today, lines[6][20:] + ''.join(lines[7:]))   # finished, and on past a #Fields change
+    tail = TailState(state_path, window_days=7)
+    assert tail.files[today]['offset'] == len(''.join(lines[:6]))
+    totals = tail.Update([ today, old ])
+    tail.Save()
+    assert [ rows for title, headers, rows in totals.Tables() + totals.Charts() ] == [ rows for title, headers, rows in whole.Tables() + whole.Charts() ]
+    assert TailState(state_path).Update([ today, old ]).lines == 6 + 1   # no window: the old file counts too
+    serial = TailState(os.path.join(directory, 'serial.json')).Update([ today, old ])
+    spread = TailState(os.path.join(directory, 'spread.json')).Update([ today, old ], workers=2)
+    assert spread.Tables() + spread.Charts() == serial.Tables() + serial.Charts()
+    Write(today, ''.join(lines[:5]), 'wb')   # replaced by a shorter file
+    assert TailState(state_path, window_days=7).Update([ today ]).lines == 1
+    Write(today, ''.join(lines), 'wb')
+    files = Aggregates()
+    files.AddFiles([ today ])
+    assert files.State() == whole.State()
+  finally:
+    shutil.rmtree(directory)
+
+if __name__ == '__main__':
+  if len(sys.argv) < 3:
+    print 'usage: w3clog.py LOG_DIR OUT_DIR [COUNT_ERROR]'
+    sys.exit(1)
+  error = len(sys.argv) > 3 and float(sys.argv[3]) or None
+  aggregates = ReadFiles(glob.glob(os.path.join(sys.argv[1], '*.log')), logpool.CpuCount(), error=error)
+  WriteReport(aggregates, sys.argv[2])
+  print '%s lines' % aggregates.lines
@@ -0,0 +1,168 @@
+import os, re, time
+
+try:
+  import mmap
+except ImportError:   # IronPython 2.6 has no mmap
+  mmap = None
+
+# reads the columns a query wants out of a W3C log without making a string of
+# every line and a list of every split. the file is mapped, not read, and each
+# #Fields directive compiles to a pattern that steps over the fields nobody
+# asked for and captures the rest, which the regex engine runs straight over the
+# mapped bytes. only the captured fields become strings. directives are found
+# with find, a few per file, and only complete lines are read, so a file still
+# being written can be picked up again from offset next time.
+#
+#   reader = MappedReader(path, ( 'cs-uri-stem', 'sc-status' ))
+#   for uri, status in reader.Rows(): ...
+#   reader.offset, reader.fields    # where to start next time, and the header in effect there
+#
+# rows are what w3clog.Read makes of the same lines: a tuple in column order, with
+# None for '-' and for columns the header doesn't name. a line with fewer fields
+# than the header says, which IIS doesn't write, is passed over.
+
+AVAILABLE = mmap is not None
+
+def Pattern(fields, columns):
+  index = {}
+  for i, column in enumerate(columns):
+    if column in fields:
+      index[fields.index(column)] = i
+  parts = [ '(?P<c%s>(?!))?' % i for i, column in enumerate(columns) if column not in fields ]   # never matches: None
+  last = index and max(index.keys()) or -1
+  fields_parts = []
+  for position in range(last + 1):
+    if position in index:
+      fields_parts.append('(?:-(?=\\s)|(?P<c%s>\\S+))' % index[position])
+    else:
+      fields_parts.append('\\S+')
+  if not fields_parts:
+    fields_parts.append('(?=\\S)')
+  return re.compile('^' + ''.join(parts) + ' '.join(fields_parts), re.MULTILINE)
+
+class MappedReader:
+
+  def __init__(self, path, columns, offset=0, fields=None):
+    self.path = path
+    self.columns = columns
+    self.offset = offset
+    self.fields = fields
+    self.names = [ 'c%s' % i for i in range(len(columns)) ]
+
+  def Rows(self):
+    f = open(self.path, 'rb')
+    try:
+      size = os.fstat(f.fileno()).st_size
+      if size <= self.offset:
+        return
+      buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+        for row in self.Scan(buf, size):
+          yield row
+      finally:
+        buf.close()
+    finally:
+      f.close()
+
+  def Scan(self, buf, size):
+    end = buf.rfind('\n', self.offset, size) + 1   # through the last complete line
+    names = self.names
+    single = len(names) == 1
+    pattern = self.fields is not None and Pattern(self.fields, self.columns) or None
+    pos = self.offset
+    while pos < end:
+      if buf[pos] == '#':
+        next = buf.find('\n', pos, end) + 1
+        line = buf[pos:next]
+        if line[:8] == '#Fields:':
+          self.fields = line[8:].split()
+          pattern = Pattern(self.fields, self.columns)
+        pos = self.offset = next
+        continue
+      stop = buf.find('\n#', pos, end)   # the rest of this run of log lines
+      if stop < 0:
+        stop = end
+      else:
+        stop += 1
+      if pattern is not None:
+        for match in pattern.finditer(buf, pos, stop):
+          if single:
+            yield ( match.group(names[0]), )
+          else:
+            yield match.group(*names)
+      pos = self.offset = stop
+
+def test():
+  import tempfile
+  log = '\r\n'.join([ '#Software: Microsoft Internet Information Services 7.0',
+    '#Fields: date time s-ip cs-method cs-uri-stem cs-uri-query c-ip sc-status time-taken',
+    '2010-10-25 14:02:11 10.0.0.1 GET /html - 1.2.3.4 200 1234',
+    '2010-10-25 14:03:00 10.0.0.1 GET - - -x 304 15',
+    '2010-10-25 14:03:01 10.0.0.1 GET /short',
+    '#Fields: date time c-ip sc-status',
+    '2010-10-25 15:10:00 9.9.9.9 400',
+    '2010-10-25 15:11:00 8.8.8.8 500 trailing fields' ]) + '\r\n2010-10-25 15:12'
+  fd, path = tempfile.mkstemp(suffix='.log')
+  os.write(fd, log)
+  os.close(fd)
+  try:
+    columns = ( 'cs-uri-stem', 'sc-status', 'c-ip', 'time-taken' )
+    reader = MappedReader(path, columns)
+    rows = list(reader.Rows())
+    assert rows == [ ( '/html', '200', '1.2.3.4', '1234' ), ( None, '304', '-x', '15' ),
+                     ( None, '400', '9.9.9.9', None ), ( None, '500', '8.8.8.8', None ) ], rows
+    assert reader.offset == len(log) - len('2010-10-25 15:12') and reader.fields == [ 'date', 'time', 'c-ip', 'sc-status' ]
+    f = open(path, 'ab')
+    f.write(':00 7.7.7.7 200\r\n')
+    f.close()
+    rest = MappedReader(path, ( 'sc-status', ), reader.offset, reader.fields)
+    assert list(rest.Rows()) == [ ( '200', ) ]
+    assert list(MappedReader(path, ( 'sc-status', ), rest.offset, rest.fields).Rows()) == []
+  finally:
+    os.remove(path)
+  print 'w3cmap: ok'
+
+def benchmark(lines=200000):
+  import tempfile, w3clog
+  fields = 'date time s-ip cs-method cs-uri-stem cs-uri-query s-port cs-username c-ip cs(User-Agent) sc-status sc-substatus sc-win32-status sc-bytes time-taken'
+  line = '2010-10-25 14:%02d:%02d 10.0.0.1 GET /services/%s/html view=all 80 - 66.249.%s.%s Mozilla/5.0+(compatible;+Googlebot/2.1) %s 0 0 %s %s\n'
+  fd, path = tempfile.mkstemp(suffix='.log')
+  f = os.fdopen(fd, 'wb')
+  f.write('#Software: Microsoft Internet Information Services 7.0\n#Fields: %s\n' % fields)
+  for i in xrange(lines):
+    f.write(line % ( i // 60 % 60, i % 60, i % 300, i % 7, i % 250, i % 9 and 200 or 404, 1000 + i % 5000, i % 3000 ))
+  f.close()
+  try:
+    def Naive():
+      # readline and split, then pick
+      f = open(path, 'rb')
+      rows = []
+      positions = None
+      while True:
+        text = f.readline()
+        if not text:
+          break
+        if text.startswith('#Fields:'):
+          positions = w3clog.Positions(text[8:].split(), w3clog.COLUMNS)
+          continue
+        if text.startswith('#'):
+          continue
+        values = text.split(' ')
+        rows.append(tuple([ values[i].strip() for i in positions ]))
+      f.close()
+      return len(rows)
+    def Lines():
+      return len(list(w3clog.ReadFile(path)))
+    def Mapped():
+      return len(list(MappedReader(path, w3clog.COLUMNS).Rows()))
+    def Projected():
+      return len(list(MappedReader(path, ( 'cs-uri-stem', 'sc-status' )).Rows()))
+    assert list(w3clog.ReadFile(path)) == list(MappedReader(path, w3clog.COLUMNS).Rows())
+    size = os.path.getsize(path) / 1048576.0
+    for label, read in [ ( 'readline/split', Naive ), ( 'w3clog.Read', Lines ), ( 'mapped, 7 columns', Mapped ), ( 'mapped, 2 columns', Projected ) ]:
+      start = time.time()
+      count = read()
+      elapsed = time.time() - start
+      print '%-18s %s lines, %.1f MB in %.2f s, %.0f MB/s' % ( label, count, size, elapsed, size / elapsed )
+  finally:
+    os.remove(path)
@@ -1,59 +1,85 @@
-import sys, os, traceback
+import sys, os, traceback, json, socket
 
 import clr
 
-clr.AddReference("ElmcityUtils")
-import ElmcityUtils
-
 clr.AddReference("System")
 clr.AddReference("mscorlib")
 import System
 
-logger = ElmcityUtils.Logger()
+import dispatch, pool, metrics, logsink, cache
 
 global result
 
-def Dispatch(url=None,filter=None,tz_source=None,tz_dest=None):
- 
-  if ( filter is "" ):
-    filter = None
-
-  if ( tz_source is "" ):
-    tz_source = None
-
-  if ( tz_dest is "" ):
-    tz_dest = None
-
-  if url.lower().find('myspace.com') != -1:
-    from myspace import MySpaceParser
-    parser = MySpaceParser(url=url, filter=filter, tz_source=tz_source)
+# hand the request to the warm worker pool if one is running, otherwise start one
+# for next time and do this request in-process the old way. a pool that is running
+# but slow to answer is still running: the request may be in progress on one of
+# its workers, so it isn't started again here, or a second pool started
 
-  if url.lower().find('libraryinsight.com') != -1:
-    from libraryinsight import LibraryInsightParser
-    parser = LibraryInsightParser(url=url, filter=filter, tz_source=tz_source)
-
-  if url.lower().find('librarything.com') != -1:
-    from librarything import LibraryThingParser
-    parser = LibraryThingParser(url=url, filter=filter, tz_source=tz_source)
-
-  if parser is not None:
-    parser.Parse()
-    return parser.ics
+def Dispatch(url=None,filter=None,tz_source=None,tz_dest=None):
 
-  return ""
+  try:
+    return pool.PoolDispatch(url=url, filter=filter, tz_source=tz_source, tz_dest=tz_dest)
+  except pool.PoolError:
+    logsink.LogMsg("exception", "(fusecal) pool dispatch: " + url, traceback.format_exc())
+    return ""
+  except socket.timeout:
+    logsink.LogMsg("exception", "(fusecal) pool dispatch timed out: " + url, traceback.format_exc())
+    return ""
+  except:
+    logsink.LogMsg("warning", "(fusecal) no worker pool, dispatching in-process", traceback.format_exc())
+
+  try:
+    pool.StartPool()
+  except:
+    logsink.LogMsg("exception", "(fusecal) cannot start worker pool", traceback.format_exc())
+
+  return dispatch.Dispatch(url=url, filter=filter, tz_source=tz_source, tz_dest=tz_dest)
+
+# many feeds in one engine start: results in the same order as the requests
+
+def DispatchBatch(requests):
+
+  try:
+    return pool.PoolDispatchBatch(requests)
+  except pool.PoolError, e:
+    logsink.LogMsg("exception", "(fusecal) pool batch dispatch: %s requests" % len(requests), traceback.format_exc())
+    return [ { 'url' : request[0], 'error' : str(e) } for request in requests ]
+  except socket.timeout:
+    logsink.LogMsg("exception", "(fusecal) pool batch dispatch timed out: %s requests" % len(requests), traceback.format_exc())
+    return [ { 'url' : request[0], 'error' : 'timed out' } for request in requests ]
+  except:
+    logsink.LogMsg("warning", "(fusecal) no worker pool, dispatching batch in-process", traceback.format_exc())
+
+  try:
+    pool.StartPool()
+  except:
+    logsink.LogMsg("exception", "(fusecal) cannot start worker pool", traceback.format_exc())
+
+  return dispatch.DispatchBatch(requests)
 
 args = 'args: (%s) ' % ','.join(sys.argv)
 
-logger.LogMsg("info", '(fusecal.py)', ','.join(sys.path))
+logsink.LogMsg("info", '(fusecal.py)', args)
 
 try: 
-  url = sys.argv[0]  
-  filter = sys.argv[1]
-  tz_source = sys.argv[2]
-  logger.LogMsg("info", '(fusecal) url %s, filter %s, tz_source %s' % ( url, filter, tz_source), None)
-  result = Dispatch(url=url, filter=filter, tz_source=tz_source)
+  if sys.argv[0] == 'batch':   # args: batch, json list of [url, filter, tz_source, tz_dest]
+    requests = json.loads(sys.argv[1])
+    logsink.LogMsg("info", '(fusecal) batch of %s' % len(requests), None)
+    result = json.dumps(DispatchBatch(requests))
+  else:
+    url = sys.argv[0]  
+    filter = sys.argv[1]
+    tz_source = sys.argv[2]
+    tz_dest = len(sys.argv) > 3 and sys.argv[3] or None
+    logsink.LogMsg("info", '(fusecal) url %s, filter %s, tz_source %s, tz_dest %s' % ( url, filter, tz_source, tz_dest), None)
+    result = Dispatch(url=url, filter=filter, tz_source=tz_source, tz_dest=tz_dest)
 except:
-  logger.LogMsg("exception", traceback.format_exc(), None)
+  logsink.LogMsg("exception", traceback.format_exc(), None)
 
- 
+try:
+  cache.Report(force=True)
+  metrics.Close()   # samples from an in-process dispatch, and the writer thread: this engine won't run again
+except:
+  logsink.LogMsg("exception", "(fusecal) metrics", traceback.format_exc())
 
+logsink.Close()